@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/18 14:40
+# @Author : yuyeqing
+# @File   : bench_adgpu_parser.py
+# @IDE    : PyCharm
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from utils.adgpu_output_xml_parser import extract_free_nrg_binding, iter_output_files, parse_outputs
+
+
+def write_synthetic_output(out_dir: Path, name: str, n_runs: int, n_atoms: int, rng: random.Random):
+    """
+    Write <name>.xml and <name>.dlg in the AutoDock-GPU layout with random energies and poses.
+    """
+    runs = [(i, round(rng.uniform(-12, -3), 2), round(rng.uniform(-13, -4), 2), round(rng.uniform(-2, 0), 2),
+             round(rng.uniform(0, 2), 2)) for i in range(1, n_runs + 1)]
+    ranked = sorted(runs, key=lambda r: r[1])
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<autodock_gpu>', f'\t<dpf>{name}.pdbqt</dpf>', '\t<runs>']
+    for run_id, e, inter, intra, tors in runs:
+        lines += [f'\t\t<run id="{run_id}">',
+                  f'\t\t\t<free_NRG_binding>   {e}</free_NRG_binding>',
+                  f'\t\t\t<final_intermol_NRG> {inter}</final_intermol_NRG>',
+                  f'\t\t\t<internal_ligand_NRG>{intra}</internal_ligand_NRG>',
+                  f'\t\t\t<torsonial_free_NRG> {tors}</torsonial_free_NRG>',
+                  '\t\t</run>']
+    lines += ['\t</runs>', '\t<result>', '\t\t<clustering_histogram>']
+    # 3 clusters of consecutive ranks
+    clusters = [ranked[i::3] for i in range(3)]
+    for rank, members in enumerate(sorted(clusters, key=lambda c: c[0][1]), 1):
+        mean = sum(r[1] for r in members) / len(members)
+        lines.append(f'\t\t\t<cluster cluster_rank="{rank}" lowest_binding_energy="{members[0][1]}" '
+                     f'run="{members[0][0]}" mean_binding_energy="{mean:.2f}" num_in_clus="{len(members)}" />')
+    lines += ['\t\t</clustering_histogram>', '\t\t<rmsd_table>']
+    for sub_rank, (run_id, e, *_) in enumerate(ranked, 1):
+        lines.append(f'\t\t\t<run rank="{(sub_rank - 1) % 3 + 1}" sub_rank="{(sub_rank - 1) // 3 + 1}" '
+                     f'run="{run_id}" binding_energy="{e}" cluster_rmsd="{rng.uniform(0, 2):.2f}" '
+                     f'reference_rmsd="{rng.uniform(0, 10):.2f}" />')
+    lines += ['\t\t</rmsd_table>', '\t</result>', '</autodock_gpu>']
+    with open(out_dir / f"{name}.xml", 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    with open(out_dir / f"{name}.dlg", 'w') as f:
+        for run_id, e, inter, intra, tors in runs:
+            f.write(f"DOCKED: MODEL     {run_id:>4}\n"
+                    f"DOCKED: USER    Run = {run_id}\n"
+                    f"DOCKED: USER    Estimated Free Energy of Binding    = {e:+.2f} kcal/mol  [=(1)+(2)+(3)-(4)]\n"
+                    f"DOCKED: USER    (1) Final Intermolecular Energy     = {inter:+.2f} kcal/mol\n"
+                    f"DOCKED: USER    (2) Final Total Internal Energy     = {intra:+.2f} kcal/mol\n"
+                    f"DOCKED: USER    (3) Torsional Free Energy           = {tors:+.2f} kcal/mol\n")
+            for i in range(1, n_atoms + 1):
+                x, y, z = (rng.uniform(-20, 20) for _ in range(3))
+                f.write(f"DOCKED: ATOM  {i:5d}  C   UNL     1    {x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00     0.000 C \n")
+            f.write("DOCKED: ENDMDL\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the per-file ElementTree parser with the bulk parser "
+                                                 "on a synthetic corpus of AutoDock-GPU outputs.")
+    parser.add_argument("-n", "--n_outputs", type=int, default=5000, help="number of synthetic ligands")
+    parser.add_argument("--nrun", type=int, default=20, help="runs per ligand")
+    parser.add_argument("--atoms", type=int, default=30, help="atoms per pose")
+    parser.add_argument("-p", "--nproc", type=int, default=os.cpu_count(), help="processes of the parallel parser")
+    parser.add_argument("-d", "--corpus_dir", default=None, help="keep the corpus in this directory")
+    args = parser.parse_args()
+
+    corpus_dir = Path(args.corpus_dir or tempfile.mkdtemp(prefix="bench_adgpu_parser_"))
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        rng = random.Random(42)
+        start = time.perf_counter()
+        for i in range(args.n_outputs):
+            write_synthetic_output(corpus_dir, f"lig_{i:06d}", args.nrun, args.atoms, rng)
+        print(f"corpus: {args.n_outputs} ligands x {args.nrun} runs in {time.perf_counter() - start:.1f} s")
+
+        start = time.perf_counter()
+        n_runs = sum(len(extract_free_nrg_binding(f)) for f in iter_output_files([corpus_dir]))
+        elapsed = time.perf_counter() - start
+        print(f"{'extract_free_nrg_binding':>28}: {args.n_outputs / elapsed:.0f} ligands/s ({n_runs} runs, "
+              f"energies only, {elapsed:.2f} s)")
+        for nproc in sorted({1, args.nproc}):
+            start = time.perf_counter()
+            runs, ligands, coords = parse_outputs([corpus_dir], nproc=nproc)
+            elapsed = time.perf_counter() - start
+            print(f"{f'parse_outputs nproc={nproc}':>28}: {len(ligands) / elapsed:.0f} ligands/s ({len(runs)} runs, "
+                  f"{len(coords)} poses, {elapsed:.2f} s)")
+    finally:
+        if args.corpus_dir is None:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/16 10:05
+# @Author : yuyeqing
+# @File   : bench_gpu_pipeline.py
+# @IDE    : PyCharm
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from smiles_to_pdbqt import prep_backends
+from run_dock import RunParam, iter_task_params, run_stage
+
+stub_dir = Path(__file__).absolute().parent / "stubs"
+
+
+def bench_mode(mode, args, work_dir):
+    """
+    Dock the library once with the pool (`process_one_task_gpu` workers) or the asyncio runner,
+    starting from an empty grid cache.
+
+    :return: Dict with docked ligands/second and wall time, failed ligands are not counted.
+    """
+    out_dir = work_dir / mode
+    run = RunParam(
+        conf_yaml_file=args.conf_yaml_file, smiles_csv=args.smiles_csv, receptor_pdbqt=args.receptor_pdbqt,
+        out_dir=out_dir, nproc=args.gpu_slots, prep_nproc=args.prep_nproc, use_gpu=True,
+        map_cache_dir=str(out_dir / "grids"), prep_backend=args.prep_backend, results_format="sqlite",
+        pose_output="none", top_k=10, gpu_batch_size=args.gpu_batch_size,
+        gpu_async=mode == "async", gpu_slots=args.gpu_slots,
+    )
+    n_ligands = 0
+
+    def task_params():
+        nonlocal n_ligands
+        for _ in range(args.repeat):
+            for param in iter_task_params(run, out_dir):
+                param.ligand_name = f"{param.ligand_name}_{n_ligands}"
+                n_ligands += 1
+                yield param
+
+    start = time.perf_counter()
+    run_stage(run, task_params(), out_dir)
+    elapsed = time.perf_counter() - start
+    conn = sqlite3.connect(out_dir / "results.sqlite")
+    n_done = conn.execute("SELECT COUNT(*) FROM results WHERE status = 'done'").fetchone()[0]
+    first_error = conn.execute("SELECT log FROM results WHERE status != 'done' LIMIT 1").fetchone()
+    conn.close()
+    if n_done == 0:
+        raise RuntimeError(f"{mode}: none of {n_ligands} ligands docked: {first_error[0] if first_error else ''}")
+    return {"mode": mode, "ligands": n_done, "failed": n_ligands - n_done, "seconds": round(elapsed, 3),
+            "ligands_per_second": round(n_done / elapsed, 2)}
+
+
+def main():
+    examples = Path(__file__).absolute().parent.parent / "examples"
+    parser = argparse.ArgumentParser(
+        description="Compare the pool and asyncio GPU runners with the stub executables of benchmarks/stubs, "
+                    "which sleep instead of computing grids and docking.")
+    parser.add_argument("-i", "--smiles_csv", default=str(examples / "ligands.csv"), help="ligand library")
+    parser.add_argument("-c", "--conf_yaml_file", default=str(examples / "conf.yaml"), help="docking config")
+    parser.add_argument("-r", "--receptor_pdbqt", default=str(examples / "protein.pdbqt"), help="receptor")
+    parser.add_argument("-b", "--prep-backend", default="meeko", choices=list(prep_backends))
+    parser.add_argument("--prep-nproc", type=int, default=2, help="ligand preparation processes")
+    parser.add_argument("--gpu-slots", type=int, default=1, help="concurrent adgpu runs")
+    parser.add_argument("--gpu-batch-size", type=int, default=1, help="ligands per adgpu run")
+    parser.add_argument("--dock-sleep", type=float, default=0.5, help="seconds adgpu sleeps per ligand")
+    parser.add_argument("--init-sleep", type=float, default=0.2, help="seconds adgpu sleeps per run")
+    parser.add_argument("--grid-sleep", type=float, default=2., help="seconds autogrid4 sleeps per grid")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the library")
+    args = parser.parse_args()
+
+    os.environ["PATH"] = f"{stub_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ["STUB_ADGPU_SLEEP"] = str(args.dock_sleep)
+    os.environ["STUB_ADGPU_INIT"] = str(args.init_sleep)
+    os.environ["STUB_AUTOGRID_SLEEP"] = str(args.grid_sleep)
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_gpu_pipeline_"))
+    try:
+        rets = [bench_mode(mode, args, work_dir) for mode in ("pool", "async")]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for ret in rets:
+        print(f"{ret['mode']:>6}: {ret['ligands_per_second']} ligands/s ({ret['ligands']} ligands docked, "
+              f"{ret['failed']} failed, {ret['seconds']} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/8 16:12
+# @Author : yuyeqing
+# @File   : bench_prep_backends.py
+# @IDE    : PyCharm
+import sys
+import time
+import argparse
+import pandas as pd
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from smiles_to_pdbqt import prep_backends, smiles_to_pdbqt_string
+
+
+def bench_backend(backend, smiles_list, repeat=1):
+    """
+    Prepare every SMILES `repeat` times with one backend.
+
+    :return: Dict with successfully prepared ligands/second, the number of failures and the first error.
+    """
+    n_ok, n_fail, first_error = 0, 0, None
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for smiles in smiles_list:
+            try:
+                smiles_to_pdbqt_string(max(smiles.split("."), key=len), backend=backend)
+                n_ok += 1
+            except Exception as e:
+                n_fail += 1
+                first_error = first_error or str(e)
+    elapsed = time.perf_counter() - start
+    return {
+        "backend": backend,
+        "ligands": n_ok + n_fail,
+        "failed": n_fail,
+        "seconds": round(elapsed, 3),
+        "ligands_per_second": round(n_ok / elapsed, 2) if elapsed > 0 else None,
+        "error": first_error,
+    }
+
+
+def main():
+    default_csv = Path(__file__).absolute().parent.parent / "examples" / "ligands.csv"
+    parser = argparse.ArgumentParser(description="Compare ligands/second of the ligand preparation backends.")
+    parser.add_argument("-i", "--smiles_csv", default=str(default_csv), help="csv with a SMILES column")
+    parser.add_argument("-b", "--backend", action="append", choices=list(prep_backends),
+                        help="backend to benchmark, can be repeated, default all")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="passes over the library")
+    args = parser.parse_args()
+
+    smiles_list = pd.read_csv(args.smiles_csv).SMILES.tolist()
+    for backend in args.backend or list(prep_backends):
+        ret = bench_backend(backend, smiles_list, repeat=args.repeat)
+        print(f"{ret['backend']:>16}: {ret['ligands_per_second']} ligands/s "
+              f"({ret['ligands']} ligands, {ret['failed']} failed, {ret['seconds']} s)")
+        if ret["error"]:
+            print(f"{'':>16}  first error: {ret['error']}")
+
+
+if __name__ == '__main__':
+    main()
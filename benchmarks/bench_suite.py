@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/7/2 9:20
+# @Author : yuyeqing
+# @File   : bench_suite.py
+# @IDE    : PyCharm
+import os
+import sys
+import json
+import time
+import yaml
+import shutil
+import sqlite3
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from smiles_to_pdbqt import prep_backends, smiles_to_pdbqt_string
+from utils.vina_maps import cached_map_prefix, load_vina
+from run_dock import RunParam, iter_task_params, run_stage
+
+repo_dir = Path(__file__).absolute().parent.parent
+examples = repo_dir / "examples"
+stub_dir = Path(__file__).absolute().parent / "stubs"
+SUITES = ('prep', 'maps', 'dock', 'e2e', 'gpu')
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process and of its finished children, e.g. pool workers, in MB.
+    """
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak_kb / 1024, 1)
+
+
+def latency_stats(seconds: list):
+    if not seconds:
+        return None
+    p50, p90 = np.quantile(seconds, (0.5, 0.9)).tolist()
+    return {"n": len(seconds), "mean": round(float(np.mean(seconds)), 4), "p50": round(p50, 4),
+            "p90": round(p90, 4), "max": round(max(seconds), 4)}
+
+
+def case_result(case: str, n_ligands: int, seconds: float, latency: dict, **extra):
+    return {
+        "case": case,
+        "ligands": n_ligands,
+        "seconds": round(seconds, 3),
+        "ligands_per_hour": round(n_ligands / seconds * 3600, 1) if seconds > 0 else None,
+        "latency": latency,
+        **extra,
+    }
+
+
+def bench_config(args, work_dir: Path, **overrides):
+    """
+    Copy of the docking config with the benchmark settings, the seed is fixed so runs are comparable.
+    """
+    with open(args.conf_yaml_file, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    config.update({'seed': 42, 'cpu': 1, 'exhaustiveness': args.exhaustiveness, **overrides})
+    conf_file = work_dir / "conf.yaml"
+    with open(conf_file, 'w') as f:
+        yaml.dump(config, f)
+    return config, str(conf_file)
+
+
+def library(args):
+    return pd.read_csv(args.smiles_csv, usecols=['name', 'SMILES'])
+
+
+def bench_prep(args, work_dir: Path, backend: str):
+    """
+    Prepare every ligand of the library `args.repeat` times with one backend, without ligand cache.
+    """
+    smiles_list = library(args).SMILES.tolist()
+    latencies, n_failed, first_error = [], 0, None
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for smiles in smiles_list:
+            ligand_start = time.perf_counter()
+            try:
+                smiles_to_pdbqt_string(max(smiles.split("."), key=len), backend=backend)
+                latencies.append(time.perf_counter() - ligand_start)
+            except Exception as e:
+                n_failed += 1
+                first_error = first_error or str(e)
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        raise RuntimeError(f"no ligand prepared: {first_error}")
+    return case_result(f"prep/{backend}", len(latencies), elapsed, {"prep": latency_stats(latencies)},
+                       failed=n_failed)
+
+
+def bench_maps(args, work_dir: Path):
+    """
+    Compute the Vina maps of the receptor into an empty cache `args.repeat` times, then load them.
+    """
+    config, _ = bench_config(args, work_dir)
+    compute, load = [], []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        prefix = cached_map_prefix(config, args.receptor_pdbqt, str(work_dir / f"maps_{i}"))
+        compute.append(time.perf_counter() - start)
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        load_vina(config, args.receptor_pdbqt, str(work_dir / "maps_0"))
+        load.append(time.perf_counter() - start)
+    return case_result("maps", 0, sum(compute), {"maps": latency_stats(compute), "receptor_load": latency_stats(load)},
+                       map_prefix=Path(prefix).parent.name)
+
+
+def bench_dock(args, work_dir: Path):
+    """
+    Dock the first ligand of the library `args.repeat` times with one Vina thread, maps loaded from the cache.
+    """
+    config, _ = bench_config(args, work_dir)
+    smiles = library(args).SMILES.iloc[0]
+    pdbqt_string = smiles_to_pdbqt_string(max(smiles.split("."), key=len), backend=args.prep_backend)
+    v = load_vina(config, args.receptor_pdbqt, str(work_dir / "maps"))
+    latencies = []
+    for _ in range(args.repeat):
+        v.set_ligand_from_string(pdbqt_string)
+        start = time.perf_counter()
+        v.dock(exhaustiveness=config['exhaustiveness'], n_poses=config.get('n_poses', 5))
+        latencies.append(time.perf_counter() - start)
+    return case_result(f"dock/ex{config['exhaustiveness']}", len(latencies), sum(latencies),
+                       {"dock": latency_stats(latencies)}, opt_energy=float(v.score()[0]))
+
+
+def stage_latencies(out_dir: Path):
+    """
+    Per-stage latency statistics from the timings in `out_dir/results.sqlite`.
+    """
+    conn = sqlite3.connect(out_dir / "results.sqlite")
+    rows = [json.loads(t) for t, in conn.execute("SELECT timings FROM results WHERE status = 'done'")]
+    conn.close()
+    stages = sorted({stage for timings in rows for stage in timings})
+    return {stage: latency_stats([t[stage] for t in rows if stage in t]) for stage in stages}, len(rows)
+
+
+def repeated_library(args, work_dir: Path):
+    """
+    The library repeated `args.repeat` times with unique names, so every pass docks again.
+    """
+    df = library(args)
+    df = pd.concat([df.assign(name=df.name.astype(str) + f"_{i}") for i in range(args.repeat)])
+    smiles_csv = work_dir / "library.csv"
+    df.to_csv(smiles_csv, index=False)
+    return str(smiles_csv)
+
+
+def bench_e2e(args, work_dir: Path, nproc: int, cpu: int, exhaustiveness: int):
+    """
+    `dock-run` of the repeated library with `nproc` processes x `cpu` Vina threads, maps warmed up front
+    as the command does.
+    """
+    config, conf_file = bench_config(args, work_dir, exhaustiveness=exhaustiveness)
+    out_dir = work_dir / "e2e"
+    run = RunParam(conf_yaml_file=conf_file, smiles_csv=repeated_library(args, work_dir),
+                   receptor_pdbqt=args.receptor_pdbqt, out_dir=out_dir, nproc=nproc, cpu=cpu,
+                   prep_nproc=args.prep_nproc, map_cache_dir=str(work_dir / "maps"),
+                   prep_backend=args.prep_backend, results_format="sqlite", pose_output="none",
+                   metrics_file="none")
+    cached_map_prefix(config, run.receptor_pdbqt, run.map_cache_dir)
+    start = time.perf_counter()
+    run_stage(run, iter_task_params(run, out_dir), out_dir)
+    elapsed = time.perf_counter() - start
+    latency, n_done = stage_latencies(out_dir)
+    return case_result(f"e2e/nproc{nproc}_cpu{cpu}_ex{exhaustiveness}", n_done, elapsed, latency)
+
+
+def bench_gpu(args, work_dir: Path, mode: str, batch_size: int):
+    """
+    GPU `dock-run` with the stub executables of benchmarks/stubs, which sleep instead of computing,
+    so only the overhead of the pipeline is measured.
+    """
+    os.environ["PATH"] = f"{stub_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ["STUB_ADGPU_SLEEP"] = str(args.gpu_dock_sleep)
+    os.environ["STUB_ADGPU_INIT"] = str(args.gpu_init_sleep)
+    os.environ["STUB_AUTOGRID_SLEEP"] = "0"
+    _, conf_file = bench_config(args, work_dir)
+    out_dir = work_dir / "gpu"
+    run = RunParam(conf_yaml_file=conf_file, smiles_csv=repeated_library(args, work_dir),
+                   receptor_pdbqt=args.receptor_pdbqt, out_dir=out_dir, nproc=1, use_gpu=True,
+                   prep_nproc=args.prep_nproc, map_cache_dir=str(out_dir / "grids"), prep_backend=args.prep_backend,
+                   results_format="sqlite", pose_output="none", metrics_file="none", gpu_batch_size=batch_size,
+                   gpu_async=mode == "async")
+    start = time.perf_counter()
+    run_stage(run, iter_task_params(run, out_dir), out_dir)
+    elapsed = time.perf_counter() - start
+    latency, n_done = stage_latencies(out_dir)
+    return case_result(f"gpu/{mode}_batch{batch_size}", n_done, elapsed, latency)
+
+
+def run_case(func, args, *case_args):
+    """
+    Run one case in a fresh process with its own work directory, so peak memory and caches are per case.
+    """
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_suite_"))
+    try:
+        # the docking output of the case and its workers would drown the report
+        saved_fds = [os.dup(1), os.dup(2)]
+        with open(os.devnull, 'w') as devnull:
+            os.dup2(devnull.fileno(), 1)
+            os.dup2(devnull.fileno(), 2)
+            try:
+                ret = func(args, work_dir, *case_args)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                for fd, saved in zip((1, 2), saved_fds):
+                    os.dup2(saved, fd)
+                    os.close(saved)
+        ret["peak_rss_mb"] = peak_rss_mb()
+        return ret
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def iter_cases(args):
+    """
+    :return: Iterator of (case name, benchmark function, extra arguments) of the selected suites.
+    """
+    if 'prep' in args.suites:
+        for backend in args.backends or list(prep_backends):
+            yield f"prep/{backend}", bench_prep, (backend,)
+    if 'maps' in args.suites:
+        yield "maps", bench_maps, ()
+    if 'dock' in args.suites:
+        yield f"dock/ex{args.exhaustiveness}", bench_dock, ()
+    if 'e2e' in args.suites:
+        for layout in args.grid or default_grid(args):
+            nproc, cpu, exhaustiveness = map(int, layout.split(':'))
+            yield f"e2e/nproc{nproc}_cpu{cpu}_ex{exhaustiveness}", bench_e2e, (nproc, cpu, exhaustiveness)
+    if 'gpu' in args.suites:
+        for mode, batch_size in (("pool", 1), ("pool", 4), ("async", 1)):
+            yield f"gpu/{mode}_batch{batch_size}", bench_gpu, (mode, batch_size)
+
+
+def default_grid(args):
+    n_cores = len(os.sched_getaffinity(0))
+    grid = [(1, 1, args.exhaustiveness), (n_cores, 1, args.exhaustiveness), (1, n_cores, args.exhaustiveness),
+            (n_cores, 1, 2 * args.exhaustiveness)]
+    return [f"{nproc}:{cpu}:{ex}" for nproc, cpu, ex in dict.fromkeys(grid)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline: list, tolerance: float, min_seconds: float = 0.01):
+    """
+    Regressions of `results` against `baseline`: lower throughput, higher median stage latency or higher
+    peak memory by more than `tolerance` (relative). Latency changes below `min_seconds` are ignored as noise.
+
+    :return: List of regression dicts.
+    """
+    base = {r["case"]: r for r in baseline if "error" not in r}
+    regressions = []
+
+    def check(case, metric, new, old, higher_is_worse, min_diff=0.):
+        if new is None or old is None or abs(new - old) <= min_diff:
+            return
+        change = (new - old) / old if old else float('inf')
+        if (change > tolerance) if higher_is_worse else (change < -tolerance):
+            regressions.append({"case": case, "metric": metric, "baseline": old, "current": new,
+                                "change": round(change, 3)})
+
+    for r in results:
+        b = base.get(r["case"])
+        if b is None or "error" in r:
+            continue
+        check(r["case"], "ligands_per_hour", r["ligands_per_hour"], b["ligands_per_hour"], False)
+        check(r["case"], "peak_rss_mb", r["peak_rss_mb"], b["peak_rss_mb"], True)
+        for stage, stats in (r["latency"] or {}).items():
+            old = ((b["latency"] or {}).get(stage) or {}).get("p50")
+            check(r["case"], f"{stage}.p50", stats and stats["p50"], old, True, min_seconds)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Docking throughput benchmarks on a CPU-only machine: ligand preparation per backend, "
+                    "Vina map computation, a single Vina dock, end-to-end dock-run over a grid of "
+                    "processes / threads / exhaustiveness, and the GPU pipeline with stub executables. "
+                    "Writes JSON and compares it against a saved baseline.")
+    parser.add_argument("-s", "--suite", dest="suites", action="append", choices=SUITES,
+                        help="suite to run, can be repeated, default all")
+    parser.add_argument("-i", "--smiles_csv", default=str(examples / "ligands.csv"), help="ligand library")
+    parser.add_argument("-c", "--conf_yaml_file", default=str(examples / "conf.yaml"), help="docking config")
+    parser.add_argument("-r", "--receptor_pdbqt", default=str(examples / "protein.pdbqt"), help="receptor")
+    parser.add_argument("-b", "--backend", dest="backends", action="append", choices=list(prep_backends),
+                        help="preparation backend of the prep suite, can be repeated, default all")
+    parser.add_argument("--prep-backend", default="meeko", choices=list(prep_backends),
+                        help="preparation backend of the dock, e2e and gpu suites")
+    parser.add_argument("--prep-nproc", type=int, default=1, help="preparation processes of the e2e and gpu suites")
+    parser.add_argument("--exhaustiveness", type=int, default=4, help="exhaustiveness of the dock suite")
+    parser.add_argument("--grid", action="append", metavar="NPROC:CPU:EXHAUSTIVENESS",
+                        help="e2e layout, can be repeated, default derived from the available cores")
+    parser.add_argument("--repeat", type=int, default=2, help="repetitions / passes over the library")
+    parser.add_argument("--gpu-dock-sleep", type=float, default=0.05, help="seconds the adgpu stub sleeps per ligand")
+    parser.add_argument("--gpu-init-sleep", type=float, default=0.1, help="seconds the adgpu stub sleeps per run")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON file of the results")
+    parser.add_argument("--baseline", default=None, help="JSON file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative change flagged as regression")
+    args = parser.parse_args()
+    args.suites = args.suites or list(SUITES)
+
+    results = []
+    # spawn, so every case starts from a clean process and its peak memory is its own
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'), max_tasks_per_child=1) as pool:
+        for case, func, case_args in iter_cases(args):
+            try:
+                ret = pool.submit(run_case, func, args, *case_args).result()
+                latency = ", ".join(f"{stage} p50 {stats['p50']} s" for stage, stats in (ret["latency"] or {}).items()
+                                    if stats)
+                print(f"{case:>32}: {ret['ligands_per_hour']} ligands/h, {ret['peak_rss_mb']} MB, {latency}")
+            except Exception as e:
+                ret = {"case": case, "error": str(e)}
+                print(f"{case:>32}: failed, {e}")
+            results.append(ret)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cores": len(os.sched_getaffinity(0)),
+            "args": {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        },
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        report["baseline"] = {"file": args.baseline, "commit": baseline["meta"].get("commit")}
+        report["regressions"] = compare(results, baseline["results"], args.tolerance)
+        for r in report["regressions"]:
+            print(f"REGRESSION {r['case']} {r['metric']}: {r['baseline']} -> {r['current']} ({r['change']:+.1%})")
+        if not report["regressions"]:
+            print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"results: {args.output}")
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
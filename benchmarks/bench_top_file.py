@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/7/8 16:10
+# @Author : yuyeqing
+# @File   : bench_top_file.py
+# @IDE    : PyCharm
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from fep.components.top_file import TopFile
+
+
+def write_synthetic_topology(top_file: Path, n_lines: int, rng: random.Random):
+    """
+    Write a GROMACS topology of about `n_lines` lines: a forcefield include, then molecule types with
+    atoms, bonds, pairs, angles and dihedrals until the size is reached, then the system and molecules.
+    """
+    n_written = 0
+    n_mol = 0
+    with open(top_file, 'w') as f:
+        f.write('; synthetic topology\n#include "amber99sb-ildn.ff/forcefield.itp"\n\n')
+        while n_written < n_lines:
+            n_mol += 1
+            n_atoms = rng.randint(500, 2000)
+            f.write(f"[ moleculetype ]\n; Name            nrexcl\nMOL{n_mol}    3\n\n[ atoms ]\n"
+                    ";   nr       type  resnr residue  atom   cgnr     charge       mass\n")
+            for i in range(1, n_atoms + 1):
+                f.write(f"{i:6d}{'CT':>11}{i // 10 + 1:7d}{'ALA':>7}{'CA':>7}{i:7d}"
+                        f"{rng.uniform(-1, 1):11.4f}{12.011:11.3f}\n")
+            f.write("\n[ bonds ]\n;  ai    aj funct\n")
+            for i in range(1, n_atoms):
+                f.write(f"{i:5d}{i + 1:6d}     1\n")
+            f.write("\n[ pairs ]\n;  ai    aj funct\n")
+            for i in range(1, n_atoms - 2):
+                f.write(f"{i:5d}{i + 3:6d}     1\n")
+            f.write("\n[ angles ]\n;  ai    aj    ak funct\n")
+            for i in range(1, n_atoms - 1):
+                f.write(f"{i:5d}{i + 1:6d}{i + 2:6d}     1\n")
+            f.write("\n[ dihedrals ] ; propers\n;  ai    aj    ak    al funct\n")
+            for i in range(1, n_atoms - 2):
+                f.write(f"{i:5d}{i + 1:6d}{i + 2:6d}{i + 3:6d}     9\n")
+            f.write("\n")
+            n_written += 5 * n_atoms + 17
+        f.write("[ system ]\nsynthetic\n\n[ molecules ]\n; Compound        #mols\n")
+        for i in range(1, n_mol + 1):
+            f.write(f"MOL{i}    1\n")
+    return n_mol
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time parsing, block lookup and writing of a synthetic "
+                                                 "GROMACS topology with TopFile.")
+    parser.add_argument("-n", "--n_lines", type=int, default=1000000, help="approximate lines of the topology")
+    parser.add_argument("--lookups", type=int, default=10000, help="block lookups by type")
+    parser.add_argument("-d", "--corpus_dir", default=None, help="keep the topology in this directory")
+    args = parser.parse_args()
+
+    corpus_dir = Path(args.corpus_dir or tempfile.mkdtemp(prefix="bench_top_file_"))
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    top_file = corpus_dir / "topol.top"
+    try:
+        start = time.perf_counter()
+        n_mol = write_synthetic_topology(top_file, args.n_lines, random.Random(42))
+        with open(top_file) as f:
+            n_lines = sum(1 for _ in f)
+        print(f"topology: {n_lines} lines, {n_mol} molecule types in {time.perf_counter() - start:.1f} s")
+
+        start = time.perf_counter()
+        top = TopFile(top_file)
+        elapsed = time.perf_counter() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{'parse':>10}: {n_lines / elapsed:.0f} lines/s ({len(top.topol_info)} blocks, {elapsed:.2f} s, "
+              f"peak rss {peak_rss:.0f} MB)")
+
+        start = time.perf_counter()
+        for i in range(args.lookups):
+            top.get_blocks('atoms' if i % 2 else 'molecules')
+        elapsed = time.perf_counter() - start
+        print(f"{'lookup':>10}: {elapsed / args.lookups * 1e6:.2f} us/lookup")
+
+        start = time.perf_counter()
+        with open(corpus_dir / "written.top", 'w') as f:
+            top.write(f)
+        elapsed = time.perf_counter() - start
+        print(f"{'write':>10}: {n_lines / elapsed:.0f} lines/s ({elapsed:.2f} s)")
+
+        start = time.perf_counter()
+        text = str(top)
+        elapsed = time.perf_counter() - start
+        print(f"{'str':>10}: {n_lines / elapsed:.0f} lines/s ({len(text) / 2 ** 20:.0f} MB, {elapsed:.2f} s)")
+    finally:
+        if args.corpus_dir is None:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,24 @@
 # @Author : yuyeqing
 # @File   : top_file.py
 # @IDE    : PyCharm
+import io
+import os
 import re
 from pathlib import Path
 
 
 class TopElement:
+    # regex of the lines this element matches, None matches any line
+    pattern = None
+    __slots__ = ('element_type', 'elem_line')
 
     def __init__(self, element_type: str='element'):
         self.element_type = element_type
         self.elem_line = ''
 
-    @staticmethod
-    def is_type_match(line:str):
-        return True
+    @classmethod
+    def is_type_match(cls, line: str):
+        return cls.pattern is None or re.match(cls.pattern, line) is not None
 
     @classmethod
     def create_from_line(cls, line: str):
@@ -32,32 +37,25 @@ class TopElement:
         return self.elem_line
 
 class TopComment(TopElement):
+    pattern = r'\s*;'
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(element_type='comment')
 
-    @staticmethod
-    def is_type_match(line: str):
-        ls = line.strip()
-        pattern = r'^\s*;'
-        match = re.match(pattern, ls)
-        if match:
-            return True
-        else:
-            return False
-
 class TopInclude(TopElement):
+    pattern = r'\s*#include\s+(?:<[^>]+>|"[^"]+")'
+    __slots__ = ()
 
     def __init__(self):
         super().__init__(element_type='include')
 
-    @staticmethod
-    def is_type_match(line: str):
-        pattern = r'^\s*#include\s+<([^>]+)>'
-        match = re.match(pattern, line)
-        if match:
-            return True
-        else:
-            return False
+    @property
+    def include_file(self):
+        """
+        The file name between the <> or "" of the directive.
+        """
+        return self.elem_line.split(None, 1)[1].strip()[1:-1]
 
 registered_elements = [
     ('comment', TopComment),
@@ -65,8 +63,70 @@ registered_elements = [
     ('element', TopElement),
 ]
 
+BLOCK_PATTERN = r'\[\s*(?P<block_type>.*?)\s*\](?P<after>.*)'
+
+
+class LineClassifier:
+    """
+    Classifies a line with a single match of one precompiled regex: the block header first, then the
+    `pattern` of each class in `registered_elements` in order, each as a named alternative; lines matching
+    none of them belong to the first class without a pattern. Rebuilt when `registered_elements` changes.
+    """
+
+    def __init__(self, elements):
+        self.elements = tuple(elements)
+        self.classes = dict()
+        self.fallback = None
+        alternatives = [f'(?P<block>{BLOCK_PATTERN})']
+        for i, (name, cls) in enumerate(self.elements):
+            if cls.pattern is None:
+                # elements after the catch-all are never reached, as in a loop over registered_elements
+                self.fallback = cls
+                break
+            self.classes[f'e{i}'] = cls
+            alternatives.append(f'(?P<e{i}>{cls.pattern})')
+        # the empty alternative matches every other line, so each line is matched exactly once
+        self.classes['other'] = self.fallback
+        alternatives.append('(?P<other>)')
+        self.regex = re.compile('|'.join(alternatives))
+        self.element_regex = re.compile('|'.join(alternatives[1:]))
+
+    def element_class(self, line: str):
+        return self._class_of(self.element_regex.match(line).lastgroup, line)
+
+    def _class_of(self, group: str, line: str):
+        cls = self.classes[group]
+        if cls is None:
+            raise ValueError(f"Unknown element type for line: {line}")
+        return cls
+
+    def classify(self, line: str):
+        """
+        :return: (block_type, content after the brackets, None) for a block header,
+                 (None, None, element class) for any other line.
+        """
+        m = self.regex.match(line)
+        group = m.lastgroup
+        if group != 'block':
+            return None, None, self._class_of(group, line)
+        if m.group('block_type'):
+            return m.group('block_type'), m.group('after').strip(), None
+        # `[ ]` is no block header
+        return None, None, self.element_class(line)
+
+
+_classifier = None
+
+
+def line_classifier():
+    global _classifier
+    if _classifier is None or _classifier.elements != tuple(registered_elements):
+        _classifier = LineClassifier(registered_elements)
+    return _classifier
+
 
 class TopBlock:
+    __slots__ = ('block_type', 'elements')
 
     def __init__(self, block_type: str=''):
         self.block_type = block_type
@@ -77,26 +137,50 @@ class TopBlock:
 
     @staticmethod
     def is_block_start(line: str):
-        pattern = r'^\[\s*(.*?)\s*\](.*)$'
-        match = re.match(pattern, line)
-        if match:
-            block_type = match.group(1)
-            content_after_brackets = match.group(2).strip()
-            return block_type, content_after_brackets
-        else:
-            return None, None
+        block_type, content_after_brackets, _ = line_classifier().classify(line)
+        return block_type, content_after_brackets
 
     def __str__(self):
         """
         Convert the block to a string representation.
         """
-        if self.block_type:
-            block_str = f"[ {self.block_type} ]\n"
-        else:
-            block_str = ''
-        for ele in self.elements:
-            block_str += str(ele) + '\n'
-        return block_str.strip()
+        lines = [f"[ {self.block_type} ]"] if self.block_type else []
+        lines += [str(ele) for ele in self.elements]
+        return '\n'.join(lines).strip()
+
+
+def gromacs_include_dirs():
+    """
+    Directories GROMACS searches for #include files after the directory of the including file:
+    $GMXLIB, then the share/gromacs/top directory of the installation ($GMXDATA or next to gmx).
+    """
+    dirs = [Path(p) for p in os.environ.get('GMXLIB', '').split(os.pathsep) if p]
+    if os.environ.get('GMXDATA'):
+        dirs.append(Path(os.environ['GMXDATA']) / 'top')
+    for bin_dir in os.environ.get('PATH', '').split(os.pathsep):
+        if bin_dir and (Path(bin_dir) / 'gmx').exists():
+            dirs.append(Path(bin_dir).parent / 'share' / 'gromacs' / 'top')
+            break
+    return dirs
+
+
+# (include file, directory of the including file, search dirs) -> resolved path or None
+_include_paths = dict()
+# resolved path -> (mtime, TopFile)
+_include_files = dict()
+
+
+def resolve_include(include_file: str, base_dir: Path, include_dirs: tuple = ()):
+    """
+    Path of an #include file, looked up once per (file, base directory, search dirs) and cached.
+
+    :return: The resolved Path, None if the file is in none of the directories.
+    """
+    key = (include_file, base_dir, include_dirs)
+    if key not in _include_paths:
+        _include_paths[key] = next((d / include_file for d in (base_dir, *include_dirs)
+                                    if (d / include_file).is_file()), None)
+    return _include_paths[key]
 
 
 class TopFile:
@@ -104,15 +188,50 @@ class TopFile:
     A class to handle topology file for molecular simulations.
     """
 
-    def __init__(self, top_file_path: str):
+    def __init__(self, top_file_path: str, include_dirs: list = None):
         """
         Initialize the TopFile object.
 
         :param top_file_path: Path to the topology file.
+        :param include_dirs: Directories searched for #include files after the directory of the file,
+                             default those of GROMACS.
         """
         self.top_file_path = Path(top_file_path)
+        self.include_dirs = tuple(Path(d) for d in (gromacs_include_dirs() if include_dirs is None else include_dirs))
+        # block type -> blocks of that type, in file order
+        self.index: dict[str, list[TopBlock]] = dict()
         self.topol_info = self.load_topology()
 
+    @staticmethod
+    def iter_blocks(lines):
+        """
+        Parse topology lines one at a time.
+
+        :param lines: Iterable of lines, e.g. an open file.
+        :return: Iterator of TopBlock, each yielded once it is complete; the first one holds the lines
+                 before the first block header.
+        """
+        classifier = line_classifier()
+        match, classes = classifier.regex.match, classifier.classes
+        last_block = TopBlock()
+        elements = last_block.elements
+        for line in lines:
+            # lines other than block headers are classified by the match alone
+            cls = classes.get(match(line).lastgroup)
+            if cls is not None:
+                elements.append(cls.create_from_line(line))
+                continue
+            block_type, content_after_brackets, cls = classifier.classify(line)
+            if block_type:
+                yield last_block
+                last_block = TopBlock(block_type)
+                elements = last_block.elements
+                if content_after_brackets:
+                    elements.append(TopFile.assign_element(content_after_brackets))
+                continue
+            elements.append(cls.create_from_line(line))
+        yield last_block
+
     def load_topology(self):
         """
         Load the topology file and parse it.
@@ -123,24 +242,23 @@ class TopFile:
             raise FileNotFoundError(f"Topology file {self.top_file_path} does not exist.")
 
         with open(self.top_file_path, 'r') as file:
-            topology_data = file.readlines()
+            topol_info = list(self.iter_blocks(file))
+        self.reindex(topol_info)
+        return topol_info
 
-        last_block = TopBlock()
-        topol_info = [last_block, ]
-        for line in topology_data:
-            block_type, content_after_brackets = TopBlock.is_block_start(line)
-            if block_type:
-                last_block = TopBlock(block_type)
-                if content_after_brackets:
-                    last_block.add_element(self.assign_element(content_after_brackets))
-                topol_info.append(last_block)
-                continue
-            ele = self.assign_element(line)
-            if ele:
-                last_block.add_element(ele)
-                continue
+    def reindex(self, topol_info: list = None):
+        """
+        Rebuild the block index, needed after blocks were added or removed from `topol_info`.
+        """
+        self.index = dict()
+        for block in (self.topol_info if topol_info is None else topol_info):
+            self.index.setdefault(block.block_type, []).append(block)
 
-        return topol_info
+    def get_blocks(self, block_type: str):
+        """
+        All blocks of `block_type`, e.g. 'atoms', in file order.
+        """
+        return self.index.get(block_type, [])
 
     @staticmethod
     def assign_element(line: str):
@@ -150,16 +268,45 @@ class TopFile:
         :param line: The line to be assigned.
         :return: The assigned element.
         """
-        for name, cls in registered_elements:
-            if cls.is_type_match(line):
-                return cls.create_from_line(line)
-        raise ValueError(f"Unknown element type for line: {line}")
+        return line_classifier().element_class(line).create_from_line(line)
+
+    def iter_includes(self):
+        """
+        :return: Iterator of (TopInclude, resolved Path or None) of the #include directives of the file.
+        """
+        base_dir = self.top_file_path.absolute().parent
+        for block in self.topol_info:
+            for ele in block.elements:
+                if isinstance(ele, TopInclude):
+                    yield ele, resolve_include(ele.include_file, base_dir, self.include_dirs)
+
+    def load_include(self, include: TopInclude):
+        """
+        Parse the file of an #include directive, each file is parsed once while it is unchanged.
+
+        :return: TopFile of the included file.
+        """
+        path = resolve_include(include.include_file, self.top_file_path.absolute().parent, self.include_dirs)
+        if path is None:
+            raise FileNotFoundError(f"Include file {include.include_file} of {self.top_file_path} not found.")
+        mtime = path.stat().st_mtime_ns
+        cached = _include_files.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = _include_files[path] = mtime, TopFile(path, self.include_dirs)
+        return cached[1]
+
+    def write(self, file):
+        """
+        Write the topology to an open text file, in time linear in its size.
+        """
+        for block in self.topol_info:
+            file.write(str(block))
+            file.write('\n\n')
 
     def __str__(self):
         """
         Convert the topology file to a string representation.
         """
-        top_str = ''
-        for block in self.topol_info:
-            top_str += str(block) + '\n\n'
-        return top_str
+        buffer = io.StringIO()
+        self.write(buffer)
+        return buffer.getvalue()
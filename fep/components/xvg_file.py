@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/7/10 10:20
+# @Author : yuyeqing
+# @File   : xvg_file.py
+# @IDE    : PyCharm
+import io
+import os
+import re
+import json
+import hashlib
+import tempfile
+import numpy as np
+from pathlib import Path
+
+SUBTITLE = re.compile(r'@\s+subtitle\s+"(.*)"')
+LEGEND = re.compile(r'@\s+s(\d+)\s+legend\s+"(.*)"')
+TEMPERATURE = re.compile(r'T = ([-+\d.eE]+)')
+# "state 2: fep-lambda = 0.2000" or "state 2: (coul-lambda, vdw-lambda) = (1.0000, 0.2000)"
+STATE = re.compile(r'state (\d+): (.*?) = (.*)$')
+DHDL_LEGEND = re.compile(r'dH/d\\xl\\f\{\}\s*(\S*?)\s*(?:=|$)')
+DELTA_H_LEGEND = re.compile(r'\\xD\\f\{\}H \\xl\\f\{\} to (.*)$')
+
+# bump when the parsed layout changes, so old cache entries are parsed again
+CACHE_VERSION = 2
+
+
+def lambda_vector(text: str):
+    """
+    Lambda values of "0.2000" or "(1.0000, 0.2000)" as a tuple of floats.
+    """
+    return tuple(float(x) for x in text.strip().strip('()').split(','))
+
+
+def parse_header(lines):
+    """
+    Metadata of a GROMACS dhdl.xvg from its '#' and '@' lines.
+
+    :return: dict with temperature (K), state, lambda_names, lambdas (vector of the sampled state),
+             n_columns, and the data columns of the time, dhdl (name -> column), delta_h (list of
+             (foreign lambda vector, column)), energy and pv, None when absent.
+    """
+    header = {'temperature': None, 'state': None, 'lambda_names': [], 'lambdas': None,
+              'time': 0, 'dhdl': dict(), 'delta_h': [], 'energy': None, 'pv': None}
+    n_series = 0
+    for line in lines:
+        m = SUBTITLE.match(line)
+        if m:
+            subtitle = m.group(1)
+            t, s = TEMPERATURE.search(subtitle), STATE.search(subtitle)
+            if t:
+                header['temperature'] = float(t.group(1))
+            if s:
+                header['state'] = int(s.group(1))
+                header['lambda_names'] = [n.strip() for n in s.group(2).strip('()').split(',')]
+                header['lambdas'] = lambda_vector(s.group(3))
+            continue
+        m = LEGEND.match(line)
+        if not m:
+            continue
+        column, legend = int(m.group(1)) + 1, m.group(2)
+        n_series = max(n_series, column)
+        dhdl, delta_h = DHDL_LEGEND.match(legend), DELTA_H_LEGEND.match(legend)
+        if dhdl:
+            header['dhdl'][dhdl.group(1) or 'fep-lambda'] = column
+        elif delta_h:
+            header['delta_h'].append((lambda_vector(delta_h.group(1)), column))
+        elif legend.startswith('pV'):
+            header['pv'] = column
+        elif 'Energy' in legend:
+            header['energy'] = column
+    header['n_columns'] = n_series + 1
+    return header
+
+
+def _read_header(f):
+    """
+    Header lines of an open binary xvg file, the file is left at the first data line.
+    """
+    header_lines = []
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        if not line.startswith((b'#', b'@')):
+            break
+        header_lines.append(line.decode(errors='replace').rstrip())
+    f.seek(pos)
+    header = parse_header(header_lines)
+    if header['temperature'] is None or header['lambdas'] is None:
+        raise ValueError(f"{f.name}: no temperature or lambda state in the subtitle, not a dhdl.xvg file")
+    return header
+
+
+def read_header(xvg_file):
+    """
+    Header of a GROMACS dhdl.xvg file without reading its data, see `parse_header`.
+    """
+    with open(xvg_file, 'rb') as f:
+        return _read_header(f)
+
+
+def read_dhdl(xvg_file):
+    """
+    Read a GROMACS dhdl.xvg file, the numbers are converted by NumPy in one call over the whole data
+    section instead of line by line. A last line without newline, cut off by an interrupted run, is dropped.
+
+    :return: (header, see `parse_header`, (n_frames, n_columns) float64 array).
+    :raises ValueError: A data line has not the n_columns numbers of the legends.
+    """
+    with open(xvg_file, 'rb') as f:
+        header = _read_header(f)
+        body = f.read()
+    n_columns = header['n_columns']
+    body = body[:body.rfind(b'\n') + 1]
+    if not body.strip():
+        return header, np.zeros((0, n_columns))
+    try:
+        data = np.loadtxt(io.BytesIO(body), dtype=np.float64, comments=('#', '@'), ndmin=2)
+    except ValueError as e:
+        # drop NumPy's hint about usecols, the file is truncated or corrupt
+        raise ValueError(f"{xvg_file}: {str(e).split(';')[0]}")
+    if data.shape[1] != n_columns:
+        raise ValueError(f"{xvg_file}: {data.shape[1]} columns, the legends describe {n_columns}")
+    return header, data
+
+
+def cached_read_dhdl(xvg_file, cache_dir=None):
+    """
+    `read_dhdl` with the result kept as a .npz file in `cache_dir`, one entry per xvg path. The entry is
+    used while the size and mtime of the xvg file are unchanged, so adding windows to an analysed
+    directory only parses the new files. Entries are written to a temporary file and renamed into place.
+    """
+    if cache_dir is None:
+        return read_dhdl(xvg_file)
+    xvg_file = Path(xvg_file).absolute()
+    stat = xvg_file.stat()
+    stamp = [CACHE_VERSION, stat.st_size, stat.st_mtime_ns]
+    entry = Path(cache_dir) / f"{hashlib.sha256(str(xvg_file).encode()).hexdigest()}.npz"
+    if entry.exists():
+        try:
+            with np.load(entry) as cached:
+                header = json.loads(str(cached['header']))
+                if header.pop('stamp') == stamp:
+                    header['delta_h'] = [(tuple(v), c) for v, c in header['delta_h']]
+                    header['lambdas'] = tuple(header['lambdas']) if header['lambdas'] is not None else None
+                    return header, cached['data']
+        except (OSError, ValueError, KeyError):
+            # unreadable entry, e.g. from a killed run, is replaced below
+            pass
+
+    header, data = read_dhdl(xvg_file)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    fd, tmp_entry = tempfile.mkstemp(prefix=f".{entry.stem}.", suffix='.npz', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, header=np.array(json.dumps({**header, 'stamp': stamp})), data=data)
+        os.replace(tmp_entry, entry)
+    finally:
+        if os.path.exists(tmp_entry):
+            os.remove(tmp_entry)
+    return header, data
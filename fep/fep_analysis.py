@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/7/10 14:30
+# @Author : yuyeqing
+# @File   : fep_analysis.py
+# @IDE    : PyCharm
+import warnings
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from multiprocessing import Pool
+from fep.components.xvg_file import cached_read_dhdl, read_header
+
+# Boltzmann constant in kJ/(mol K), the energy unit of GROMACS
+K_B = 0.0083144626
+KJ_PER_KCAL = 4.184
+UNITS = ('kcal/mol', 'kJ/mol', 'kT')
+ESTIMATORS = ('MBAR', 'BAR', 'TI')
+
+
+def iter_replicas(paths, pattern: str = 'dhdl*.xvg'):
+    """
+    dhdl files of each replica, every path being one replica: a directory searched recursively
+    for `pattern`, or a single file.
+
+    :return: Iterator of (replica name, sorted list of files).
+    """
+    names = set()
+    for path in map(Path, paths):
+        files = sorted(path.rglob(pattern)) if path.is_dir() else [path]
+        name = path.name or str(path)
+        # two replicas named the same, e.g. rep1/complex and rep2/complex, keep their full paths
+        if name in names:
+            name = str(path)
+        names.add(name)
+        yield name, files
+
+
+# time origins tried by the equilibration detection when nskip is not given, its cost grows with their number
+EQUILIBRATION_ORIGINS = 2000
+
+
+def subsample(series: np.ndarray, equilibrate: bool = True, decorrelate: bool = True, nskip: int = None):
+    """
+    Indices of the samples kept from `series`: those after the equilibration time detected by
+    pymbar, then every g-th of them, g being the statistical inefficiency of the equilibrated part.
+    The detection tries every `nskip`-th frame as the equilibration time, by default enough frames
+    for EQUILIBRATION_ORIGINS tries.
+
+    :return: (indices, t0, g).
+    """
+    from pymbar import timeseries
+
+    n = len(series)
+    if n < 3 or np.ptp(series) == 0 or not (equilibrate or decorrelate):
+        return np.arange(n), 0, 1.
+    if equilibrate:
+        nskip = nskip or max(1, n // EQUILIBRATION_ORIGINS)
+        t0, g, _ = timeseries.detect_equilibration(series, fast=True, nskip=nskip)
+    else:
+        t0, g = 0, timeseries.statistical_inefficiency(series, fast=True)
+    if not decorrelate:
+        return np.arange(t0, n), int(t0), float(g)
+    indices = np.asarray(timeseries.subsample_correlated_data(series[t0:], g=g), dtype=np.int64) + t0
+    return indices, int(t0), float(g)
+
+
+def load_window(args):
+    """
+    Parse the dhdl files of one lambda window of one replica and subsample its frames.
+
+    :param args: (replica, files, cache_dir, skip_time, equilibrate, decorrelate, nskip); several files of
+                 the same state are the parts of a continued run and are joined in time order.
+    :return: dict of the header of the first part, the kept dhdl (n, n_components) and delta_h
+             (n, n_foreign) arrays, and the subsampling statistics.
+    """
+    replica, files, cache_dir, skip_time, equilibrate, decorrelate, nskip = args
+    parts = sorted((cached_read_dhdl(f, cache_dir) for f in files),
+                   key=lambda part: part[1][0, 0] if len(part[1]) else np.inf)
+    header = parts[0][0]
+    frames, last_time = [], -np.inf
+    for part_header, data in parts:
+        if part_header['n_columns'] != header['n_columns'] or part_header['delta_h'] != header['delta_h']:
+            raise ValueError(f"{replica}: parts of state {header['state']} have different columns")
+        # the first frame of a continued run repeats the last frame of the previous part
+        data = data[data[:, 0] > last_time]
+        if len(data):
+            frames.append(data)
+            last_time = data[-1, 0]
+    data = np.concatenate(frames) if frames else np.zeros((0, header['n_columns']))
+    data = data[data[:, 0] >= skip_time]
+    n_frames = len(data)
+
+    dhdl_columns = list(header['dhdl'].values())
+    dhdl = data[:, dhdl_columns]
+    delta_h = data[:, [column for _, column in header['delta_h']]]
+    # the dH/dl sum is the observable of the subsampling, the energy difference to the nearest other
+    # state when no dH/dl is written
+    if dhdl_columns:
+        series = dhdl.sum(axis=1)
+    else:
+        others = [(np.abs(np.subtract(v, header['lambdas'])).sum(), i) for i, (v, _) in enumerate(header['delta_h'])
+                  if tuple(v) != tuple(header['lambdas'])]
+        series = delta_h[:, min(others)[1]] if others else np.zeros(n_frames)
+    indices, t0, g = subsample(series, equilibrate, decorrelate, nskip)
+    return {
+        'replica': replica,
+        'files': [str(f) for f in files],
+        'header': header,
+        'dhdl': dhdl[indices],
+        'delta_h': delta_h[indices],
+        'n_frames': n_frames,
+        't0': t0,
+        'g': g,
+    }
+
+
+def lambda_key(lambdas):
+    return tuple(round(x, 6) for x in lambdas)
+
+
+def component_lambdas(windows: list, component: str):
+    """
+    Lambda of a dH/dl component at each window; a component missing from the state vector follows fep-lambda.
+    """
+    names = windows[0]['header']['lambda_names']
+    if component in names:
+        i = names.index(component)
+    elif 'fep-lambda' in names:
+        i = names.index('fep-lambda')
+    elif len(names) == 1:
+        i = 0
+    else:
+        raise ValueError(f"no lambda values of the dH/dl component {component}")
+    return np.array([w['header']['lambdas'][i] for w in windows])
+
+
+def estimate_ti(windows: list, beta: float):
+    """
+    Thermodynamic integration with the trapezoidal rule, summed over the dH/dl components; the error
+    is propagated from the standard errors of the window means.
+
+    :return: (dG, error) in kT.
+    """
+    components = list(windows[0]['header']['dhdl'])
+    if not components:
+        raise ValueError("no dH/dl in the dhdl files")
+    dg, var = 0., 0.
+    for c, component in enumerate(components):
+        lambdas = component_lambdas(windows, component)
+        means = np.array([w['dhdl'][:, c].mean() for w in windows]) * beta
+        sems2 = np.array([w['dhdl'][:, c].var(ddof=1) / len(w['dhdl']) if len(w['dhdl']) > 1 else 0.
+                          for w in windows]) * beta ** 2
+        dl = np.diff(lambdas)
+        dg += float(np.sum(dl * (means[1:] + means[:-1]) / 2))
+        # each window mean enters the sum with half the width of its two neighbouring intervals
+        weights = np.zeros(len(windows))
+        weights[1:] += dl / 2
+        weights[:-1] += dl / 2
+        var += float(np.sum(weights ** 2 * sems2))
+    return dg, var ** 0.5
+
+
+def reduced_potentials(windows: list, beta: float):
+    """
+    Reduced potential of every sample in every state, relative to the state it was sampled in.
+
+    :return: (K, N) array u_kn, NaN where the dhdl file has no energy difference to the state.
+    """
+    index = {lambda_key(w['header']['lambdas']): k for k, w in enumerate(windows)}
+    u_kn = np.full((len(windows), sum(len(w['delta_h']) for w in windows)), np.nan)
+    start = 0
+    for own, w in enumerate(windows):
+        stop = start + len(w['delta_h'])
+        u_kn[own, start:stop] = 0.
+        for i, (foreign, _) in enumerate(w['header']['delta_h']):
+            k = index.get(lambda_key(foreign))
+            if k is not None:
+                u_kn[k, start:stop] = beta * w['delta_h'][:, i]
+        start = stop
+    return u_kn
+
+
+def estimate_bar(windows: list, u_kn: np.ndarray):
+    """
+    Sum of BAR estimates between neighbouring windows, errors added in quadrature.
+
+    :return: (dG, error) in kT.
+    """
+    from pymbar.other_estimators import bar
+
+    bounds = np.cumsum([0] + [len(w['delta_h']) for w in windows])
+    dg, var = 0., 0.
+    for k in range(len(windows) - 1):
+        w_f = u_kn[k + 1, bounds[k]:bounds[k + 1]]
+        w_r = u_kn[k, bounds[k + 1]:bounds[k + 2]]
+        if np.isnan(w_f).any() or np.isnan(w_r).any():
+            raise ValueError(f"no energy differences between the states {k} and {k + 1}")
+        ret = bar(w_f, w_r)
+        dg += ret['Delta_f']
+        var += ret['dDelta_f'] ** 2
+    return float(dg), float(var ** 0.5)
+
+
+def estimate_mbar(windows: list, u_kn: np.ndarray):
+    """
+    MBAR estimate between the first and the last window.
+
+    :return: (dG, error, smallest overlap of neighbouring windows) in kT.
+    """
+    from pymbar import MBAR
+
+    if np.isnan(u_kn).any():
+        raise ValueError("MBAR needs the energy differences to all states, set calc-lambda-neighbors = -1")
+    mbar = MBAR(u_kn, np.array([len(w['delta_h']) for w in windows]))
+    ret = mbar.compute_free_energy_differences()
+    overlap = mbar.compute_overlap()['matrix']
+    min_overlap = min(overlap[k, k + 1] for k in range(len(windows) - 1))
+    return float(ret['Delta_f'][0, -1]), float(ret['dDelta_f'][0, -1]), float(min_overlap)
+
+
+def estimate(windows: list, estimators=ESTIMATORS):
+    """
+    Free energy of one replica from its windows ordered by state.
+
+    :return: list of dicts with estimator, dG and dG_err in kT, min_overlap and note, the reason when
+             an estimator cannot be applied to the data.
+    """
+    temperature = windows[0]['header']['temperature']
+    beta = 1. / (K_B * temperature)
+    u_kn = reduced_potentials(windows, beta)
+    rows = []
+    for name in estimators:
+        row = {'estimator': name, 'dG': np.nan, 'dG_err': np.nan, 'min_overlap': np.nan, 'note': ''}
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                if name == 'MBAR':
+                    row['dG'], row['dG_err'], row['min_overlap'] = estimate_mbar(windows, u_kn)
+                elif name == 'BAR':
+                    row['dG'], row['dG_err'] = estimate_bar(windows, u_kn)
+                else:
+                    row['dG'], row['dG_err'] = estimate_ti(windows, beta)
+        except Exception as e:
+            row['note'] = str(e)
+        rows.append(row)
+    return rows
+
+
+def analyze(paths, pattern: str = 'dhdl*.xvg', cache_dir=None, skip_time: float = 0., equilibrate: bool = True,
+            decorrelate: bool = True, nskip: int = None, estimators=ESTIMATORS, units: str = 'kcal/mol', nproc: int = 1):
+    """
+    Free energies of GROMACS lambda windows, every path being one replica.
+
+    :param paths: Directories with the dhdl files of all windows of a replica, or single files.
+    :param pattern: File name pattern of the dhdl files.
+    :param cache_dir: Directory of the parsed dhdl cache, None to parse every file.
+    :param skip_time: Frames before this time (ps) are dropped.
+    :param equilibrate: Drop the frames before the detected equilibration time.
+    :param decorrelate: Keep only uncorrelated frames.
+    :param nskip: Frames between two tries of the equilibration detection, None for `subsample`'s default.
+    :param nproc: Number of processes parsing and subsampling the windows and estimating the replicas.
+    :return: (windows, results), DataFrames with one row per window and one row per replica and estimator.
+    """
+    tasks = []
+    for replica, files in iter_replicas(paths, pattern):
+        if not files:
+            raise ValueError(f"no {pattern} files in {replica}")
+        # the parts of a continued run share the state of the subtitle, only the headers are read here
+        states = dict()
+        for f in files:
+            states.setdefault(read_header(f)['state'], []).append(f)
+        tasks += [(replica, parts, cache_dir, skip_time, equilibrate, decorrelate, nskip) for parts in states.values()]
+
+    # imported once before the workers are forked, so they do not import it each
+    import pymbar  # noqa: F401
+
+    pool = Pool(min(nproc, len(tasks))) if nproc > 1 and len(tasks) > 1 else None
+    try:
+        loaded = pool.map(load_window, tasks, chunksize=1) if pool else list(map(load_window, tasks))
+        by_replica = dict()
+        for w in loaded:
+            by_replica.setdefault(w['replica'], []).append(w)
+        for windows in by_replica.values():
+            windows.sort(key=lambda w: w['header']['state'])
+        estimate_args = [(windows, estimators) for windows in by_replica.values()]
+        estimated = pool.starmap(estimate, estimate_args, chunksize=1) if pool else [estimate(*a) for a in estimate_args]
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    window_rows, result_rows = [], []
+    for (replica, windows), rows in zip(by_replica.items(), estimated):
+        temperature = windows[0]['header']['temperature']
+        for w in windows:
+            window_rows.append({
+                'replica': replica,
+                'state': w['header']['state'],
+                'lambdas': ' '.join(f"{x:g}" for x in w['header']['lambdas']),
+                'n_frames': w['n_frames'],
+                't0': w['t0'],
+                'g': w['g'],
+                'n_samples': len(w['delta_h']),
+                'files': ' '.join(w['files']),
+            })
+        factor = {'kT': 1., 'kJ/mol': K_B * temperature, 'kcal/mol': K_B * temperature / KJ_PER_KCAL}[units]
+        for row in rows:
+            row['dG'] *= factor
+            row['dG_err'] *= factor
+            result_rows.append({'replica': replica, **row, 'units': units, 'temperature': temperature})
+    return pd.DataFrame(window_rows), pd.DataFrame(result_rows)
+
+
+def summarize(results: pd.DataFrame):
+    """
+    Mean of each estimator over the replicas, with the standard deviation of the replicas and the
+    mean of their statistical errors.
+    """
+    ok = results.dropna(subset=['dG'])
+    summary = ok.groupby('estimator', sort=False).agg(
+        dG=('dG', 'mean'), replica_std=('dG', 'std'), dG_err=('dG_err', 'mean'), n_replicas=('dG', 'size'))
+    return summary.reset_index()
+
@@ -4,16 +4,75 @@
 # @Author : yuyeqing
 # @File   : fep_cmds.py
 # @IDE    : PyCharm
+import time
 import click
+from pathlib import Path
+from fep.fep_analysis import ESTIMATORS, UNITS, analyze, summarize
+from utils.cpu_layout import available_cores
 
 
 
-@click.command("fep")
+@click.group("fep")
 def fep_cmds():
     """
-    This function is a placeholder for the FEP (Free Energy Perturbation) commands.
-    It currently does not perform any operations but serves as a template for future implementations.
+    FEP (Free Energy Perturbation) commands.
     """
-    pass
 
 
+@fep_cmds.command("analyze")
+@click.argument("replicas", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("-o", "--out_dir", "out_dir", default=".", show_default=True, type=click.Path(),
+              help="directory of fep_windows.csv and fep_results.csv")
+@click.option("--pattern", "pattern", default="dhdl*.xvg", show_default=True,
+              help="file name pattern of the dhdl files in the replica directories")
+@click.option("-e", "--estimator", "estimators", multiple=True, type=click.Choice(ESTIMATORS),
+              default=ESTIMATORS, show_default=True, help="estimators to run, can be repeated")
+@click.option("-u", "--units", "units", default="kcal/mol", show_default=True, type=click.Choice(UNITS))
+@click.option("-b", "--skip-time", "skip_time", default=0., show_default=True,
+              help="drop the frames before this time (ps)")
+@click.option("--no-equilibration", "no_equilibration", is_flag=True,
+              help="keep the frames before the detected equilibration time")
+@click.option("--no-decorrelation", "no_decorrelation", is_flag=True, help="keep correlated frames")
+@click.option("--nskip", "nskip", default=None, type=int,
+              help="frames between two tries of the equilibration detection, smaller is slower on long windows; "
+                   "default 1 per 2000 frames of the window")
+@click.option("--cache-dir", "cache_dir", default=None, type=click.Path(),
+              help="cache of the parsed dhdl files, default OUT_DIR/dhdl_cache, 'none' to disable; "
+                   "unchanged files are not parsed again")
+@click.option("-n", "--nproc", "nproc", default=lambda: len(available_cores()), type=int,
+              help="processes parsing the windows and estimating the replicas, default the cores this process "
+                   "may use")
+def fep_analyze(replicas: tuple, out_dir: str = ".", pattern: str = "dhdl*.xvg", estimators: tuple = ESTIMATORS,
+                units: str = "kcal/mol", skip_time: float = 0., no_equilibration: bool = False,
+                no_decorrelation: bool = False, nskip: int = None, cache_dir: str = None, nproc: int = 1):
+    """
+    Free energy of the GROMACS dhdl.xvg files of all lambda windows with MBAR, BAR and TI.
+
+    Every REPLICAS argument is one replica, a directory with the dhdl files of all its windows; several
+    files of the same state are joined as parts of a continued run.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if cache_dir is None:
+        cache_dir = out_dir / "dhdl_cache"
+    elif cache_dir == 'none':
+        cache_dir = None
+
+    start = time.time()
+    try:
+        windows, results = analyze(replicas, pattern=pattern, cache_dir=cache_dir, skip_time=skip_time,
+                                   equilibrate=not no_equilibration, decorrelate=not no_decorrelation, nskip=nskip,
+                                   estimators=estimators, units=units, nproc=nproc)
+    except (ValueError, OSError) as e:
+        raise click.ClickException(str(e))
+    windows.to_csv(out_dir / "fep_windows.csv", index=False)
+    results.to_csv(out_dir / "fep_results.csv", index=False)
+
+    click.echo(f"{len(windows)} windows of {results['replica'].nunique()} replicas in {time.time() - start:.1f} s")
+    for row in results.itertuples():
+        if row.note:
+            click.echo(f"{row.replica} {row.estimator}: {row.note}")
+    for row in summarize(results).itertuples():
+        spread = f", replica std {row.replica_std:.2f}" if row.n_replicas > 1 else ""
+        click.echo(f"{row.estimator:>5}: {row.dG:8.2f} +- {row.dG_err:.2f} {units}{spread}")
+    click.echo(f"Results written to {out_dir / 'fep_results.csv'}")
@@ -4,9 +4,11 @@
 # @Author : yuyeqing
 # @File   : gen_config.py
 # @IDE    : PyCharm
+import math
 import yaml
 import click
 import argparse
+import numpy as np
 from pathlib import Path
 
 def parse_grid_box_file(file_path):
@@ -41,6 +43,93 @@ def calculate_size(npts, spacing):
     size_z = (npts[2] - 1) * spacing
     return size_x, size_y, size_z
 
+def read_atoms(pdbqt_file):
+    """
+    读取PDB/PDBQT文件中ATOM/HETATM记录的链、残基名、残基号和坐标。
+
+    返回:
+    (chains, resnames, resseqs, coords), coords 为 (n, 3) 的 numpy 数组。
+    """
+    with open(pdbqt_file, 'r') as file:
+        lines = [line for line in file if line.startswith(('ATOM', 'HETATM'))]
+    if not lines:
+        raise ValueError(f"{pdbqt_file} 中没有原子记录。")
+    chains = np.array([line[21].strip() for line in lines])
+    resnames = np.array([line[17:20].strip() for line in lines])
+    resseqs = np.array([line[22:26].strip() for line in lines])
+    coords = np.array([(line[30:38], line[38:46], line[46:54]) for line in lines], dtype=float)
+    return chains, resnames, resseqs, coords
+
+
+def pocket_coords(receptor_file, residues):
+    """
+    受体中口袋残基的原子坐标。
+
+    参数:
+    residues (list): 残基列表, 如 ['A:TYR123', 'ASP45', '67'], 链和残基名可省略。
+    """
+    chains, resnames, resseqs, coords = read_atoms(receptor_file)
+    mask = np.zeros(len(coords), dtype=bool)
+    for residue in residues:
+        chain, _, residue = residue.strip().rpartition(':')
+        resname, resseq = residue.rstrip('0123456789'), residue[len(residue.rstrip('0123456789')):]
+        if not resseq:
+            raise ValueError(f"残基 {residue} 缺少残基号。")
+        selected = resseqs == resseq
+        if chain:
+            selected &= chains == chain
+        if resname:
+            selected &= resnames == resname.upper()
+        if not selected.any():
+            raise ValueError(f"受体 {receptor_file} 中没有残基 {residue}。")
+        mask |= selected
+    return coords[mask]
+
+
+def fit_box(coords, padding=4.0, spacing=0.375):
+    """
+    包住所有坐标并向外扩展 padding 埃的最小盒子。
+
+    npts 取偶数 (AutoGrid 的要求), 且 (npts - 1) * spacing 不小于盒子边长。
+
+    返回:
+    (center, npts, size), size 由 npts 和 spacing 计算, 与 calculate_size 一致。
+    """
+    lo = coords.min(axis=0) - padding
+    hi = coords.max(axis=0) + padding
+    center = np.round((lo + hi) / 2, 3)
+    npts = (2 * np.ceil(((hi - lo) / spacing + 1) / 2)).astype(int)
+    return center.tolist(), npts.tolist(), list(calculate_size(npts.tolist(), spacing))
+
+
+def rescale_npts(npts, spacing, new_spacing):
+    """
+    间距改为 new_spacing 后包住原盒子的格点数, npts 取偶数, 与 fit_box 一致。
+    """
+    # 舍入浮点误差, 间距不变时格点数也不变
+    steps = np.round(np.array(calculate_size(npts, spacing)) / new_spacing + 1, 6)
+    return (2 * np.ceil(steps / 2)).astype(int).tolist()
+
+
+def box_report(npts, spacing, ref_npts=None, ref_spacing=None, fitted=True):
+    """
+    盒子体积和格点数, 以及相对输入盒子的缩减比例。
+
+    参数:
+    fitted (bool): 盒子由参考配体或口袋残基拟合, 比输入盒子大时提示减小 padding。
+    """
+    volume = math.prod(calculate_size(npts, spacing))
+    report = f"盒子 {' x '.join(f'{x:.3f}' for x in calculate_size(npts, spacing))} Å, 体积 {volume:.1f} Å^3, " \
+             f"格点 {math.prod(npts)}"
+    if ref_npts is not None:
+        ref_volume = math.prod(calculate_size(ref_npts, ref_spacing))
+        report += f"; 输入盒子体积 {ref_volume:.1f} Å^3, 格点 {math.prod(ref_npts)}, " \
+                  f"体积减少 {1 - volume / ref_volume:.1%}, 格点减少 {1 - math.prod(npts) / math.prod(ref_npts):.1%}"
+        if fitted and volume > ref_volume:
+            report += " (拟合盒子比输入盒子大, 可减小 padding 或口袋残基)"
+    return report
+
+
 def generate_conf_file(center, size, spacing, cpu, exhaustiveness, seed, num_modes, npts, output_file='conf.txt'):
     """
     生成Vina的conf.txt文件。
@@ -83,17 +172,47 @@ def generate_conf_yaml(center, size, spacing, cpu, exhaustiveness, seed, num_mod
         yaml.dump(content, file)
 
 @click.command("gen-config")
-@click.option('-f', '--input_file', type=str, required=True, help='输入的grid box文件路径')
+@click.option('-f', '--input_file', type=str, default=None, help='输入的grid box文件路径')
+@click.option('--ligand', type=str, default=None, help='参考配体PDB/PDBQT文件, 按其原子拟合盒子')
+@click.option('--receptor', type=str, default=None, help='受体PDBQT文件, 与 --residues 一起使用')
+@click.option('--residues', type=str, default=None, help='口袋残基, 逗号分隔, 如 A:TYR123,A:ASP45,67')
+@click.option('--padding', type=float, default=4.0, help='拟合盒子向外扩展的距离(埃), 默认 4.0')
+@click.option('--spacing', type=float, default=None,
+              help='格点间距, 默认取输入文件的值或 0.375; 与输入文件不同时按新间距重算格点数')
 @click.option('--cpu', type=int, default=1, help='CPU数量, 默认 1')
 @click.option('--exhaustiveness', type=int, default=8, help='Exhaustiveness值, 默认 8')
 @click.option('--seed', type=int, default=42, help='随机种子值, 默认42')
 @click.option('--num_modes', type=int, default=5, help='生成的模式数量, 默认 5')
 @click.option('--output-path', type=str, default='./', help='输出文件路径, 默认当前目录')
 @click.option('--generate-yaml', is_flag=True, help='是否生成yaml类型文件')
-def gen_config_inference(input_file, cpu, exhaustiveness, seed, num_modes, output_path='./', generate_yaml=False):
+def gen_config_inference(input_file, cpu, exhaustiveness, seed, num_modes, output_path='./', generate_yaml=False,
+                         ligand=None, receptor=None, residues=None, padding=4.0, spacing=None):
+    """
+    由ADT的grid box文件生成对接配置; 指定 --ligand 或 --receptor/--residues 时按参考配体或口袋残基拟合紧凑的盒子。
+    """
     try:
-        center, npts, spacing = parse_grid_box_file(input_file)
-        size = calculate_size(npts, spacing)
+        ref_npts = ref_spacing = None
+        if input_file:
+            center, ref_npts, ref_spacing = parse_grid_box_file(input_file)
+            npts = ref_npts
+        if ligand or residues:
+            if ligand:
+                coords = read_atoms(ligand)[3]
+            else:
+                if not receptor:
+                    raise ValueError("--residues 需要 --receptor。")
+                coords = pocket_coords(receptor, residues.split(','))
+            center, npts, size = fit_box(coords, padding, spacing or ref_spacing or 0.375)
+            spacing = spacing or ref_spacing or 0.375
+        elif input_file:
+            # --spacing 优先, 格点数随之调整, 盒子至少与输入盒子一样大
+            spacing = spacing or ref_spacing
+            if spacing != ref_spacing:
+                npts = rescale_npts(ref_npts, ref_spacing, spacing)
+            size = calculate_size(npts, spacing)
+        else:
+            raise ValueError("需要 --input_file, --ligand 或 --receptor/--residues 之一。")
+        print(box_report(npts, spacing, ref_npts, ref_spacing, fitted=bool(ligand or residues)))
         if generate_yaml:
             outf = Path(output_path) / 'conf.yaml'
             generate_conf_yaml(center, size, spacing, cpu, exhaustiveness,
@@ -102,7 +221,7 @@ def gen_config_inference(input_file, cpu, exhaustiveness, seed, num_modes, outpu
         else:
             outf = Path(output_path) / 'conf.txt'
             generate_conf_file(center, size, spacing, cpu, exhaustiveness,
-                               seed, num_modes, outf)
+                               seed, num_modes, npts, outf)
             print(f"{outf.absolute()}文件已生成")
     except Exception as e:
         print(f"发生错误：{e}")
@@ -2,17 +2,25 @@ import click
 from fep.fep_cmds import fep_cmds
 from run_dock import para_run_dock
 from gen_config import gen_config_inference
+from smiles_to_pdbqt import prep_cache_warm
+from utils.library_prep import prep_library
+from pose_archive import extract_poses
+from utils.adgpu_output_xml_parser import parse_adgpu
 
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
 @click.group(context_settings=CONTEXT_SETTINGS)
 def dock_app():
-    """Docking application, it contains the 'gen-config' and 'dock-run' sub-groups."""
+    """Docking application, it contains the 'gen-config', 'dock-run', 'prep-cache', 'prep-library', 'extract-poses', 'parse-adgpu' and 'fep' sub-groups."""
 
 dock_app.add_command(fep_cmds)
 dock_app.add_command(para_run_dock)
 dock_app.add_command(gen_config_inference)
+dock_app.add_command(prep_cache_warm)
+dock_app.add_command(prep_library)
+dock_app.add_command(extract_poses)
+dock_app.add_command(parse_adgpu)
 
 if __name__ == '__main__':
     dock_app()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/22 15:30
+# @Author : yuyeqing
+# @File   : pose_archive.py
+# @IDE    : PyCharm
+import os
+import mmap
+import zlib
+import click
+import sqlite3
+from pathlib import Path
+
+
+class PoseArchiveWriter:
+    """
+    Append the docked poses of all ligands to a few large shard files.
+
+    Every ligand is one record, optionally zlib-compressed on its own, and `index.sqlite` keeps
+    its shard, byte offset and length, so a single record can be read back without scanning.
+    Only the parent process writes the archive.
+    """
+
+    def __init__(self, archive_dir: str, resume: bool = False, compress: bool = False,
+                 shard_size: int = 1 << 30, batch_size: int = 1000):
+        """
+        :param archive_dir: Directory of the shards and the index.
+        :param resume: Append to the existing archive instead of replacing it.
+        :param compress: Compress every record with zlib.
+        :param shard_size: Start a new shard once the current one reaches this many bytes.
+        :param batch_size: Number of index rows committed at once.
+        """
+        self.archive_dir = Path(archive_dir)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.compress = compress
+        self.shard_size = shard_size
+        self.batch_size = batch_size
+        if not resume:
+            for f in self.archive_dir.glob("poses-*.pdbqt*"):
+                f.unlink()
+        self.conn = sqlite3.connect(self.archive_dir / "index.sqlite")
+        if not resume:
+            self.conn.execute("DROP TABLE IF EXISTS poses")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS poses ("
+            " name TEXT, shard TEXT, offset INTEGER, length INTEGER, compressed INTEGER, opt_energy REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS poses_name ON poses (name)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS poses_energy ON poses (opt_energy)")
+        self.conn.commit()
+        self.shard_id = len(list(self.archive_dir.glob("poses-*.pdbqt*")))
+        self.fp = None
+        self.rows = []
+
+    def _open_shard(self):
+        if self.fp is not None:
+            self.fp.close()
+        suffix = ".pdbqt.z" if self.compress else ".pdbqt"
+        self.shard = f"poses-{self.shard_id:05d}{suffix}"
+        self.shard_id += 1
+        self.fp = open(self.archive_dir / self.shard, 'ab')
+
+    def write(self, name: str, pdbqt: str, opt_energy: float = None):
+        if self.fp is None or self.fp.tell() >= self.shard_size:
+            self._open_shard()
+        data = pdbqt.encode()
+        if self.compress:
+            data = zlib.compress(data)
+        offset = self.fp.tell()
+        self.fp.write(data)
+        self.rows.append((str(name), self.shard, offset, len(data), int(self.compress), opt_energy))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.fp is not None:
+            # data first, so every indexed record is complete on disk
+            self.fp.flush()
+        if self.rows:
+            self.conn.executemany("INSERT INTO poses VALUES (?, ?, ?, ?, ?, ?)", self.rows)
+            self.conn.commit()
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.fp is not None:
+            self.fp.close()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PoseArchive:
+    """
+    Random access to a pose archive written by `PoseArchiveWriter`, shards are memory-mapped.
+    """
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = Path(archive_dir)
+        if not (self.archive_dir / "index.sqlite").exists():
+            raise FileNotFoundError(f"No pose archive index in {self.archive_dir}.")
+        self.conn = sqlite3.connect(self.archive_dir / "index.sqlite")
+        self.maps = dict()
+
+    def _read(self, shard: str, offset: int, length: int, compressed: int):
+        if length == 0:
+            return ''
+        mm = self.maps.get(shard)
+        if mm is None or offset + length > len(mm):
+            # the shard may have grown since it was mapped
+            with open(self.archive_dir / shard, 'rb') as f:
+                # an empty file can not be mapped, e.g. the shard of a node that crashed before writing it
+                if offset + length > os.fstat(f.fileno()).st_size:
+                    raise KeyError(f"Record at {offset} of {shard} is beyond the end of the shard.")
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[shard] = mm
+        data = mm[offset:offset + length]
+        return (zlib.decompress(data) if compressed else data).decode()
+
+    def get(self, name: str):
+        """
+        :return: The poses of ligand `name` as pdbqt string, the last record wins if it was docked more than once.
+        """
+        row = self.conn.execute("SELECT shard, offset, length, compressed FROM poses WHERE name = ? "
+                                "ORDER BY rowid DESC LIMIT 1", (str(name),)).fetchone()
+        if row is None:
+            raise KeyError(f"Ligand {name} not in pose archive.")
+        return self._read(*row)
+
+    def top(self, k: int):
+        """
+        :return: List of (rank, name, opt_energy) of the k ligands with the lowest opt_energy.
+        """
+        rows = self.conn.execute("SELECT name, MIN(opt_energy) AS e FROM poses WHERE opt_energy IS NOT NULL "
+                                 "GROUP BY name ORDER BY e LIMIT ?", (k,)).fetchall()
+        return [(rank, name, e) for rank, (name, e) in enumerate(rows, 1)]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(DISTINCT name) FROM poses").fetchone()[0]
+
+    def close(self):
+        for mm in self.maps.values():
+            mm.close()
+        self.conn.close()
+
+
+def merge_pose_archives(src_dirs: list, archive_dir: str):
+    """
+    Index the pose archives of several directories, e.g. the nodes of a multi-node run, in the archive
+    `archive_dir` without copying their shards: the merged index refers to the shards by their path
+    relative to `archive_dir`. Existing records of `archive_dir` are replaced. A ligand archived twice,
+    e.g. in a chunk taken over from a crashed node, keeps the record of the last source.
+    """
+    archive_dir = Path(archive_dir)
+    writer = PoseArchiveWriter(archive_dir)
+    for src_dir in src_dirs:
+        src_file = Path(src_dir) / "index.sqlite"
+        if not src_file.exists():
+            continue
+        prefix = Path(os.path.relpath(src_dir, archive_dir)).as_posix()
+        writer.conn.execute("ATTACH DATABASE ? AS src", (str(src_file),))
+        writer.conn.execute("INSERT INTO poses SELECT name, ? || '/' || shard, offset, length, compressed, opt_energy "
+                            "FROM src.poses", (prefix,))
+        writer.conn.commit()
+        writer.conn.execute("DETACH DATABASE src")
+    writer.conn.execute("DELETE FROM poses WHERE rowid NOT IN (SELECT MAX(rowid) FROM poses GROUP BY name)")
+    writer.conn.commit()
+    writer.close()
+
+
+@click.command("extract-poses")
+@click.argument("archive_dir", type=click.Path(exists=True))
+@click.option("-n", "--name", "names", multiple=True, help="ligand name to extract, can be repeated")
+@click.option("-k", "--top", "top", default=0, help="extract the top k ligands by opt_energy")
+@click.option("-o", "--out_dir", "out_dir", default="./poses", help="directory for the extracted pdbqt files",
+              show_default=True)
+def extract_poses(archive_dir: str, names: tuple = (), top: int = 0, out_dir: str = "./poses"):
+    """Extract poses from the pose archive ARCHIVE_DIR (the `poses` directory of a dock-run) by name or rank."""
+    archive = PoseArchive(archive_dir)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    targets = [(None, name) for name in names]
+    targets += [(rank, name) for rank, name, _ in archive.top(top)] if top > 0 else []
+    n_extracted = 0
+    for rank, name in targets:
+        try:
+            pdbqt = archive.get(name)
+        except KeyError as e:
+            print(e)
+            continue
+        file_name = f"{rank}_{name}_out.pdbqt" if rank else f"{name}_out.pdbqt"
+        with open(out_dir / file_name, 'w') as f:
+            f.write(pdbqt)
+        n_extracted += 1
+    archive.close()
+    click.echo(f"{n_extracted} ligands extracted to {out_dir.absolute()}")
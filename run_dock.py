@@ -4,20 +4,44 @@
 # @Author : yuyeqing
 # @File   : run_dock.py
 # @IDE    : PyCharm
-import os
 import yaml
 import json
+import time
 import click
 import shutil
+import tempfile
 import subprocess
+import itertools
+import functools
+import asyncio
+import threading
+import multiprocessing
 from tqdm import tqdm
-import pandas as pd
-from vina import Vina
 from pathlib import Path
-from dataclasses import dataclass
+from contextlib import nullcontext
+from dataclasses import dataclass, replace
 from multiprocessing import Pool
-from smiles_to_pdbqt import one_smiles_to_pdbqt_string_v2
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from smiles_to_pdbqt import smiles_to_pdbqt_string, prep_backends
 from utils.adgpu_output_xml_parser import extract_free_nrg_binding
+from utils.vina_maps import load_vina, cached_map_prefix
+from utils.run_journal import RunJournal
+from utils.ligand_reader import iter_ligands, LigandCursor
+from utils.result_sink import open_result_sink, result_sinks, select_best, merge_results, ensemble_matrix
+from utils.receptors import is_receptor_manifest, load_receptors
+from utils.library_prep import preprocess_library, format_report, fan_out_results
+from pose_archive import PoseArchiveWriter, merge_pose_archives
+from utils.top_hits import TopHits
+from utils.gpu_grid import GridSet, cached_grid, executable, ligand_atom_types
+from utils.ligand_cost import CostModel, CostScheduler
+from utils.work_queue import WorkQueue, LeasedTasks, claim_node_id
+from utils.timing import timed, take_pending, init_profiled_worker, profiled
+from utils.metrics import RunMetrics
+from utils.cpu_layout import available_cores, docking_cores, candidate_layouts, default_layout, core_sets, \
+    pin_worker
+
+# per-process state, filled once by `init_vina_worker` and reused for every ligand
+_worker_state = dict()
 
 
 @dataclass
@@ -31,109 +55,393 @@ class TaskParam:
     task_id: int = None
     output_result: bool = True
     output_pdbqt: bool = True
+    return_poses: bool = False
     cur_dir: str = str(Path("./").absolute())
+    map_cache_dir: str = None
+    smiles: str = None
+    prep_backend: str = 'prepare_ligand4'
+    ligand_cache: str = None
+    prep_error: str = None
+    config_overrides: dict = None
+    scratch_dir: str = None
+    receptors: list = None
+    timings: dict = None
+
+
+def prepare_one_task(param: TaskParam):
+    """
+    Ligand preparation stage: convert `param.smiles` to a pdbqt string.
+    Failures are recorded in `param.prep_error` and reported by the docking stage.
+    """
+    if param.smiles is None or param.ligand_pdbqt_file or param.ligand_pdbqt_string:
+        return param
+    print(f"Processing {param.ligand_name}")
+    param.timings = dict()
+    try:
+        with timed('prep', param.timings):
+            # keep the largest fragment, e.g. drop counter ions of salts
+            smiles = max(param.smiles.split("."), key=len)
+            param.ligand_pdbqt_string = smiles_to_pdbqt_string(smiles, backend=param.prep_backend,
+                                                                cache_file=param.ligand_cache)
+    except Exception as e:
+        param.prep_error = str(e)
+        print(f"{param.ligand_name} Error: {e}")
+    return param
+
+
+def iter_batches(iterable, batch_size: int):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+
+def iter_pipeline(task_params, dock_func, nproc: int, prep_nproc: int = 1, chunksize: int = 1,
+                  queue_size: int = 0, initializer=None, initargs=(), batch_size: int = 1,
+                  scheduler: CostScheduler = None, profile_dir: str = None):
+    """
+    Run ligand preparation and docking as two overlapping process pools.
+
+    Preparation workers run ahead of the docking workers by at most `queue_size` ligands,
+    so neither stage waits for the other to finish the whole library.
+
+    :param task_params: Iterable of TaskParam with `smiles` to prepare.
+    :param dock_func: `process_one_task`, `process_one_task_gpu` or `process_batch_gpu`.
+    :param nproc: Number of docking processes.
+    :param prep_nproc: Number of preparation processes.
+    :param chunksize: Chunksize of the docking pool.
+    :param queue_size: Max number of ligands in flight, 0 for 2 * nproc * chunksize.
+    :param initializer: Initializer of the docking pool.
+    :param initargs: Arguments of the initializer.
+    :param batch_size: Ligands per `dock_func` call, with more than one it takes and returns lists.
+    :param scheduler: Orders the prepared ligands longest-first and cuts them into cost-sized chunks,
+                      replacing `chunksize`; with `batch_size` > 1 its chunks are the batches.
+    :param profile_dir: Profile every worker of both pools with cProfile into this directory.
+    :return: Iterator over the docking results, in completion order.
+    """
+    # the docking pool waits for full chunks, so fewer slots than chunksize would deadlock
+    per_chunk = chunksize * batch_size
+    n_slots = max(queue_size or 2 * nproc * per_chunk, per_chunk)
+    if scheduler is not None:
+        # the ligands waiting in the scheduler window come on top
+        n_slots += scheduler.window
+    slots = threading.Semaphore(n_slots)
+
+    def bounded(iterable):
+        for item in iterable:
+            slots.acquire()
+            yield item
+
+    prep_initializer, prep_initargs = None, ()
+    if profile_dir is not None:
+        prep_initializer, prep_initargs = init_profiled_worker, (profile_dir, "prep")
+        initializer, initargs = init_profiled_worker, (profile_dir, "dock", initializer, *initargs)
+
+    with Pool(max(prep_nproc, 1), initializer=prep_initializer, initargs=prep_initargs) as prep_pool, \
+            Pool(max(nproc, 1), initializer=initializer, initargs=initargs) as dock_pool:
+        prepared = prep_pool.imap_unordered(prepare_one_task, bounded(task_params))
+        if scheduler is not None:
+            prepared = scheduler.iter_chunks(prepared)
+            if batch_size <= 1:
+                dock_func = functools.partial(process_chunk, dock_func)
+            chunksize = 1
+        elif batch_size > 1:
+            prepared = iter_batches(prepared, batch_size)
+        is_list = scheduler is not None or batch_size > 1
+        for rets in dock_pool.imap_unordered(dock_func, prepared, chunksize=chunksize):
+            if scheduler is not None:
+                scheduler.chunk_done()
+            for ret in (rets if is_list else [rets]):
+                slots.release()
+                yield ret
+        # let the workers exit on their own instead of being terminated, so they run their exit handlers
+        for pool in (prep_pool, dock_pool):
+            pool.close()
+            pool.join()
+
+
+def init_vina_worker(conf_yaml_file: str, receptor_pdbqt: str, map_cache_dir: str = None,
+                     cpu: int = None, core_queue=None):
+    """
+    Pool initializer: load the config and receptor and compute (or load cached) maps once per worker.
+    With a `core_queue` of core sets the worker pins itself to one of them, `cpu` overrides config['cpu'].
+    """
+    pin_worker(core_queue)
+    _worker_state['cpu'] = cpu
+    load_vina_worker(conf_yaml_file, receptor_pdbqt, map_cache_dir)
+
+
+def load_vina_worker(conf_yaml_file: str, receptor_pdbqt: str, map_cache_dir: str = None):
+    """
+    Load a receptor into the worker, it is kept for all later ligands, also while other receptors
+    of an ensemble are docked.
+    """
+    with open(conf_yaml_file, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    if _worker_state.get('cpu'):
+        config['cpu'] = _worker_state['cpu']
+    vinas = _worker_state.setdefault('vinas', dict())
+    vinas[(conf_yaml_file, receptor_pdbqt, map_cache_dir)] = config, load_vina(config, receptor_pdbqt, map_cache_dir)
+
+
+def get_vina_worker(param: TaskParam):
+    key = (param.conf_yaml_file, param.receptor_pdbqt, param.map_cache_dir)
+    if key not in _worker_state.get('vinas', dict()):
+        load_vina_worker(*key)
+    config, v = _worker_state['vinas'][key]
+    if param.config_overrides:
+        # e.g. exhaustiveness / n_poses of a funnel stage, the maps do not depend on them
+        config = {**config, **param.config_overrides}
+    return config, v
+
+
+def get_gpu_grids(param: TaskParam, config: dict):
+    key = (param.conf_yaml_file, param.receptor_pdbqt, param.map_cache_dir)
+    grids = _worker_state.setdefault('gpu_grids', dict())
+    if key not in grids:
+        grids[key] = GridSet(param.receptor_pdbqt, config, param.map_cache_dir)
+    return grids[key]
+
+
+def read_ligand_pdbqt(param: TaskParam):
+    if param.prep_error:
+        raise RuntimeError(f"Ligand preparation failed: {param.prep_error}")
+    if param.ligand_pdbqt_file:
+        with open(param.ligand_pdbqt_file, 'r') as f:
+            return f.read()
+    elif param.ligand_pdbqt_string:
+        return param.ligand_pdbqt_string
+    raise ValueError("No ligand provided.")
+
+
+def collect_gpu_result(param: TaskParam, work_dir: Path, start: float, timings: dict = None):
+    """
+    Parse the adgpu outputs of one ligand in `work_dir` into its result dict.
+
+    :param timings: Stage timings of the ligand so far, e.g. prep and adgpu.
+    """
+    ligand_name = param.ligand_name
+    timings = dict(timings or param.timings or {})
+    xml_file = work_dir / f"{ligand_name}.xml"
+    if not xml_file.exists():
+        raise RuntimeError(f"adgpu wrote no result for {ligand_name}")
+    with timed('parse', timings):
+        energies = extract_free_nrg_binding(xml_file)
+    # runs are listed by run id, the best one is the lowest free energy of binding
+    opt_energy = min(e[0] for e in energies)
+    ret = {
+        "task_id": param.task_id,
+        "ligand_name": ligand_name,
+        "opt_energy": opt_energy,
+        "energies": energies,
+        "timings": timings,
+        "log": f" Optimal energy: {opt_energy}"
+    }
+    best_struct_file = work_dir / f"{ligand_name}-best.pdbqt"
+    with timed('poses', timings):
+        if param.return_poses:
+            with open(best_struct_file, 'r') as f:
+                ret["poses"] = f.read()
+        if param.output_pdbqt:
+            shutil.move(best_struct_file, Path(param.output_dir) / best_struct_file.name)
+    timings["total"] = time.time() - start
+    take_pending(timings)
+    return ret
+
+
+def adgpu_command(config: dict, *inputs):
+    """
+    adgpu command line for the ligand `inputs`, e.g. ('--ffile', fld, '--lfile', pdbqt) or ('--filelist', file).
+    """
+    return [
+        executable(config, 'adgpu'),
+        *inputs,
+        '--devnum', f'{config.get("gpu_device", 0) + 1}',
+        '--nrun', str(config.get("nrun", 20)),
+        '--gbest', '--rlige',
+        '--seed', str(config.get("seed", 42)),
+    ]
+
+
+def make_scratch_dir(param: TaskParam, prefix: str):
+    """
+    Private working directory of one adgpu run under `param.scratch_dir` (e.g. /dev/shm or node-local
+    disk), falling back to the output directory. Only the final outputs are moved to the output directory.
+    """
+    scratch_root = Path(param.scratch_dir or param.output_dir)
+    scratch_root.mkdir(parents=True, exist_ok=True)
+    return Path(tempfile.mkdtemp(prefix=prefix, dir=scratch_root))
+
+
+def write_result_json(param: TaskParam, ret: dict):
+    with open(Path(param.output_dir) / f"{param.ligand_name}_log.json", 'w') as fp:
+        ret_str = json.dumps({k: v for k, v in ret.items() if k != "poses"}, indent=4)
+        fp.write(ret_str)
 
 
 def process_one_task_gpu(param: TaskParam):
+    start = time.time()
     out_log = ""
     ret = dict()
     with open(param.conf_yaml_file, 'r') as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
+    config.update(param.config_overrides or {})
     ligand_name = param.ligand_name
-    temp_dir = Path(param.output_dir) / f"{ligand_name}_temp"
-    temp_dir.mkdir(parents=True, exist_ok=True)
+    temp_dir = make_scratch_dir(param, f"{ligand_name}_")
     try:
-        # copy receptor to temp dir
-        shutil.copy(param.receptor_pdbqt, temp_dir / "receptor.pdbqt")
         # prepare ligand
-        if param.ligand_pdbqt_file:
-            shutil.copy(param.ligand_pdbqt_file, temp_dir / f"{ligand_name}.pdbqt")
-        elif param.ligand_pdbqt_string:
-            with open(temp_dir / f"{ligand_name}.pdbqt", 'w') as f:
-                f.write(param.ligand_pdbqt_string)
-        else:
-            raise ValueError("No ligand provided.")
+        ligand_pdbqt_string = read_ligand_pdbqt(param)
+        with open(temp_dir / f"{ligand_name}.pdbqt", 'w') as f:
+            f.write(ligand_pdbqt_string)
 
-        os.chdir(temp_dir)
-        # prepare gpf
-        gpf_file = f"{ligand_name}.gpf"
-        gpf_result = subprocess.run([
-                        'prepare_gpf4',
-                        '-r', 'receptor.pdbqt',
-                        '-l', f"{ligand_name}.pdbqt",
-                        '-o', gpf_file,
-                        '-p', f"npts={','.join(map(str, config['npts']))}",
-                        '-p', f"gridcenter={','.join(map(str, config['center']))}",
-                        '-p', f"spacing={config['spacing']}"],
-                        check=True
-                    )
-        if gpf_result.returncode != 0:
-            raise RuntimeError(gpf_result.stderr)
-
-        # autogrid
-        ag_result = subprocess.run([
-                        'autogrid4',
-                        '-p', gpf_file,
-                        '-l', f"{ligand_name}.log"],
-                        check=True
-                    )
-        if ag_result.returncode != 0:
-            raise RuntimeError(ag_result.stderr)
+        # the grid maps are built once per receptor / box / ligand types and shared by all ligands
+        fld_file = get_gpu_grids(param, config).fld_for(ligand_pdbqt_string)
 
         # run autodock gpu
-        best_struct_file = Path(param.output_dir) / f"{ligand_name}-best.pdbqt"
-        if best_struct_file.exists():
-            best_struct_file.unlink()
-        adgpu_result = subprocess.run([
-                        'adgpu',
-                        '--ffile', "receptor.maps.fld",
-                        '--lfile', f"{ligand_name}.pdbqt",
-                        '--devnum', f'{config.get("gpu_device", 0) + 1}',
-                        '--nrun', "20",
-                        '--gbest', '--rlige'
-                        '--seed', str(config.get("seed", 42)),],
-                        check=True
-                    )
+        timings = dict(param.timings or {})
+        with timed('adgpu', timings):
+            adgpu_result = subprocess.run(
+                adgpu_command(config, '--ffile', str(fld_file), '--lfile', f"{ligand_name}.pdbqt"),
+                cwd=temp_dir, capture_output=True, text=True
+            )
         if adgpu_result.returncode != 0:
-            raise RuntimeError(adgpu_result.stderr)
+            raise RuntimeError(adgpu_result.stderr.strip())
 
         # parse output xml
-        xml_file = f"{ligand_name}.xml"
-        energies = extract_free_nrg_binding(xml_file)
-        opt_energy = energies[0][0]
-        out_log += f" Optimal energy: {opt_energy}"
-        shutil.move(f"{ligand_name}-best.pdbqt", param.output_dir)
+        ret = collect_gpu_result(param, temp_dir, start, timings)
+        out_log = ret["log"]
+    except Exception as e:
+        out_log = str(e)
         ret = {
             "task_id": param.task_id,
             "ligand_name": param.ligand_name,
-            "opt_energy": opt_energy,
-            "energies": energies,
             "log": out_log
         }
-    except Exception as e:
-        out_log = str(e)
-        ret['log'] = out_log
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
-    os.chdir(param.cur_dir)
-    shutil.rmtree(temp_dir)
     print(f"task {param.task_id}: ", out_log)
     if param.output_result:
-        with open(Path(param.output_dir) / f"{param.ligand_name}_log.json", 'w') as fp:
-            ret_str = json.dumps(ret, indent=4)
-            fp.write(ret_str)
+        write_result_json(param, ret)
+    return ret
+
+
+def process_batch_gpu(params: list):
+    """
+    Dock a batch of ligands with a single adgpu run over a file list, so device initialisation and
+    map upload are paid once per batch. A ligand without output fails on its own, the rest of the
+    batch is kept.
+
+    :param params: TaskParams of the batch, all with the same receptor and config.
+    :return: List of result dicts, one per ligand.
+    """
+    start = time.time()
+    first = params[0]
+    with open(first.conf_yaml_file, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    config.update(first.config_overrides or {})
+    temp_dir = make_scratch_dir(first, f"batch_{first.task_id}_")
+    rets, batch, errors, adgpu_seconds = dict(), [], "", 0.
+    for param in params:
+        try:
+            ligand_pdbqt_string = read_ligand_pdbqt(param)
+            with open(temp_dir / f"{param.ligand_name}.pdbqt", 'w') as f:
+                f.write(ligand_pdbqt_string)
+            batch.append((param, ligand_atom_types(ligand_pdbqt_string)))
+        except Exception as e:
+            rets[param.task_id] = {"task_id": param.task_id, "ligand_name": param.ligand_name, "log": str(e)}
+
+    if batch:
+        try:
+            # one fld for the whole batch, covering the atom types of all its ligands
+            fld_file = get_gpu_grids(first, config).fld_for_types(set().union(*(t for _, t in batch)))
+            with open(temp_dir / "filelist.txt", 'w') as f:
+                f.write(f"{fld_file}\n")
+                for param, _ in batch:
+                    f.write(f"{param.ligand_name}.pdbqt\n{param.ligand_name}\n")
+            adgpu_start = time.perf_counter()
+            adgpu_result = subprocess.run(adgpu_command(config, '--filelist', "filelist.txt"),
+                                          cwd=temp_dir, capture_output=True, text=True)
+            adgpu_seconds = time.perf_counter() - adgpu_start
+            if adgpu_result.returncode != 0:
+                errors = adgpu_result.stderr.strip()
+        except Exception as e:
+            errors = str(e)
+
+    for param, _ in batch:
+        try:
+            # the ligands of the batch share the adgpu run equally
+            timings = {**(param.timings or {}), "adgpu": adgpu_seconds / len(batch)}
+            rets[param.task_id] = collect_gpu_result(param, temp_dir, start, timings)
+        except Exception as e:
+            log = f"{e}: {errors}" if errors else str(e)
+            rets[param.task_id] = {"task_id": param.task_id, "ligand_name": param.ligand_name, "log": log}
+
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    rets = [rets[param.task_id] for param in params]
+    for param, ret in zip(params, rets):
+        print(f"task {param.task_id}: ", ret["log"])
+        if param.output_result:
+            write_result_json(param, ret)
+    return rets
+
+
+def process_chunk(dock_func, params: list):
+    return [dock_func(param) for param in params]
+
+
+def process_ensemble(dock_func, param: TaskParam):
+    """
+    Dock one prepared ligand against every receptor of `param.receptors`, (name, conf_yaml_file, receptor_pdbqt).
+    Outputs of a receptor go to `output_dir/<name>`.
+
+    :return: Result dict of the ligand with the ensemble `opt_energy` (best over the receptors), `mean_energy`,
+             `best_receptor` and the results per receptor in `receptor_results`.
+    """
+    start = time.time()
+    rets = []
+    for name, conf_yaml_file, receptor_pdbqt in param.receptors:
+        receptor_dir = Path(param.output_dir) / name
+        receptor_dir.mkdir(exist_ok=True)
+        ret = dock_func(replace(param, conf_yaml_file=conf_yaml_file, receptor_pdbqt=receptor_pdbqt,
+                                output_dir=str(receptor_dir), receptors=None, timings=dict(param.timings or {})))
+        ret["receptor"] = name
+        rets.append(ret)
+    # the ligand is prepared once, the other stages add up over the receptors
+    timings = dict(param.timings or {})
+    for r in rets:
+        for stage, seconds in r.get("timings", dict()).items():
+            if stage not in (param.timings or {}):
+                timings[stage] = timings.get(stage, 0.) + seconds
+    timings["total"] = time.time() - start
+    ret = {
+        "task_id": param.task_id,
+        "ligand_name": param.ligand_name,
+        "receptor_results": rets,
+        "timings": timings,
+    }
+    docked = [r for r in rets if "opt_energy" in r]
+    if docked:
+        best = min(docked, key=lambda r: r["opt_energy"])
+        ret["opt_energy"] = best["opt_energy"]
+        ret["mean_energy"] = sum(r["opt_energy"] for r in docked) / len(docked)
+        ret["best_receptor"] = best["receptor"]
+        ret["log"] = f" Ensemble optimal energy: {ret['opt_energy']} ({best['receptor']}), " \
+                     f"mean: {ret['mean_energy']:.3f} over {len(docked)}/{len(rets)} receptors"
+    else:
+        ret["log"] = "; ".join(f"{r['receptor']}: {r['log']}" for r in rets)
     return ret
 
 
 def process_one_task(param: TaskParam):
+    start = time.time()
     out_log = ""
     ret = dict()
-    with open(param.conf_yaml_file, 'r') as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
 
     try:
-        v = Vina(sf_name='vina', cpu=config.get("cpu", 1), seed=config.get("seed", 42), verbosity=1)
+        if param.prep_error:
+            raise RuntimeError(f"Ligand preparation failed: {param.prep_error}")
+        config, v = get_vina_worker(param)
 
-        v.set_receptor(param.receptor_pdbqt)
         if param.ligand_pdbqt_file:
             v.set_ligand_from_file(param.ligand_pdbqt_file)
             out_log += f" Load ligand {param.ligand_name} from {param.ligand_pdbqt_file}"
@@ -143,40 +451,531 @@ def process_one_task(param: TaskParam):
         else:
             raise ValueError("No ligand provided.")
 
-        v.compute_vina_maps(center=config['center'],
-                            box_size=config['box_size'],
-                            spacing=config['spacing'])
+        timings = dict(param.timings or {})
+        with timed('dock', timings):
+            v.dock(exhaustiveness=config.get('exhaustiveness', 8), n_poses=config.get('n_poses', 5))
 
-        v.dock(exhaustiveness=config.get('exhaustiveness', 8), n_poses=config.get('n_poses', 5))
+            opt_energy = v.score()[0]
+            energies = v.energies(n_poses=config.get('n_poses', 5)).tolist()
 
-        opt_energy = v.score()[0]
-        energies = v.energies(n_poses=config.get('n_poses', 5)).tolist()
-
-        if param.output_pdbqt:
-            output_pdbqt_file = Path(param.output_dir) / f"{param.ligand_name}_out.pdbqt"
-            v.write_poses(pdbqt_filename=str(output_pdbqt_file.absolute()),
-                          n_poses=config.get('n_poses', 5), overwrite=True)
+        poses = None
+        with timed('poses', timings):
+            if param.output_pdbqt:
+                output_pdbqt_file = Path(param.output_dir) / f"{param.ligand_name}_out.pdbqt"
+                v.write_poses(pdbqt_filename=str(output_pdbqt_file.absolute()),
+                              n_poses=config.get('n_poses', 5), overwrite=True)
+            if param.return_poses:
+                poses = v.poses(n_poses=config.get('n_poses', 5))
         out_log += f" Optimal energy: {opt_energy}"
+        timings["total"] = time.time() - start
 
         ret = {
             "task_id": param.task_id,
             "ligand_name": param.ligand_name,
             "opt_energy": opt_energy,
             "energies": energies,
+            "timings": take_pending(timings),
             "log": out_log
         }
         if param.output_result:
             with open(Path(param.output_dir) / f"{param.ligand_name}_log.json", 'w') as fp:
                 ret_str = json.dumps(ret, indent=4)
                 fp.write(ret_str)
+        if poses is not None:
+            ret["poses"] = poses
 
     except Exception as e:
         out_log = str(e)
+        ret = {
+            "task_id": param.task_id,
+            "ligand_name": param.ligand_name,
+            "log": out_log
+        }
 
     print(f"task {param.task_id}: ", out_log)
     return ret
 
 
+@dataclass
+class RunParam:
+    conf_yaml_file: str
+    smiles_csv: str
+    receptor_pdbqt: str
+    out_dir: Path
+    nproc: int = 3
+    chunksize: int = 1
+    use_gpu: bool = False
+    map_cache_dir: str = None
+    prep_nproc: int = 1
+    queue_size: int = 0
+    prep_backend: str = "prepare_ligand4"
+    ligand_cache: str = None
+    resume: bool = False
+    retry_failed: bool = False
+    results_format: str = "sqlite"
+    pose_output: str = "files"
+    pose_compress: bool = False
+    top_k: int = 1000
+    summary_interval: float = 60.
+    cpu: int = None
+    core_sets: list = None
+    gpu_batch_size: int = 1
+    scratch_dir: str = None
+    gpu_async: bool = False
+    gpu_slots: int = 1
+    schedule: str = "fifo"
+    order_window: int = 1000
+    receptors: list = None
+    metrics_file: str = "metrics.csv"
+    profile: bool = False
+    # out_dir is shared by the nodes of a work queue
+    shared_out_dir: bool = False
+
+
+def iter_task_params(run: RunParam, out_dir: Path, task_ids: set = None, config_overrides: dict = None,
+                     ligands=None):
+    """
+    Lazily build the TaskParams of the library, optionally only those in `task_ids`.
+
+    :param ligands: Iterable of (index, name, smiles) rows of the library, default all of them.
+    """
+    if ligands is None:
+        ligands = iter_ligands(run.smiles_csv)
+    for i, name, smiles in ligands:
+        if task_ids is not None and i not in task_ids:
+            continue
+        yield TaskParam(
+            conf_yaml_file=run.conf_yaml_file,
+            receptor_pdbqt=run.receptor_pdbqt,
+            ligand_name=name,
+            smiles=smiles,
+            prep_backend=run.prep_backend,
+            ligand_cache=run.ligand_cache,
+            output_dir=str(out_dir.absolute()),
+            task_id=i,
+            output_result=run.results_format == 'json',
+            output_pdbqt=run.pose_output == 'files',
+            return_poses=run.pose_output == 'archive',
+            cur_dir=str(Path("./").absolute()),
+            map_cache_dir=run.map_cache_dir,
+            config_overrides=config_overrides,
+            scratch_dir=run.scratch_dir,
+            receptors=run.receptors
+        )
+
+
+async def run_gpu_async(run: RunParam, task_params, on_result, dock_slots: int = 1, collect_slots: int = 2,
+                        profile_dir: str = None):
+    """
+    GPU docking as an asyncio pipeline of four stages connected by bounded queues, each with its own
+    concurrency limit: ligand preparation (`run.prep_nproc` processes, a thread for one), grid maps (one at a time),
+    adgpu (`dock_slots` subprocesses) and result parsing (`collect_slots` threads). While adgpu docks
+    one ligand, the next ones are prepared and wait in the queue, so the GPU never waits for the CPU stages.
+
+    :param task_params: Iterable of TaskParam.
+    :param on_result: Called in the event loop thread with the result dict of every ligand.
+    :param dock_slots: Max number of concurrent adgpu runs.
+    :param collect_slots: Max number of docked batches parsed concurrently.
+    :param profile_dir: Profile the preparation processes with cProfile into this directory.
+    """
+    loop = asyncio.get_running_loop()
+    with open(run.conf_yaml_file, 'r') as f:
+        base_config = yaml.load(f, Loader=yaml.FullLoader)
+    grids = GridSet(run.receptor_pdbqt, base_config, run.map_cache_dir)
+    grid_lock = asyncio.Lock()
+    batch_size = max(run.gpu_batch_size, 1)
+    queue_size = run.queue_size or 2 * dock_slots * batch_size
+    prep_slots = asyncio.Semaphore(queue_size)
+    ready, docked = asyncio.Queue(queue_size), asyncio.Queue(collect_slots)
+
+    def finish(param: TaskParam, ret: dict):
+        print(f"task {param.task_id}: ", ret["log"])
+        if param.output_result:
+            write_result_json(param, ret)
+        on_result(ret)
+
+    async def prepare(prep_pool, param: TaskParam):
+        start = time.time()
+        try:
+            param = await loop.run_in_executor(prep_pool, prepare_one_task, param)
+            ligand_pdbqt_string = read_ligand_pdbqt(param)
+            async with grid_lock:
+                # GridSet is not thread safe, new maps are rare as the grid cache is warmed up front
+                fld_file = await asyncio.to_thread(grids.fld_for, ligand_pdbqt_string)
+            await ready.put((param, ligand_pdbqt_string, fld_file, start))
+        except Exception as e:
+            finish(param, {"task_id": param.task_id, "ligand_name": param.ligand_name, "log": str(e)})
+        finally:
+            prep_slots.release()
+
+    async def feed():
+        if run.prep_nproc <= 1 and not profile_dir:
+            # a single process costs its start and the imports of this module before the first ligand,
+            # a thread prepares while the event loop waits for adgpu
+            prep_pool = ThreadPoolExecutor(1)
+        else:
+            initializer, initargs = (init_profiled_worker, (profile_dir, "prep")) if profile_dir else (None, ())
+            prep_pool = ProcessPoolExecutor(max(run.prep_nproc, 1), initializer=initializer, initargs=initargs)
+        try:
+            pending = set()
+            for param in task_params:
+                await prep_slots.acquire()
+                pending.add(asyncio.create_task(prepare(prep_pool, param)))
+                pending = {t for t in pending if not t.done()}
+            await asyncio.gather(*pending)
+        finally:
+            # joining the workers would block the event loop while adgpu runs
+            await asyncio.to_thread(prep_pool.shutdown)
+        for _ in range(dock_slots):
+            await ready.put(None)
+
+    async def dock():
+        while (item := await ready.get()) is not None:
+            # take what is ready up to batch_size, never wait for a batch to fill up
+            batch = [item]
+            while len(batch) < batch_size and not ready.empty():
+                item = ready.get_nowait()
+                if item is None:
+                    ready.put_nowait(None)
+                    break
+                batch.append(item)
+            first = batch[0][0]
+            config = {**base_config, **(first.config_overrides or {})}
+            temp_dir = make_scratch_dir(first, f"{first.ligand_name}_")
+            for param, ligand_pdbqt_string, _, _ in batch:
+                with open(temp_dir / f"{param.ligand_name}.pdbqt", 'w') as f:
+                    f.write(ligand_pdbqt_string)
+            if len(batch) == 1:
+                inputs = ('--ffile', str(batch[0][2]), '--lfile', f"{first.ligand_name}.pdbqt")
+            else:
+                # the maps only ever grow, so the latest fld covers the types of every queued ligand
+                with open(temp_dir / "filelist.txt", 'w') as f:
+                    f.write(f"{grids.fld_file}\n")
+                    for param, *_ in batch:
+                        f.write(f"{param.ligand_name}.pdbqt\n{param.ligand_name}\n")
+                inputs = ('--filelist', "filelist.txt")
+            errors, adgpu_start = "", time.perf_counter()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *adgpu_command(config, *inputs), cwd=temp_dir,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+                _, stderr = await proc.communicate()
+                if proc.returncode != 0:
+                    errors = stderr.decode().strip()
+            except Exception as e:
+                errors = str(e)
+            await docked.put((batch, temp_dir, errors, (time.perf_counter() - adgpu_start) / len(batch)))
+
+    async def collect():
+        while (item := await docked.get()) is not None:
+            batch, temp_dir, errors, adgpu_seconds = item
+            for param, _, _, start in batch:
+                try:
+                    timings = {**(param.timings or {}), "adgpu": adgpu_seconds}
+                    ret = await asyncio.to_thread(collect_gpu_result, param, temp_dir, start, timings)
+                except Exception as e:
+                    log = f"{e}: {errors}" if errors else str(e)
+                    ret = {"task_id": param.task_id, "ligand_name": param.ligand_name, "log": log}
+                finish(param, ret)
+            await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+
+    async def dock_and_collect():
+        collectors = [asyncio.create_task(collect()) for _ in range(collect_slots)]
+        await asyncio.gather(*(dock() for _ in range(dock_slots)))
+        for _ in range(collect_slots):
+            await docked.put(None)
+        await asyncio.gather(*collectors)
+
+    await asyncio.gather(feed(), dock_and_collect())
+
+
+def run_stage(run: RunParam, task_params, out_dir: Path, result_hook=None):
+    """
+    Dock `task_params` and write journal, results, poses and top hits to `out_dir`.
+
+    :param result_hook: Called with every result dict after it is recorded, and a function that writes all
+                        results recorded so far to disk.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    dock_func = process_one_task_gpu if run.use_gpu else process_one_task
+    batch_size = run.gpu_batch_size if run.use_gpu else 1
+    if batch_size > 1:
+        dock_func = process_batch_gpu
+    if run.receptors:
+        # the ligand is prepared once and docked against every receptor by the same worker
+        dock_func = functools.partial(process_ensemble, dock_func)
+    journal = RunJournal(out_dir / "run_journal.tsv", resume=run.resume, retry_failed=run.retry_failed)
+    if run.resume:
+        n_finished = sum(journal.is_finished(name) for name in journal.status)
+        click.echo(f"resume: {n_finished} ligands already finished")
+        retried = [name for name, status in journal.status.items() if status == RunJournal.FAILED]
+        if run.retry_failed and retried:
+            click.echo(f"resume: retrying {len(retried)} failed ligands, each tried up to "
+                       f"{max(journal.attempts.get(name, 1) for name in retried)} times before")
+    task_params = journal.iter_started(p for p in task_params if not journal.is_finished(p.ligand_name))
+    sink = open_result_sink(run.results_format, out_dir, resume=run.resume, shared=run.shared_out_dir)
+    archive = PoseArchiveWriter(out_dir / "poses", resume=run.resume, compress=run.pose_compress) \
+        if run.pose_output == 'archive' else None
+    top_hits = TopHits(run.top_k, out_dir / "top_hits.csv", interval=run.summary_interval, resume=run.resume)
+    # relative to out_dir, an absolute path e.g. points into the textfile directory of node_exporter
+    metrics = RunMetrics(out_dir / run.metrics_file, interval=run.summary_interval, resume=run.resume) \
+        if run.metrics_file and run.metrics_file != 'none' else None
+    # cProfile stats of the main process and of every worker
+    profile_dir = str(out_dir / "profile") if run.profile else None
+    scheduler = None
+    if run.schedule == 'cost':
+        scheduler = CostScheduler(CostModel(), nproc=run.nproc, chunksize=run.chunksize, window=run.order_window,
+                                  max_chunk=batch_size if batch_size > 1 else None)
+
+    def on_result(ret):
+        # one results row and pose record per receptor of an ensemble
+        for row in ret.pop("receptor_results", None) or [ret]:
+            poses = row.pop("poses", None)
+            if archive is not None and poses:
+                name = f"{row['ligand_name']}_{row['receptor']}" if "receptor" in row else row["ligand_name"]
+                archive.write(name, poses, row.get("opt_energy"))
+            if sink is not None:
+                sink.write(row)
+        journal.record_result(ret)
+        top_hits.add(ret)
+        if metrics is not None:
+            metrics.add(ret)
+        if scheduler is not None:
+            scheduler.observe(ret)
+        if result_hook is not None:
+            result_hook(ret, flush)
+
+    def flush():
+        if sink is not None:
+            sink.flush()
+        if archive is not None:
+            archive.flush()
+        top_hits.write_summary()
+        if metrics is not None:
+            metrics.write()
+
+    with journal, top_hits, sink or nullcontext(), archive or nullcontext(), metrics or nullcontext():
+        if run.use_gpu and run.gpu_async:
+            start = time.time()
+            with profiled(profile_dir, "main"):
+                asyncio.run(run_gpu_async(run, task_params, on_result, dock_slots=run.gpu_slots,
+                                          profile_dir=profile_dir))
+            print(f"Time: {time.time() - start}")
+        elif run.nproc <= 1 and run.prep_nproc <= 1:
+            with profiled(profile_dir, "main"):
+                if not run.use_gpu:
+                    init_vina_worker(run.conf_yaml_file, run.receptor_pdbqt, run.map_cache_dir, run.cpu,
+                                     make_core_queue(run.core_sets))
+                start = time.time()
+                prepared = map(prepare_one_task, task_params)
+                if batch_size > 1:
+                    for batch in iter_batches(prepared, batch_size):
+                        for results in dock_func(batch):
+                            on_result(results)
+                else:
+                    for param in prepared:
+                        results = dock_func(param)
+                        on_result(results)
+            end = time.time()
+            print(f"Time: {end - start}")
+        else:
+            if run.use_gpu:
+                initializer, initargs = None, ()
+            else:
+                initializer, initargs = init_vina_worker, (run.conf_yaml_file, run.receptor_pdbqt,
+                                                           run.map_cache_dir, run.cpu,
+                                                           make_core_queue(run.core_sets))
+            start = time.time()
+            with profiled(profile_dir, "main"):
+                for ret in tqdm(iter_pipeline(task_params, dock_func, nproc=run.nproc, prep_nproc=run.prep_nproc,
+                                              chunksize=run.chunksize, queue_size=run.queue_size,
+                                              initializer=initializer, initargs=initargs,
+                                              batch_size=batch_size, scheduler=scheduler,
+                                              profile_dir=profile_dir)):
+                    on_result(ret)
+            print(f"Time: {time.time() - start}")
+
+    if run.receptors:
+        write_ensemble_matrix(run, out_dir)
+
+
+def write_ensemble_matrix(run: RunParam, out_dir: Path):
+    if run.results_format == 'json':
+        click.echo("ensemble matrix: not available for --results-format json, see the <receptor>/ directories")
+        return
+    matrix = ensemble_matrix(run.results_format, out_dir, [name for name, _, _ in run.receptors])
+    matrix.to_csv(out_dir / "ensemble_matrix.csv")
+    click.echo(f"ensemble matrix: {len(matrix)} ligands x {len(run.receptors)} receptors, "
+               f"{out_dir / 'ensemble_matrix.csv'}")
+
+
+def make_core_queue(sets: list):
+    if not sets:
+        return None
+    core_queue = multiprocessing.Queue()
+    for cores in sets:
+        core_queue.put(cores)
+    return core_queue
+
+
+def calibrate_layout(run: RunParam, cores: list, n_ligands: int, config: dict, config_overrides: dict = None):
+    """
+    Dock the first `n_ligands` ligands of the library with every candidate processes x threads
+    split of `cores` and return the one with the highest throughput.
+
+    :param cores: Cores of the docking workers, without those of the preparation processes, see `docking_cores`.
+    :return: (nproc, cpu) of the fastest layout.
+    """
+    exhaustiveness = {**config, **(config_overrides or {})}.get('exhaustiveness', 8)
+    with Pool(max(run.prep_nproc, 1)) as p:
+        sample = p.map(prepare_one_task, itertools.islice(
+            iter_task_params(run, run.out_dir, config_overrides=config_overrides), n_ligands))
+    # cached maps make the worker start-up negligible, so only the docking is timed
+    map_cache_dir = run.map_cache_dir or tempfile.mkdtemp(prefix="calibration_maps_")
+    cached_map_prefix(config, run.receptor_pdbqt, map_cache_dir)
+    for param in sample:
+        param.output_result = param.output_pdbqt = param.return_poses = False
+        param.map_cache_dir = map_cache_dir
+    best, best_rate = None, 0.
+    for nproc, cpu in candidate_layouts(len(cores), exhaustiveness):
+        with Pool(nproc, initializer=init_vina_worker,
+                  initargs=(run.conf_yaml_file, run.receptor_pdbqt, map_cache_dir, cpu,
+                            make_core_queue(core_sets(cores, nproc, cpu)))) as p:
+            start = time.time()
+            rets = p.map(process_one_task, sample, chunksize=1)
+        rate = sum('opt_energy' in r for r in rets) / (time.time() - start) * 3600
+        click.echo(f"calibration: {nproc} processes x {cpu} threads: {rate:.1f} ligands/hour")
+        if rate > best_rate:
+            best, best_rate = (nproc, cpu), rate
+    if not run.map_cache_dir:
+        shutil.rmtree(map_cache_dir, ignore_errors=True)
+    if best is None:
+        raise click.ClickException("calibration failed, no ligand of the sample could be docked")
+    return best
+
+
+def run_funnel(run: RunParam, stages: list):
+    """
+    Multi-stage screening: the first stage docks the whole library, every later stage re-docks
+    only the best `top` ligands (or `top_fraction` of them) of the previous stage with its own settings.
+
+    Each stage writes to `out_dir/stage_<i>` and is resumable on its own, so finished stages are
+    not recomputed, and ligands prepared in the first stage are taken from the ligand cache.
+    Only the prepared ligand is reused: a later stage docks its ligands from scratch, it is not
+    seeded with the poses or scores of the previous stage.
+
+    :param stages: `funnel` list of the yaml config, e.g. [{'exhaustiveness': 1, 'n_poses': 1},
+                   {'top_fraction': 0.05, 'exhaustiveness': 16}].
+    """
+    if run.results_format == 'json':
+        raise click.UsageError("funnel stages select ligands from results.sqlite or results/, "
+                               "use --results-format sqlite or parquet")
+    task_ids = None
+    for n, stage in enumerate(stages, 1):
+        stage = dict(stage)
+        top, top_fraction = stage.pop('top', None), stage.pop('top_fraction', None)
+        stage_dir = run.out_dir / f"stage_{n}"
+        if n > 1:
+            if top is None and top_fraction is None:
+                raise click.UsageError(f"funnel stage {n} needs `top` or `top_fraction`")
+            task_ids = set(select_best(run.results_format, run.out_dir / f"stage_{n - 1}",
+                                       n=top, fraction=top_fraction))
+            if not task_ids:
+                raise click.ClickException(f"funnel stage {n}: no ligand of stage {n - 1} was docked")
+        click.echo(f"funnel stage {n}: {'all' if task_ids is None else len(task_ids)} ligands, settings {stage}")
+        run_stage(run, iter_task_params(run, stage_dir, task_ids=task_ids, config_overrides=stage), stage_dir)
+
+
+def iter_leased_task_params(run: RunParam, leased: LeasedTasks, out_dir: Path, finished: set = frozenset()):
+    """
+    TaskParams of the chunks leased from the work queue, leasing the next chunk when the pipeline needs more
+    ligands. Ligands in `finished` are skipped, the chunk is complete without them.
+    """
+    # chunks are leased in ascending order, so the library is read once
+    cursor = LigandCursor(run.smiles_csv)
+    for chunk_id, task_range in leased.iter_chunks():
+        for param in iter_task_params(run, out_dir, ligands=cursor.range(task_range.start, task_range.stop)):
+            if param.ligand_name in finished:
+                continue
+            leased.add(chunk_id, param.task_id)
+            yield param
+
+
+def wait_for_nodes(queue: WorkQueue, nodes_dir: Path, poll_seconds: float = 5.):
+    """
+    Wait until every node that completed chunks has closed its results and written `nodes/<id>/closed`.
+    A node whose heartbeat stopped for `lease_seconds` crashed, its results are merged as they are.
+    """
+    while True:
+        waiting, crashed = [], []
+        for owner in queue.done_owners():
+            if (nodes_dir / owner / "closed").exists():
+                continue
+            if time.time() - queue.last_heartbeat(owner) > queue.lease_seconds:
+                crashed.append(owner)
+            else:
+                waiting.append(owner)
+        if not waiting:
+            for owner in crashed:
+                click.echo(f"node {owner} stopped without closing its results, merging what it wrote")
+            return
+        time.sleep(poll_seconds)
+
+
+def run_node(run: RunParam, node_id: str, chunk_size: int = 1000, lease_seconds: float = 600.):
+    """
+    One node of a multi-node screen: dock chunks leased from the shared work queue `out_dir/work_queue.sqlite`
+    until none is left. Pose files go to `out_dir`, results, journal, top hits and pose archive of the node to
+    `out_dir/nodes/<node_id>`. The node that finds all chunks done merges the results of all nodes into `out_dir`
+    and indexes their pose archives in `out_dir/poses`.
+
+    Start the same command on every node, or several times on one machine, with the same out_dir.
+    """
+    queue = WorkQueue(run.out_dir / "work_queue.sqlite", lease_seconds=lease_seconds)
+    # task ids are row numbers, rows without name or SMILES leave gaps
+    n_tasks = max((i for i, _, _ in iter_ligands(run.smiles_csv)), default=-1) + 1
+    if queue.create(n_tasks, chunk_size):
+        click.echo(f"work queue: created {sum(queue.counts().values())} chunks of {chunk_size} ligands")
+    node_dir = run.out_dir / "nodes" / node_id
+    # a node restarted with the same id, the default on the same host, continues its own results
+    journal_file = node_dir / "run_journal.tsv"
+    closed_file = node_dir / "closed"
+    leased = LeasedTasks(queue, node_id)
+    try:
+        while True:
+            finished = {name for name, status in RunJournal.load(journal_file).items()
+                        if status in RunJournal.finished(run.retry_failed)}
+            node_run = replace(run, resume=journal_file.exists(), shared_out_dir=True)
+            closed_file.unlink(missing_ok=True)
+            run_stage(node_run, iter_leased_task_params(run, leased, run.out_dir, finished), node_dir,
+                      result_hook=lambda ret, flush: leased.done(ret.get("task_id"), flush))
+            # run_stage has closed the results, journal and top hits, only now the last chunk is completed
+            closed_file.touch()
+            leased.complete_finished()
+            # chunks of nodes that stop renewing their leases are docked here
+            if not leased.wait_for_chunk():
+                break
+    finally:
+        leased.close()
+    counts = queue.counts()
+    click.echo(f"work queue: {counts}")
+    if queue.all_done() and queue.claim("merge", node_id):
+        wait_for_nodes(queue, run.out_dir / "nodes")
+        node_dirs = sorted(p for p in (run.out_dir / "nodes").iterdir() if p.is_dir())
+        for part in merge_results(run.results_format, node_dirs, run.out_dir):
+            click.echo(f"skipped {part}, not a complete parquet file")
+        if run.pose_output == 'archive':
+            merge_pose_archives([p / "poses" for p in node_dirs], run.out_dir / "poses")
+        with TopHits(run.top_k, run.out_dir / "top_hits.csv") as top_hits:
+            for p in node_dirs:
+                if (p / "top_hits.csv").exists():
+                    top_hits.load(p / "top_hits.csv")
+        click.echo(f"merged the results of {len(node_dirs)} nodes into {run.out_dir}")
+        if run.receptors:
+            write_ensemble_matrix(run, run.out_dir)
+    queue.close()
+
+
 @click.command("dock-run")
 @click.argument("conf_yaml_file", type=click.Path(exists=True))
 @click.argument("smiles_csv", type=click.Path(exists=True))
@@ -185,69 +984,203 @@ def process_one_task(param: TaskParam):
 @click.option("-n", "--nproc", "nproc", default=3, help="number of processes", show_default=True)
 @click.option("-c", "--chunksize", "chunksize", default=1, help="chunksize of multiprocess", show_default=True)
 @click.option('--use-gpu', is_flag=True, help='Use AutoDock-GPU to run docking', show_default=True)
+@click.option("--map-cache", "map_cache_dir", default=None, type=click.Path(),
+              help="directory to cache Vina affinity maps / AutoGrid maps, shared by all workers and runs "
+                   "(AutoGrid maps default to out_dir/grids)")
+@click.option("--prep-nproc", "prep_nproc", default=1, show_default=True,
+              help="number of ligand preparation processes, running alongside the docking processes")
+@click.option("--queue-size", "queue_size", default=0,
+              help="max ligands prepared ahead of docking, 0 for 2 * nproc * chunksize")
+@click.option("--prep-backend", "prep_backend", default="prepare_ligand4", show_default=True,
+              type=click.Choice(list(prep_backends)), help="ligand preparation backend")
+@click.option("--ligand-cache", "ligand_cache", default=None, type=click.Path(),
+              help="SQLite file caching prepared ligands across runs, see `para-dock prep-cache`")
+@click.option("--resume", is_flag=True,
+              help="continue a previous run in out_dir, skipping ligands finished according to its run journal")
+@click.option("--retry-failed", "retry_failed", is_flag=True,
+              help="with --resume, dock the ligands that failed again; the results keep a row of every attempt")
+@click.option("--results-format", "results_format", default="sqlite", show_default=True,
+              type=click.Choice(['json'] + list(result_sinks)),
+              help="results.sqlite / results/*.parquet written by the parent, or legacy per-ligand json files")
+@click.option("--pose-output", "pose_output", default="files", show_default=True,
+              type=click.Choice(['files', 'archive', 'none']),
+              help="one pdbqt file per ligand, or an indexed archive in out_dir/poses, see `para-dock extract-poses`")
+@click.option("--pose-compress", is_flag=True, help="compress the records of the pose archive")
+@click.option("--top-k", "top_k", default=1000, show_default=True,
+              help="number of best ligands ranked in out_dir/top_hits.csv")
+@click.option("--summary-interval", "summary_interval", default=60., show_default=True,
+              help="seconds between two updates of top_hits.csv and the metrics file while running")
+@click.option("--layout", "layout", default="manual", show_default=True,
+              type=click.Choice(['manual', 'auto', 'calibrate']),
+              help="manual: --nproc and config cpu; auto: split the available cores, less one per --prep-nproc "
+                   "process, into pinned processes x Vina threads; calibrate: time the candidate splits on a "
+                   "sample and keep the fastest")
+@click.option("--calibration-size", "calibration_size", default=0,
+              help="ligands docked per candidate split with --layout calibrate, 0 for 2 * cores")
+@click.option("--gpu-batch-size", "gpu_batch_size", default=1, show_default=True,
+              help="ligands docked per adgpu run with --use-gpu, batches are passed as --filelist")
+@click.option("--scratch-dir", "scratch_dir", default=None, type=click.Path(),
+              help="root of the per-task working directories of adgpu, e.g. /dev/shm or node-local disk "
+                   "(default out_dir), only final outputs are written to out_dir")
+@click.option("--gpu-async", "gpu_async", is_flag=True,
+              help="with --use-gpu, run preparation, grid maps, adgpu and result parsing as an asyncio pipeline "
+                   "that keeps the next ligands ready for the GPU, --nproc is not used")
+@click.option("--gpu-slots", "gpu_slots", default=1, show_default=True,
+              help="concurrent adgpu runs with --gpu-async")
+@click.option("--schedule", "schedule", default="fifo", show_default=True, type=click.Choice(['fifo', 'cost']),
+              help="fifo: dock in library order with fixed chunks; cost: dock the slowest ligands first, as predicted "
+                   "from their torsions and heavy atoms, in chunks of about --chunksize mean ligand costs")
+@click.option("--order-window", "order_window", default=1000, show_default=True,
+              help="prepared ligands ordered at once with --schedule cost")
+@click.option("--queue", "queue", is_flag=True,
+              help="join the multi-node work queue in out_dir, start the same command on every node (or several "
+                   "times on one machine) with the same out_dir")
+@click.option("--node-id", "node_id", default=None, help="name of this node with --queue, default <hostname>-<slot>, the lowest slot not taken by a "
+                   "running node on this host")
+@click.option("--queue-chunk", "queue_chunk", default=1000, show_default=True,
+              help="ligands per leased chunk of the work queue, set by the node creating the queue")
+@click.option("--lease-seconds", "lease_seconds", default=600., show_default=True,
+              help="seconds until the chunks of a node that stopped renewing them (e.g. crashed) are leased again")
+@click.option("--metrics", "metrics_file", default="metrics.csv", show_default=True,
+              help="throughput and stage latency file, relative to the output directory; "
+                   "*.prom writes a Prometheus textfile, 'none' disables it")
+@click.option("--profile", "profile", is_flag=True,
+              help="write cProfile stats of the main process and every worker to <out_dir>/profile")
+@click.option("--preprocess", "preprocess", is_flag=True,
+              help="standardise, filter (`library_filters` of the config) and dedupe the library before docking, "
+                   "results of every input row go to results_by_name.csv")
 def para_run_dock(conf_yaml_file: str, smiles_csv: str, receptor_pdbqt: str,
-                  out_dir: str="./output", nproc: int = 3, chunksize: int = 1, use_gpu: bool = False):
+                  out_dir: str="./output", nproc: int = 3, chunksize: int = 1, use_gpu: bool = False,
+                  map_cache_dir: str = None, prep_nproc: int = 1, queue_size: int = 0,
+                  prep_backend: str = "prepare_ligand4", ligand_cache: str = None, resume: bool = False,
+                  retry_failed: bool = False, results_format: str = "sqlite", pose_output: str = "files",
+                  pose_compress: bool = False,
+                  top_k: int = 1000, summary_interval: float = 60., layout: str = "manual",
+                  calibration_size: int = 0, gpu_batch_size: int = 1,
+                  scratch_dir: str = None, gpu_async: bool = False, gpu_slots: int = 1,
+                  schedule: str = "fifo", order_window: int = 1000, queue: bool = False, node_id: str = None,
+                  queue_chunk: int = 1000, lease_seconds: float = 600., metrics_file: str = "metrics.csv",
+                  profile: bool = False, preprocess: bool = False):
+    """
+    Dock the ligands of SMILES_CSV into RECEPTOR_PDBQT, or every receptor of a yaml manifest, with the settings
+    of CONF_YAML_FILE.
+
+    A `funnel` list in CONF_YAML_FILE screens in stages, each re-docking the best ligands of the previous one
+    with its own settings. Only the prepared ligands are reused, every stage docks from scratch.
+    """
     click.echo(f"conf_yaml_file: {conf_yaml_file}")
     click.echo(f"smiles_csv: {smiles_csv}")
     click.echo(f"receptor_pdbqt: {receptor_pdbqt}")
     click.echo(f"out_dir: {out_dir}")
     click.echo(f"nproc: {nproc}")
     click.echo(f"chunksize: {chunksize}")
+    click.echo(f"schedule: {schedule}")
     click.echo(f"use_gpu: {use_gpu}")
+    if use_gpu:
+        click.echo(f"gpu_batch_size: {gpu_batch_size}")
+        click.echo(f"scratch_dir: {scratch_dir}")
+        click.echo(f"gpu_async: {gpu_async}")
+    click.echo(f"map_cache: {map_cache_dir}")
+    click.echo(f"prep_nproc: {prep_nproc}")
+    click.echo(f"prep_backend: {prep_backend}")
+    click.echo(f"ligand_cache: {ligand_cache}")
+    click.echo(f"resume: {resume}")
+    click.echo(f"retry_failed: {retry_failed}")
+    click.echo(f"results_format: {results_format}")
+    click.echo(f"pose_output: {pose_output}")
+    click.echo(f"layout: {layout}")
+    click.echo(f"metrics: {metrics_file}")
+    click.echo(f"preprocess: {preprocess}")
+    click.echo(f"queue: {queue}")
 
-    df = pd.read_csv(smiles_csv)
-    task_params = []
-    if out_dir is not None:
-        out_dir = Path(out_dir)
-        out_dir.mkdir(parents=True, exist_ok=True)
+    if use_gpu and gpu_async and schedule == 'cost':
+        raise click.UsageError("--schedule cost orders the chunks of the process pools, "
+                               "the --gpu-async pipeline docks in library order; drop one of them")
 
-    for i in range(len(df.index)):
-        name = df.name[i]
-        if not name:
-            continue
-        print(f"Processing {name}")
-        try:
-            smiles = df.SMILES[i]
-            sl = smiles.split(".")
-            max_len = 0
-            for s in sl:
-                if len(s) > max_len:
-                    smiles = s
-                    max_len = len(s)
-
-            ligand_pdbqt_string = one_smiles_to_pdbqt_string_v2(smiles)
-            task_params.append(
-                                TaskParam(
-                                     conf_yaml_file=conf_yaml_file,
-                                     receptor_pdbqt=receptor_pdbqt,
-                                     ligand_name=name,
-                                     ligand_pdbqt_string=ligand_pdbqt_string,
-                                     output_dir=str(out_dir.absolute()),
-                                     task_id=i,
-                                     cur_dir=str(Path("./").absolute())
-                                    )
-                                )
-        except Exception as e:
-            print(f"{name} Error: {e}")
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with open(conf_yaml_file, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    stages = config.get('funnel')
+    receptors = None
+    if is_receptor_manifest(receptor_pdbqt):
+        # ensemble docking, RECEPTOR_PDBQT is a yaml manifest of receptors
+        if use_gpu and (gpu_async or gpu_batch_size > 1):
+            raise click.UsageError("ensemble docking runs one ligand per adgpu call, "
+                                   "drop --gpu-async and --gpu-batch-size")
+        receptors = load_receptors(receptor_pdbqt, conf_yaml_file, out_dir)
+        click.echo(f"receptors: {', '.join(name for name, _, _ in receptors)}")
+        # the workers start with the first receptor loaded
+        _, conf_yaml_file, receptor_pdbqt = receptors[0]
+    library_dir = out_dir / "library"
+    if preprocess:
+        if queue:
+            raise click.UsageError("run prep-library once before starting the nodes and dock its library.csv")
+        report = preprocess_library(smiles_csv, library_dir, config.get('library_filters'),
+                                    nproc=max(nproc, prep_nproc))
+        click.echo(format_report(report))
+        # the unique molecules are docked, canonical SMILES of their largest fragment
+        smiles_csv = str(library_dir / "library.csv")
+    if stages and not ligand_cache:
+        # later stages reuse the ligands prepared in the first one
+        ligand_cache = str(out_dir / "ligands.sqlite")
 
-    import time
-    if nproc <= 1:
-        start = time.time()
-        for param in task_params:
-            if use_gpu:
-                results = process_one_task_gpu(param)
-            else:
-                results = process_one_task(param)
-        end = time.time()
-        print(f"Time: {end - start}")
+    run = RunParam(conf_yaml_file=conf_yaml_file, smiles_csv=smiles_csv, receptor_pdbqt=receptor_pdbqt,
+                   out_dir=out_dir, nproc=nproc, chunksize=chunksize, use_gpu=use_gpu,
+                   map_cache_dir=map_cache_dir, prep_nproc=prep_nproc, queue_size=queue_size,
+                   prep_backend=prep_backend, ligand_cache=ligand_cache, resume=resume, retry_failed=retry_failed,
+                   results_format=results_format, pose_output=pose_output, pose_compress=pose_compress,
+                   top_k=top_k, summary_interval=summary_interval, gpu_batch_size=gpu_batch_size,
+                   scratch_dir=scratch_dir and str(Path(scratch_dir).absolute()),
+                   gpu_async=gpu_async, gpu_slots=gpu_slots, schedule=schedule, order_window=order_window,
+                   receptors=receptors, metrics_file=metrics_file, profile=profile)
+
+    if use_gpu:
+        run.map_cache_dir = str(Path(map_cache_dir or out_dir / "grids").absolute())
+    for _, receptor_conf, pdbqt in receptors or [(None, conf_yaml_file, receptor_pdbqt)]:
+        with open(receptor_conf, 'r') as f:
+            receptor_config = yaml.load(f, Loader=yaml.FullLoader)
+        if map_cache_dir and not use_gpu:
+            # compute the maps once here, so the workers only load them
+            click.echo(f"Vina maps: {cached_map_prefix(receptor_config, pdbqt, map_cache_dir)}")
+        if use_gpu:
+            # AutoGrid maps are built once here, the workers only extend them for unusual ligand types
+            click.echo(f"AutoGrid maps: {cached_grid(pdbqt, receptor_config, run.map_cache_dir)}")
+
+    if layout != 'manual' and not use_gpu:
+        # the preparation processes run alongside the docking workers, each keeps a core
+        cores = docking_cores(available_cores(), prep_nproc)
+        if layout == 'calibrate':
+            overrides = {k: v for k, v in stages[0].items() if k not in ('top', 'top_fraction')} \
+                if stages else None
+            run.nproc, run.cpu = calibrate_layout(run, cores, calibration_size or 2 * len(cores),
+                                                  config, config_overrides=overrides)
+        else:
+            run.nproc, run.cpu = default_layout(len(cores))
+        run.core_sets = core_sets(cores, run.nproc, run.cpu)
+        click.echo(f"layout: {run.nproc} processes x {run.cpu} Vina threads on cores {run.core_sets}, "
+                   f"{len(available_cores()) - len(cores)} cores left for ligand preparation")
+
+    if queue:
+        if stages:
+            raise click.UsageError("funnel stages can not run on the multi-node work queue")
+        node_lock = None
+        if node_id is None:
+            node_id, node_lock = claim_node_id(out_dir / "nodes")
+        try:
+            run_node(run, node_id, queue_chunk, lease_seconds)
+        finally:
+            if node_lock is not None:
+                node_lock.close()
+    elif stages:
+        run_funnel(run, stages)
     else:
-        with Pool(nproc) as p:
-            if use_gpu:
-                results = list(tqdm(p.imap_unordered(process_one_task_gpu, task_params, chunksize=chunksize),
-                                    total=len(task_params)))
-            else:
-                results = list(tqdm(p.imap_unordered(process_one_task, task_params, chunksize=chunksize),
-                                    total=len(task_params)))
-        # results = list(p.map(process_one_task, task_params, chunksize=chunksize))
+        # the library is read lazily, the pipeline pulls only as many ligands as it has free slots
+        run_stage(run, iter_task_params(run, out_dir), out_dir)
 
-    # return results
+    if preprocess:
+        if results_format == 'json':
+            click.echo(f"results by name: not available for --results-format json, see {library_dir / 'library_map.csv'}")
+        else:
+            result_dir = out_dir / f"stage_{len(stages)}" if stages else out_dir
+            click.echo(f"results by name: {fan_out_results(results_format, result_dir, library_dir)}")
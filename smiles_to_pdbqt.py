@@ -4,9 +4,16 @@
 # @Author : yuyeqing
 # @File   : smiles_to_pdbqt.py
 # @IDE    : PyCharm
+import json
+import click
 import subprocess
 import tempfile
+import pandas as pd
+from tqdm import tqdm
+from multiprocessing import Pool
 from openbabel import pybel
+from utils.ligand_cache import get_ligand_cache
+from utils.tool_version import executable_sha256
 
 
 def one_smiles_to_pdbqt_string(smiles):
@@ -73,6 +80,118 @@ def one_smiles_to_pdbqt_string_v2(smiles):
         raise RuntimeError(result.stderr)
 
 
+def one_smiles_to_pdbqt_string_meeko(smiles, seed=42):
+    """
+    在内存中将 SMILES 转换为 PDBQT 字符串 (RDKit 生成 3D 结构, Meeko 写出 PDBQT), 不启动子进程也不写临时文件。
+
+    参数:
+    smiles (str): 输入的 SMILES 字符串。
+    seed (int): 3D 构象生成的随机种子。
+
+    返回:
+    str: 输出的 PDBQT 字符串。
+    """
+    from rdkit import Chem
+    from rdkit.Chem import AllChem
+    from meeko import MoleculePreparation, PDBQTWriterLegacy
+
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        raise ValueError(f"Invalid SMILES: {smiles}")
+    mol = Chem.AddHs(mol)  # 添加氢原子
+    params = AllChem.ETKDGv3()
+    params.randomSeed = seed
+    if AllChem.EmbedMolecule(mol, params) != 0:
+        raise RuntimeError(f"3D embedding failed: {smiles}")
+    if AllChem.MMFFHasAllMoleculeParams(mol):
+        AllChem.MMFFOptimizeMolecule(mol)
+
+    setups = MoleculePreparation().prepare(mol)
+    pdbqt_string, is_ok, error_msg = PDBQTWriterLegacy.write_string(setups[0])
+    if not is_ok:
+        raise RuntimeError(error_msg)
+    return pdbqt_string
+
+
+# 配体准备后端, 名称 -> SMILES 转 PDBQT 字符串的函数
+prep_backends = {
+    'prepare_ligand4': one_smiles_to_pdbqt_string_v2,
+    'obabel': one_smiles_to_pdbqt_string,
+    'meeko': one_smiles_to_pdbqt_string_meeko,
+}
+
+
+def prep_backend_key(backend, **kwargs):
+    """
+    生成描述配体准备后端、版本和参数的字符串, 作为配体缓存键的一部分。
+    prepare_ligand4 没有版本号, 以其可执行文件的 sha256 代替。
+    """
+    versions = {'openbabel': pybel.ob.OBReleaseVersion()}
+    if backend == 'prepare_ligand4':
+        versions['prepare_ligand4'] = executable_sha256('prepare_ligand4')
+    if backend == 'meeko':
+        import rdkit
+        import meeko
+        versions.update(rdkit=rdkit.__version__, meeko=meeko.__version__)
+    return json.dumps({'backend': backend, 'versions': versions, 'settings': kwargs}, sort_keys=True)
+
+
+def smiles_to_pdbqt_string(smiles, backend='prepare_ligand4', cache_file=None, **kwargs):
+    """
+    使用指定的配体准备后端将 SMILES 转换为 PDBQT 字符串。
+
+    参数:
+    smiles (str): 输入的 SMILES 字符串。
+    backend (str): prep_backends 中的后端名称。
+    cache_file (str): 可选的配体缓存 SQLite 文件, 先查缓存, 未命中时准备后写入缓存。
+    kwargs: 传给后端函数的参数。
+
+    返回:
+    str: 输出的 PDBQT 字符串。
+    """
+    if backend not in prep_backends:
+        raise ValueError(f"Unknown preparation backend {backend}, choose from {list(prep_backends)}")
+    if not cache_file:
+        return prep_backends[backend](smiles, **kwargs)
+
+    cache = get_ligand_cache(cache_file)
+    prep_key = prep_backend_key(backend, **kwargs)
+    pdbqt_string = cache.get(smiles, prep_key)
+    if pdbqt_string is None:
+        pdbqt_string = prep_backends[backend](smiles, **kwargs)
+        cache.put(smiles, prep_key, pdbqt_string)
+    return pdbqt_string
+
+
+def _warm_one(args):
+    smiles, backend, cache_file = args
+    try:
+        smiles_to_pdbqt_string(max(smiles.split("."), key=len), backend=backend, cache_file=cache_file)
+        return None
+    except Exception as e:
+        return f"{smiles} Error: {e}"
+
+
+@click.command("prep-cache")
+@click.argument("smiles_csv", type=click.Path(exists=True))
+@click.argument("cache_file", type=click.Path())
+@click.option("-b", "--prep-backend", "prep_backend", default="prepare_ligand4", show_default=True,
+              type=click.Choice(list(prep_backends)), help="ligand preparation backend")
+@click.option("-n", "--nproc", "nproc", default=3, help="number of processes", show_default=True)
+def prep_cache_warm(smiles_csv: str, cache_file: str, prep_backend: str = "prepare_ligand4", nproc: int = 3):
+    """Prepare all SMILES of SMILES_CSV and store the pdbqt strings in the ligand cache CACHE_FILE."""
+    smiles_list = pd.read_csv(smiles_csv).SMILES.dropna().tolist()
+    tasks = ((smiles, prep_backend, cache_file) for smiles in smiles_list)
+    n_fail = 0
+    with Pool(max(nproc, 1)) as p:
+        for err in tqdm(p.imap_unordered(_warm_one, tasks, chunksize=16), total=len(smiles_list)):
+            if err:
+                n_fail += 1
+                print(err)
+    click.echo(f"{len(smiles_list) - n_fail} ligands cached, {n_fail} failed, "
+               f"{len(get_ligand_cache(cache_file))} entries in {cache_file}")
+
+
 def one_smiles_to_pdbqt_file(smiles, output_file):
     """
     将 SMILES 字符串转换为 PDBQT 文件。
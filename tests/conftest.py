@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/16 10:12
+# @Author : yuyeqing
+# @File   : conftest.py
+# @IDE    : PyCharm
+import sys
+from pathlib import Path
+
+# the modules of the repository are imported as top-level modules, as `para-dock` does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/18 14:40
+# @Author : yuyeqing
+# @File   : test_adgpu_output_xml_parser.py
+# @IDE    : PyCharm
+import random
+import pytest
+import numpy as np
+import xml.etree.ElementTree as ET
+from utils import adgpu_output_xml_parser
+from utils.adgpu_output_xml_parser import parse_outputs, parse_xml
+from benchmarks.bench_adgpu_parser import write_synthetic_output
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    rng = random.Random(42)
+    for batch in ["batch_1", "batch_2"]:
+        (tmp_path / batch).mkdir()
+        for name in ["lig-1", "lig-2"]:
+            write_synthetic_output(tmp_path / batch, name, n_runs=6, n_atoms=4, rng=rng)
+    return tmp_path
+
+
+def test_same_stem_in_subdirectories(outputs):
+    runs, ligands, coords = parse_outputs([outputs])
+    names = ["batch_1/lig-1", "batch_1/lig-2", "batch_2/lig-1", "batch_2/lig-2"]
+    assert sorted(ligands.name) == names
+    assert sorted(coords) == names
+    assert len(runs) == 4 * 6
+    assert not np.array_equal(coords["batch_1/lig-1"], coords["batch_2/lig-1"])
+    # a directory given directly keeps the plain names
+    assert sorted(parse_outputs([outputs / "batch_1"])[1].name) == ["lig-1", "lig-2"]
+
+
+def test_duplicate_names_raise(outputs):
+    with pytest.raises(ValueError, match="lig-1"):
+        parse_outputs([outputs / "batch_1", outputs / "batch_2"])
+
+
+def test_errors_go_to_stderr(outputs, capsys):
+    (outputs / "batch_1" / "lig-2.xml").write_text("<autodock_gpu><runs><run id=")
+    (outputs / "batch_1" / "lig-2.dlg").unlink()
+    runs, ligands, coords = parse_outputs([outputs / "batch_1"])
+    assert list(ligands.name) == ["lig-1"]
+    captured = capsys.readouterr()
+    assert "lig-2.xml" in captured.err and captured.out == ""
+
+
+def test_parse_xml_drops_read_elements(outputs, monkeypatch):
+    ends = []
+    iterparse = ET.iterparse
+
+    def recording_iterparse(*args, **kwargs):
+        for event, elem in iterparse(*args, **kwargs):
+            yield event, elem
+            ends.append(elem)
+
+    monkeypatch.setattr(adgpu_output_xml_parser.ET, "iterparse", recording_iterparse)
+    ret = parse_xml(outputs / "batch_1" / "lig-1.xml")
+    assert len(ret['run_ids']) == 6 and len(ret['clusters']) == 3 and (ret['ranks'] > 0).all()
+    for elem in ends:
+        if elem.tag in ('run', 'cluster'):
+            assert not elem.attrib and not len(elem)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/26 14:05
+# @Author : yuyeqing
+# @File   : test_funnel.py
+# @IDE    : PyCharm
+import click
+import pytest
+import pandas as pd
+import run_dock
+from run_dock import RunParam, run_funnel
+from utils.result_sink import select_best
+
+STAGES = [{'exhaustiveness': 1}, {'top': 2, 'exhaustiveness': 16}]
+
+
+@pytest.fixture
+def funnel_run(tmp_path, monkeypatch):
+    smiles_csv = tmp_path / "ligands.csv"
+    pd.DataFrame({"name": [f"lig-{i}" for i in range(6)], "SMILES": ["CCO"] * 6}).to_csv(smiles_csv, index=False)
+    docked = []
+
+    def process_one_task(param):
+        docked.append((param.config_overrides['exhaustiveness'], param.task_id))
+        if param.task_id == 0:
+            return {"task_id": 0, "ligand_name": param.ligand_name, "log": "failed"}
+        # a later stage finds better poses
+        energy = -param.task_id - param.config_overrides['exhaustiveness']
+        return {"task_id": param.task_id, "ligand_name": param.ligand_name, "opt_energy": energy,
+                "energies": [[energy]], "log": ""}
+
+    monkeypatch.setattr(run_dock, "init_vina_worker", lambda *args: None)
+    monkeypatch.setattr(run_dock, "prepare_one_task", lambda param: param)
+    monkeypatch.setattr(run_dock, "process_one_task", process_one_task)
+    run = RunParam(conf_yaml_file="conf.yaml", smiles_csv=str(smiles_csv), receptor_pdbqt="receptor.pdbqt",
+                   out_dir=tmp_path / "out", nproc=1, prep_nproc=1, pose_output="none", metrics_file="none")
+    return run, docked
+
+
+@pytest.mark.parametrize("results_format", ["sqlite", "parquet"])
+def test_stages_redock_the_best(funnel_run, results_format):
+    run, docked = funnel_run
+    run.results_format = results_format
+    run_funnel(run, STAGES)
+    # stage 2 re-docks the two best of stage 1, in library order
+    assert docked == [(1, i) for i in range(6)] + [(16, 4), (16, 5)]
+    assert select_best(results_format, run.out_dir / "stage_2", n=2) == [5, 4]
+
+
+def test_torn_parquet_part_between_stages(funnel_run):
+    run, docked = funnel_run
+    run.results_format = "parquet"
+    run_funnel(run, STAGES[:1])
+    # a part without footer in stage 1, e.g. of a crashed run
+    (run.out_dir / "stage_1" / "results" / "part-00001.parquet").write_bytes(b"PAR1 torn")
+    run.resume = True
+    with pytest.warns(UserWarning, match="part-00001.parquet"):
+        run_funnel(run, STAGES)
+    assert docked[-2:] == [(16, 4), (16, 5)]
+
+
+def test_stage_without_docked_ligands(funnel_run):
+    run, docked = funnel_run
+    run.smiles_csv = str(run.out_dir.parent / "one.csv")
+    pd.DataFrame({"name": ["lig-0"], "SMILES": ["CCO"]}).to_csv(run.smiles_csv, index=False)
+    with pytest.raises(click.ClickException, match="no ligand of stage 1"):
+        run_funnel(run, STAGES)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/3/7 8:56
+# @Author : yuyeqing
+# @File   : test_gen_config.py
+# @IDE    : PyCharm
+import yaml
+from gen_config import gen_config_inference, rescale_npts, calculate_size
+
+
+def test_rescale_npts():
+    assert rescale_npts([40, 50, 40], 0.375, 0.375) == [40, 50, 40]
+    npts = rescale_npts([40, 50, 40], 0.375, 0.5)
+    assert npts == [32, 38, 32]
+    assert all(a >= b for a, b in zip(calculate_size(npts, 0.5), calculate_size([40, 50, 40], 0.375)))
+
+
+def test_spacing_overrides_the_grid_box_file(tmp_path):
+    grid_box = tmp_path / "grid.gpf"
+    grid_box.write_text("npts 40 50 40\nspacing 0.375\ncenter 1.335 53.325 -18.028\n")
+    args = ["-f", str(grid_box), "--output-path", str(tmp_path), "--generate-yaml"]
+    gen_config_inference.main(args, standalone_mode=False)
+    conf = yaml.load((tmp_path / "conf.yaml").read_text(), Loader=yaml.FullLoader)
+    assert conf["spacing"] == 0.375 and conf["npts"] == [40, 50, 40]
+
+    gen_config_inference.main(args + ["--spacing", "0.5"], standalone_mode=False)
+    conf = yaml.load((tmp_path / "conf.yaml").read_text(), Loader=yaml.FullLoader)
+    assert conf["spacing"] == 0.5 and conf["npts"] == [32, 38, 32]
+    assert conf["center"] == [1.335, 53.325, -18.028]
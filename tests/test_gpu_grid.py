@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/9 14:20
+# @Author : yuyeqing
+# @File   : test_gpu_grid.py
+# @IDE    : PyCharm
+import os
+from utils.gpu_grid import grid_cache_key, DEFAULT_LIGAND_TYPES
+
+
+def write_tool(path, body: str):
+    path.write_text(f"#!/bin/sh\n{body}\n")
+    os.chmod(path, 0o755)
+    # the hash is cached per size and mtime
+    os.utime(path, ns=(0, len(body)))
+
+
+def test_grid_cache_key_follows_autogrid(tmp_path):
+    receptor = tmp_path / "receptor.pdbqt"
+    receptor.write_text("ATOM      1  C   ALA A   1       0.000   0.000   0.000  1.00  0.00     0.000 C \n")
+    write_tool(tmp_path / "prepare_gpf4", "exit 0")
+    write_tool(tmp_path / "autogrid4", "exit 0")
+    config = {'npts': [40, 40, 40], 'center': [0., 0., 0.], 'spacing': 0.375,
+              'executables': {'prepare_gpf4': tmp_path / "prepare_gpf4", 'autogrid4': tmp_path / "autogrid4"}}
+    key = grid_cache_key(receptor, config, DEFAULT_LIGAND_TYPES)
+    assert grid_cache_key(receptor, config, DEFAULT_LIGAND_TYPES) == key
+
+    # another AutoGrid release
+    write_tool(tmp_path / "autogrid4", "exit 0 # 4.2.7")
+    assert grid_cache_key(receptor, config, DEFAULT_LIGAND_TYPES) != key
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/20 9:30
+# @Author : yuyeqing
+# @File   : test_ligand_cost.py
+# @IDE    : PyCharm
+from run_dock import TaskParam, prepare_one_task
+from utils.ligand_cost import CostModel, CostScheduler, ligand_features
+
+# from rigid to flexible, the order of their prior costs
+SMILES = {
+    "benzene": "c1ccccc1",
+    "ethanol": "CCO",
+    "ibuprofen": "CC(C)Cc1ccc(cc1)C(C)C(=O)O",
+    "decanol": "CCCCCCCCCCO",
+    "dodecyl_ester": "CCCCCCCCCCCCOC(=O)CCCCCCCCC(=O)O",
+}
+
+
+def prepared_params(smiles: dict):
+    return [prepare_one_task(TaskParam(conf_yaml_file="conf.yaml", receptor_pdbqt="receptor.pdbqt", ligand_name=name,
+                                       smiles=s, prep_backend="meeko", task_id=i))
+            for i, (name, s) in enumerate(smiles.items())]
+
+
+def schedule(scheduler: CostScheduler, params: list):
+    chunks = []
+    for chunk in scheduler.iter_chunks(params):
+        chunks.append([p.ligand_name for p in chunk])
+        scheduler.chunk_done()
+    return chunks
+
+
+def test_longest_first():
+    model = CostModel()
+    params = prepared_params(SMILES)
+    costs = {p.ligand_name: model.predict(ligand_features(p.ligand_pdbqt_string)) for p in params}
+    assert sorted(costs, key=costs.get) == list(SMILES)
+
+    chunks = schedule(CostScheduler(model, nproc=2, chunksize=1, max_chunk=1), params)
+    assert chunks == [[name] for name in reversed(SMILES)]
+
+
+def test_chunks_group_cheap_ligands():
+    model = CostModel()
+    library = {**SMILES, **{f"ethanol_{i}": SMILES["ethanol"] for i in range(3)},
+               **{f"benzene_{i}": SMILES["benzene"] for i in range(3)}}
+    params = prepared_params(library)
+    costs = {p.ligand_name: model.predict(ligand_features(p.ligand_pdbqt_string)) for p in params}
+    chunks = schedule(CostScheduler(model, nproc=1, chunksize=4), params)
+    assert sorted(name for chunk in chunks for name in chunk) == sorted(library)
+    # every chunk starts with the most expensive ligand left, the flexible ones are docked alone
+    assert chunks[0] == ["dodecyl_ester"]
+    assert [costs[chunk[0]] for chunk in chunks] == sorted((costs[chunk[0]] for chunk in chunks), reverse=True)
+    assert all(len(chunk) == 1 for chunk in chunks if costs[chunk[0]] > costs["ethanol"])
+    # the rigid ones are grouped
+    assert len(chunks) < len(library)
+
+
+def test_unparseable_smiles_gets_the_default_cost():
+    model = CostModel()
+    params = prepared_params({"broken": "C1CC(", "decanol": SMILES["decanol"], "ethanol": SMILES["ethanol"]})
+    assert params[0].prep_error and not params[0].ligand_pdbqt_string
+    scheduler = CostScheduler(model, nproc=1, max_chunk=1)
+    assert scheduler.ligand_features(params[0]) == (0, 0)
+    assert scheduler.ligand_features(TaskParam(conf_yaml_file="conf.yaml", receptor_pdbqt="receptor.pdbqt",
+                                               ligand_name="missing", ligand_pdbqt_file="missing.pdbqt")) == (0, 0)
+    assert ligand_features("TORSDOF\n") == (0, 0)
+    # ranked below every prepared ligand, and still docked to report the failure
+    assert schedule(scheduler, params) == [["decanol"], ["ethanol"], ["broken"]]
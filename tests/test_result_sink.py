@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/20 10:48
+# @Author : yuyeqing
+# @File   : test_result_sink.py
+# @IDE    : PyCharm
+import pytest
+import pandas as pd
+from utils.result_sink import ResultSink, ParquetResultSink, select_best, merge_results
+
+
+def result(task_id: int, opt_energy: float = None):
+    ret = {"task_id": task_id, "ligand_name": f"lig-{task_id}", "log": ""}
+    if opt_energy is not None:
+        ret.update(opt_energy=opt_energy, energies=[[opt_energy]])
+    return ret
+
+
+def test_result_sink_is_abstract(tmp_path):
+    with pytest.raises(TypeError):
+        ResultSink(tmp_path)
+
+
+def test_parquet_part_appears_on_close(tmp_path):
+    sink = ParquetResultSink(tmp_path, batch_size=1)
+    sink.write(result(0, -7.))
+    # a crash now leaves only a hidden temporary file, which readers skip
+    assert list((tmp_path / "results").glob("part-*.parquet")) == []
+    assert pd.read_parquet(tmp_path / "results").empty
+    sink.write(result(1, -9.))
+    sink.write(result(2))
+    sink.close()
+    assert [p.name for p in (tmp_path / "results").iterdir()] == ["part-00000.parquet"]
+    assert select_best("parquet", tmp_path, n=2) == [1, 0]
+
+
+def test_unreadable_parts_are_skipped(tmp_path):
+    with ParquetResultSink(tmp_path) as sink:
+        sink.write(result(0, -7.))
+        sink.write(result(1, -9.))
+    # a part without footer, left by a crashed run of an older version
+    (tmp_path / "results" / "part-00001.parquet").write_bytes(b"PAR1 torn")
+    with pytest.warns(UserWarning, match="part-00001.parquet"):
+        assert select_best("parquet", tmp_path, fraction=1.) == [1, 0]
+    skipped = merge_results("parquet", [tmp_path], tmp_path / "merged")
+    assert [p.name for p in skipped] == ["part-00001.parquet"]
+    assert sorted(pd.read_parquet(tmp_path / "merged" / "results").task_id) == [0, 1]
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/14 9:20
+# @Author : yuyeqing
+# @File   : test_run_journal.py
+# @IDE    : PyCharm
+import pytest
+from utils.run_journal import RunJournal
+
+
+@pytest.mark.parametrize("block_size", [4096, 3])
+def test_resume_cuts_a_torn_line(tmp_path, block_size):
+    journal_file = tmp_path / "run_journal.tsv"
+    journal_file.write_text("started\t0\tlig-0\ndone\t0\tlig-0\nstarted\t1\tlig-1\ndo")
+    RunJournal.truncate_torn_line(journal_file, block_size=block_size)
+    assert journal_file.read_text() == "started\t0\tlig-0\ndone\t0\tlig-0\nstarted\t1\tlig-1\n"
+
+    with RunJournal(journal_file, resume=True) as journal:
+        assert journal.is_finished("lig-0") and not journal.is_finished("lig-1")
+        journal.record_result({"task_id": 1, "ligand_name": "lig-1", "opt_energy": -7.})
+    assert RunJournal.load(journal_file) == {"lig-0": RunJournal.DONE, "lig-1": RunJournal.DONE}
+
+
+def test_torn_first_line(tmp_path):
+    journal_file = tmp_path / "run_journal.tsv"
+    journal_file.write_text("start")
+    RunJournal.truncate_torn_line(journal_file)
+    assert journal_file.read_text() == ""
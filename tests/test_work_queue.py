@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/16 10:12
+# @Author : yuyeqing
+# @File   : test_work_queue.py
+# @IDE    : PyCharm
+import time
+import sqlite3
+import threading
+import pandas as pd
+import run_dock
+from pathlib import Path
+from run_dock import RunParam, run_node, wait_for_nodes
+from utils.work_queue import WorkQueue, LeasedTasks
+from utils.result_sink import SQLiteResultSink, merge_results
+from pose_archive import PoseArchive, PoseArchiveWriter, merge_pose_archives
+
+LIGANDS = ["CCO", "CCN", "CCC", "c1ccccc1", "CC(=O)O", "CCOC"]
+
+
+def fake_result(task_id: int, name: str, node: str):
+    return {"task_id": task_id, "ligand_name": name, "opt_energy": -1. - task_id, "energies": [[-1. - task_id]],
+            "log": "", "poses": f"MODEL 1\nREMARK {node}\nENDMDL\n"}
+
+
+def write_node(node_dir: Path, task_ids: list):
+    node_dir.mkdir(parents=True)
+    with SQLiteResultSink(node_dir) as sink, PoseArchiveWriter(node_dir / "poses") as archive:
+        for i in task_ids:
+            ret = fake_result(i, f"lig-{i}", node_dir.name)
+            archive.write(ret["ligand_name"], ret.pop("poses"), ret["opt_energy"])
+            sink.write(ret)
+
+
+def test_expired_lease_is_handed_out_again(tmp_path):
+    queue = WorkQueue(tmp_path / "work_queue.sqlite", lease_seconds=0.2)
+    assert queue.create(4, 2)
+    chunk = queue.lease("dead")
+    assert queue.lease("live")[0] != chunk[0]
+    assert queue.lease("live") is None
+    # the dead node never renews its lease
+    time.sleep(0.3)
+    assert queue.lease("live") == chunk
+    queue.close()
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    queue = WorkQueue(tmp_path / "work_queue.sqlite", lease_seconds=0.3)
+    queue.create(1, 1)
+    leased = LeasedTasks(queue, "live")
+    chunks = leased.iter_chunks()
+    chunk_id, task_range = next(chunks)
+    leased.add(chunk_id, task_range.start)
+    other = WorkQueue(tmp_path / "work_queue.sqlite", lease_seconds=0.3)
+    try:
+        assert other.lease("other") is None
+        # several lease periods: the heartbeat thread renews the chunk in between
+        time.sleep(1.)
+        assert other.lease("other") is None
+    finally:
+        leased.close()
+    time.sleep(0.4)
+    assert other.lease("other")[0] == chunk_id
+    other.close()
+    queue.close()
+
+
+def test_merge_keeps_one_row_and_pose_per_ligand(tmp_path):
+    # task 1 was docked by node-a, its chunk expired and node-b docked it again
+    write_node(tmp_path / "nodes" / "node-a", [0, 1])
+    write_node(tmp_path / "nodes" / "node-b", [1, 2, 3])
+    node_dirs = sorted((tmp_path / "nodes").iterdir())
+    assert merge_results("sqlite", node_dirs, tmp_path) == []
+    merge_pose_archives([p / "poses" for p in node_dirs], tmp_path / "poses")
+
+    with sqlite3.connect(tmp_path / "results.sqlite") as conn:
+        rows = conn.execute("SELECT task_id, COUNT(*) FROM results GROUP BY task_id").fetchall()
+    assert rows == [(0, 1), (1, 1), (2, 1), (3, 1)]
+    with sqlite3.connect(tmp_path / "poses" / "index.sqlite") as conn:
+        names = [name for name, in conn.execute("SELECT name FROM poses ORDER BY name")]
+    assert names == ["lig-0", "lig-1", "lig-2", "lig-3"]
+    archive = PoseArchive(tmp_path / "poses")
+    assert "node-a" in archive.get("lig-0")
+    assert "node-b" in archive.get("lig-1")
+    archive.close()
+
+
+def test_wait_for_nodes(tmp_path):
+    queue = WorkQueue(tmp_path / "work_queue.sqlite", lease_seconds=0.5)
+    queue.create(2, 1)
+    for owner in ["closed", "crashed", "writing"]:
+        (tmp_path / "nodes" / owner).mkdir(parents=True)
+        queue.heartbeat(owner)
+        queue.complete(queue.lease(owner)[0] if owner != "crashed" else 0, owner)
+    (tmp_path / "nodes" / "closed" / "closed").touch()
+    # a node that still renews its heartbeat is waited for until it has closed its results
+    timer = threading.Timer(0.6, lambda: (tmp_path / "nodes" / "writing" / "closed").touch())
+    timer.start()
+    start = time.time()
+    wait_for_nodes(queue, tmp_path / "nodes", poll_seconds=0.05)
+    assert time.time() - start >= 0.5
+    timer.join()
+    queue.close()
+
+
+def test_run_node_takes_over_a_dead_node(tmp_path, monkeypatch):
+    smiles_csv = tmp_path / "ligands.csv"
+    pd.DataFrame({"name": [f"lig-{i}" for i in range(len(LIGANDS))], "SMILES": LIGANDS}).to_csv(smiles_csv,
+                                                                                              index=False)
+    monkeypatch.setattr(run_dock, "init_vina_worker", lambda *args: None)
+    monkeypatch.setattr(run_dock, "prepare_one_task", lambda param: param)
+    monkeypatch.setattr(run_dock, "process_one_task",
+                        lambda param: fake_result(param.task_id, param.ligand_name, "live"))
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    # the dead node leased the first chunk, docked one of its ligands and stopped
+    queue = WorkQueue(out_dir / "work_queue.sqlite", lease_seconds=0.5)
+    queue.create(len(LIGANDS), 2)
+    queue.heartbeat("dead")
+    assert queue.lease("dead")[0] == 0
+    write_node(out_dir / "nodes" / "dead", [0])
+
+    run = RunParam(conf_yaml_file="conf.yaml", smiles_csv=str(smiles_csv), receptor_pdbqt="receptor.pdbqt",
+                   out_dir=out_dir, nproc=1, prep_nproc=1, pose_output="archive")
+    run_node(run, "live", chunk_size=2, lease_seconds=0.5)
+
+    assert queue.all_done()
+    with sqlite3.connect(out_dir / "results.sqlite") as conn:
+        rows = conn.execute("SELECT task_id, COUNT(*) FROM results GROUP BY task_id").fetchall()
+    assert rows == [(i, 1) for i in range(len(LIGANDS))]
+    archive = PoseArchive(out_dir / "poses")
+    assert len(archive) == len(LIGANDS)
+    assert "live" in archive.get("lig-0")
+    archive.close()
+    queue.close()
@@ -4,8 +4,15 @@
 # @Author : yuyeqing
 # @File   : adgpu_output_xml_parser.py
 # @IDE    : PyCharm
-import argparse
+import os
+import re
+import click
+import numpy as np
+import pandas as pd
 import xml.etree.ElementTree as ET
+from pathlib import Path
+from collections import Counter
+from multiprocessing import Pool
 
 def extract_free_nrg_binding(xml_file):
     # 解析 XML 文件
@@ -28,11 +35,238 @@ def extract_free_nrg_binding(xml_file):
     return ret
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Parse AutoDock-GPU output XML file.")
-    parser.add_argument("xml_file", help="Path to the AutoDock-GPU output XML file.")
-    args = parser.parse_args()
+ENERGY_TERMS = ('free_NRG_binding', 'final_intermol_NRG', 'internal_ligand_NRG', 'torsonial_free_NRG')
+# DLG lines of the same four terms, only the DOCKED: records of the docked poses are read
+DLG_RUN = re.compile(r'DOCKED: USER    Run = +(\d+)')
+DLG_ENERGY_TERMS = tuple(re.compile(rf'DOCKED: USER    {re.escape(term)} += *([-+\d.]+)') for term in (
+    'Estimated Free Energy of Binding', '(1) Final Intermolecular Energy',
+    '(2) Final Total Internal Energy', '(3) Torsional Free Energy'))
+
+
+def parse_xml(xml_file):
+    """
+    Stream one AutoDock-GPU xml with iterparse, dropping every element once it is read.
+
+    :return: Dict of numpy arrays: run_ids (n_runs,), energies (n_runs, 4) in ENERGY_TERMS order,
+             ranks (n_runs, 2) cluster rank / sub rank, rmsd (n_runs, 2) cluster / reference rmsd,
+             clusters (n_clusters, 5) rank, lowest energy, run, mean energy, size.
+    """
+    run_ids, energies, ranks, rmsd, clusters = [], [], dict(), dict(), []
+    for _, elem in ET.iterparse(xml_file, events=('end',)):
+        if elem.tag == 'run' and 'id' in elem.attrib:
+            # <runs><run id="1">
+            run_ids.append(int(elem.get('id')))
+            energies.append([float(elem.findtext(term)) for term in ENERGY_TERMS])
+        elif elem.tag == 'run' and 'rank' in elem.attrib:
+            # <rmsd_table><run rank="1" sub_rank="1" run="7" .../>
+            run_id = int(elem.get('run'))
+            ranks[run_id] = (int(elem.get('rank')), int(elem.get('sub_rank')))
+            rmsd[run_id] = (float(elem.get('cluster_rmsd')), float(elem.get('reference_rmsd')))
+        elif elem.tag == 'cluster':
+            clusters.append((int(elem.get('cluster_rank')), float(elem.get('lowest_binding_energy')),
+                             int(elem.get('run')), float(elem.get('mean_binding_energy')),
+                             int(elem.get('num_in_clus'))))
+        else:
+            # parents of the runs and clusters, their children are already dropped
+            continue
+        elem.clear()
+    return {
+        'run_ids': np.array(run_ids, dtype=np.int32),
+        'energies': np.array(energies, dtype=np.float64).reshape(-1, len(ENERGY_TERMS)),
+        'ranks': np.array([ranks.get(r, (0, 0)) for r in run_ids], dtype=np.int32).reshape(-1, 2),
+        'rmsd': np.array([rmsd.get(r, (np.nan, np.nan)) for r in run_ids], dtype=np.float64).reshape(-1, 2),
+        'clusters': np.array(clusters, dtype=np.float64).reshape(-1, 5),
+    }
+
+
+def parse_dlg(dlg_file, best_run: int = None):
+    """
+    Read one AutoDock-GPU dlg, only the atoms of the best pose are parsed.
+
+    :param best_run: Run whose pose coordinates are kept. If None, the energies are read with regular
+                     expressions over the whole text and the run with the lowest free energy of binding is kept.
+    :return: Dict with the coordinates (n_atoms, 3) of the best pose, and if `best_run` is None, also
+             run_ids (n_runs,) and energies (n_runs, 4) in ENERGY_TERMS order.
+    """
+    with open(dlg_file, 'r') as f:
+        text = f.read()
+    ret = dict()
+    if best_run is None:
+        run_ids = np.array(DLG_RUN.findall(text), dtype=np.int32)
+        energies = np.full((len(run_ids), len(DLG_ENERGY_TERMS)), np.nan)
+        for i, term in enumerate(DLG_ENERGY_TERMS):
+            values = term.findall(text)
+            if len(values) == len(run_ids):
+                energies[:, i] = np.array(values, dtype=np.float64)
+        if len(run_ids):
+            best_run = int(run_ids[np.nanargmin(energies[:, 0])])
+        ret = {'run_ids': run_ids, 'energies': energies}
+    coords = []
+    start = text.find(f"DOCKED: USER    Run = {best_run}\n") if best_run is not None else -1
+    if start >= 0:
+        end = text.find("DOCKED: ENDMDL", start)
+        for line in text[start:end if end >= 0 else len(text)].splitlines():
+            if line.startswith(('DOCKED: ATOM', 'DOCKED: HETATM')):
+                coords.append((line[38:46], line[46:54], line[54:62]))
+    ret['coords'] = np.array(coords, dtype=np.float32).reshape(-1, 3)
+    return ret
+
+
+def parse_output(path):
+    """
+    Parse the outputs of one ligand, `path` being its xml or dlg file; the other one is used when present,
+    the xml for energies, ranks and clusters, the dlg for the best pose.
+
+    :return: (name, dict of numpy arrays), see `parse_xml` and `parse_dlg`, best_run is the run of the best pose.
+    """
+    path = Path(path)
+    xml_file, dlg_file = path.with_suffix('.xml'), path.with_suffix('.dlg')
+    ret = dict()
+    if xml_file.exists():
+        ret = parse_xml(xml_file)
+    best_run = None
+    if len(ret.get('run_ids', [])):
+        best_run = int(ret['run_ids'][np.argmin(ret['energies'][:, 0])])
+    if dlg_file.exists():
+        dlg = parse_dlg(dlg_file, best_run=best_run)
+        if not ret:
+            ret = dlg
+            best_run = int(ret['run_ids'][np.nanargmin(ret['energies'][:, 0])]) if len(ret['run_ids']) else None
+        ret['coords'] = dlg['coords']
+    ret['best_run'] = best_run
+    return path.stem, ret
+
+
+def _parse_output_safe(path):
+    try:
+        return parse_output(path)
+    except Exception as e:
+        return Path(path).stem, {'error': f"{path}: {e}"}
+
+
+def iter_named_output_files(paths):
+    """
+    Outputs of `paths`, files or directories searched recursively; a ligand with both an xml and a dlg is listed once.
 
-    results = extract_free_nrg_binding(args.xml_file)
-    for r in results:
-        print(r)
+    :return: Iterator of (name, file), the name of a ligand found in a directory is its path relative to the
+             directory without suffix, e.g. `batch_1/lig-1`, so equal file names in subdirectories stay apart;
+             the name of a given file is its stem.
+    """
+    for path in map(Path, paths):
+        if path.is_dir():
+            for root, _, files in os.walk(path):
+                names = set(files)
+                for file in sorted(files):
+                    if file.endswith('.xml') or (file.endswith('.dlg') and file[:-4] + '.xml' not in names):
+                        yield (Path(root) / file).relative_to(path).with_suffix('').as_posix(), Path(root) / file
+        else:
+            yield path.stem, path
+
+
+def iter_output_files(paths):
+    for _, file in iter_named_output_files(paths):
+        yield file
+
+
+def parse_outputs(paths, nproc: int = 1, chunksize: int = 64):
+    """
+    Parse many AutoDock-GPU outputs in parallel into tables.
+
+    :param paths: xml / dlg files or directories.
+    :param nproc: Number of parsing processes.
+    :return: (runs, ligands, coords): DataFrame of all runs with name, run, energies, ranks and rmsd;
+             DataFrame with one row per ligand with its best run, energy and cluster info;
+             dict name -> (n_atoms, 3) coordinates of the best pose, from the dlg files.
+             Names are those of `iter_named_output_files`.
+    """
+    named_files = list(iter_named_output_files(paths))
+    names = [name for name, _ in named_files]
+    duplicates = sorted(name for name, count in Counter(names).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"ligand names found more than once, e.g. {duplicates[:3]}, "
+                         f"parse the directories separately or pass their parent directory")
+    files = [file for _, file in named_files]
+    if nproc > 1:
+        with Pool(nproc) as p:
+            parsed = p.map(_parse_output_safe, files, chunksize=chunksize)
+    else:
+        parsed = list(map(_parse_output_safe, files))
+
+    run_names, run_ids, energies, ranks, rmsd, ligands, coords = [], [], [], [], [], [], dict()
+    for name, (_, ret) in zip(names, parsed):
+        if 'error' in ret:
+            click.echo(ret['error'], err=True)
+            continue
+        n_runs = len(ret['run_ids'])
+        run_names.append(np.full(n_runs, name, dtype=object))
+        run_ids.append(ret['run_ids'])
+        energies.append(ret['energies'])
+        ranks.append(ret.get('ranks', np.zeros((n_runs, 2), dtype=np.int32)))
+        rmsd.append(ret.get('rmsd', np.full((n_runs, 2), np.nan)))
+        clusters = ret.get('clusters', np.zeros((0, 5)))
+        best = int(np.nanargmin(ret['energies'][:, 0])) if n_runs else None
+        ligands.append({
+            'name': name,
+            'n_runs': n_runs,
+            'best_run': ret['best_run'],
+            'best_energy': ret['energies'][best, 0] if n_runs else np.nan,
+            'n_clusters': len(clusters),
+            'top_cluster_size': int(clusters[0, 4]) if len(clusters) else 0,
+            'top_cluster_mean_energy': clusters[0, 3] if len(clusters) else np.nan,
+        })
+        if len(ret.get('coords', [])):
+            coords[name] = ret['coords']
+
+    def cat(arrays, shape, dtype):
+        return np.concatenate(arrays) if arrays else np.zeros(shape, dtype=dtype)
+
+    energies = cat(energies, (0, len(ENERGY_TERMS)), np.float64)
+    ranks, rmsd = cat(ranks, (0, 2), np.int32), cat(rmsd, (0, 2), np.float64)
+    runs = pd.DataFrame({
+        'name': cat(run_names, (0,), object),
+        'run': cat(run_ids, (0,), np.int32),
+        **{term: energies[:, i] for i, term in enumerate(ENERGY_TERMS)},
+        'cluster_rank': ranks[:, 0],
+        'sub_rank': ranks[:, 1],
+        'cluster_rmsd': rmsd[:, 0],
+        'reference_rmsd': rmsd[:, 1],
+    })
+    ligands = pd.DataFrame(ligands, columns=['name', 'n_runs', 'best_run', 'best_energy', 'n_clusters',
+                                             'top_cluster_size', 'top_cluster_mean_energy'])
+    return runs, ligands.sort_values('best_energy', ignore_index=True), coords
+
+
+def write_table(df: pd.DataFrame, out_file: Path):
+    if out_file.suffix == '.parquet':
+        df.to_parquet(out_file, index=False)
+    else:
+        df.to_csv(out_file, index=False)
+
+
+@click.command("parse-adgpu")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("-n", "--nproc", "nproc", default=1, show_default=True, help="number of parsing processes")
+@click.option("-o", "--out_prefix", "out_prefix", default=None,
+              help="write <prefix>_runs.csv, <prefix>_ligands.csv and <prefix>_poses.npz instead of printing")
+@click.option("--parquet", is_flag=True, help="write the tables as parquet instead of csv")
+def parse_adgpu(paths: tuple, nproc: int = 1, out_prefix: str = None, parquet: bool = False):
+    """Parse AutoDock-GPU xml / dlg outputs, given as files or directories, into per-run and per-ligand tables."""
+    try:
+        runs, ligands, coords = parse_outputs(paths, nproc=nproc)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if out_prefix is None:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+            click.echo(runs if len(ligands) == 1 else ligands)
+        return
+    suffix = '.parquet' if parquet else '.csv'
+    Path(out_prefix).absolute().parent.mkdir(parents=True, exist_ok=True)
+    write_table(runs, Path(f"{out_prefix}_runs{suffix}"))
+    write_table(ligands, Path(f"{out_prefix}_ligands{suffix}"))
+    if coords:
+        np.savez_compressed(f"{out_prefix}_poses.npz", **coords)
+    click.echo(f"{len(ligands)} ligands, {len(runs)} runs written to {out_prefix}_*")
+
+
+if __name__ == '__main__':
+    parse_adgpu()
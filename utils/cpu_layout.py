@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/3 9:15
+# @Author : yuyeqing
+# @File   : cpu_layout.py
+# @IDE    : PyCharm
+import os
+import math
+from pathlib import Path
+
+
+def cgroup_cpu_limit():
+    """
+    CPU quota of the cgroup of this process in cores, None if unlimited.
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = Path("/sys/fs/cgroup/cpu.max")
+    if cpu_max.exists():
+        quota, period = cpu_max.read_text().split()[:2]
+        if quota != "max":
+            return max(1, math.floor(int(quota) / int(period)))
+        return None
+    # cgroup v1
+    quota_file = Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period_file = Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota_file.exists() and period_file.exists():
+        quota, period = int(quota_file.read_text()), int(period_file.read_text())
+        if quota > 0:
+            return max(1, math.floor(quota / period))
+    return None
+
+
+def available_cores():
+    """
+    Cores this process may run on, respecting the affinity mask and the cgroup quota.
+
+    :return: Sorted list of core ids.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cores = cores[:limit]
+    return cores
+
+
+def docking_cores(cores: list, prep_nproc: int):
+    """
+    Cores left for docking when every ligand preparation process keeps one, at least one core.
+    The preparation processes are not pinned, they run on the cores no docking worker is pinned to.
+    """
+    n_prep = min(max(prep_nproc, 0), len(cores) - 1)
+    return cores[:len(cores) - n_prep]
+
+
+def candidate_layouts(n_cores: int, exhaustiveness: int = 8):
+    """
+    Splits of `n_cores` into processes x Vina threads that use every core once.
+
+    Vina runs the `exhaustiveness` Monte Carlo searches of one ligand in parallel, so more threads
+    than `exhaustiveness` stay idle.
+
+    :return: List of (nproc, cpu), most processes first.
+    """
+    layouts = []
+    for cpu in range(1, max(1, min(n_cores, exhaustiveness)) + 1):
+        if n_cores % cpu == 0:
+            layouts.append((n_cores // cpu, cpu))
+    return layouts
+
+
+def default_layout(n_cores: int):
+    """
+    Layout used without calibration: one single-threaded process per core. Parallelism across
+    ligands scales better than Vina threads, which wait for the slowest search of each ligand.
+    """
+    return n_cores, 1
+
+
+def core_sets(cores: list, nproc: int, cpu: int):
+    """
+    Split `cores` into `nproc` disjoint sets of `cpu` cores, one per worker.
+    """
+    return [cores[i * cpu:(i + 1) * cpu] for i in range(nproc)]
+
+
+def pin_worker(core_queue):
+    """
+    Pin the calling worker process to the next free core set of `core_queue`.
+
+    :return: The core set, None if no set is left (e.g. a restarted worker) or pinning is unsupported.
+    """
+    if core_queue is None or not hasattr(os, "sched_setaffinity"):
+        return None
+    try:
+        cores = core_queue.get_nowait()
+    except Exception:
+        return None
+    os.sched_setaffinity(0, cores)
+    return cores
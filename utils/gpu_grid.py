@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/9 14:20
+# @Author : yuyeqing
+# @File   : gpu_grid.py
+# @IDE    : PyCharm
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from pathlib import Path
+from utils.timing import timed
+from utils.tool_version import executable_sha256
+
+# AD4 types of typical drug-like ligands, grids are built for all of them up front
+DEFAULT_LIGAND_TYPES = ('A', 'C', 'HD', 'N', 'NA', 'OA', 'SA', 'S', 'P', 'F', 'Cl', 'Br', 'I')
+
+
+def executable(config: dict, name: str):
+    """
+    Path of an external tool, `executables: {autogrid4: /path/to/stub}` in the config overrides PATH.
+    """
+    return str(config.get('executables', dict()).get(name, name))
+
+
+def ligand_atom_types(pdbqt_string: str):
+    """
+    AD4 atom types of a ligand pdbqt, the last column of its ATOM / HETATM records.
+    """
+    types = set()
+    for line in pdbqt_string.splitlines():
+        if line.startswith(('ATOM', 'HETATM')):
+            fields = line.split()
+            if fields:
+                types.add(fields[-1])
+    return types
+
+
+def grid_cache_key(receptor_pdbqt: str, config: dict, ligand_types):
+    """
+    Hash of the receptor, the box, the ligand types and the prepare_gpf4 / autogrid4 executables,
+    so maps of another AutoGrid installation are not reused.
+    """
+    h = hashlib.sha256()
+    with open(receptor_pdbqt, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    grid = {
+        'npts': [int(x) for x in config['npts']],
+        'center': [float(x) for x in config['center']],
+        'spacing': float(config['spacing']),
+        'ligand_types': sorted(ligand_types),
+        # neither tool reports a version
+        'executables': {name: executable_sha256(executable(config, name)) for name in ('prepare_gpf4', 'autogrid4')},
+    }
+    h.update(json.dumps(grid, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def build_grid(receptor_pdbqt: str, config: dict, ligand_types, grid_dir: Path):
+    """
+    Run prepare_gpf4 and autogrid4 for the receptor in `grid_dir`.
+
+    :return: Path of the receptor.maps.fld file.
+    """
+    # link instead of copying, the receptor is only read while the maps are built
+    try:
+        os.symlink(Path(receptor_pdbqt).absolute(), grid_dir / "receptor.pdbqt")
+    except OSError:
+        shutil.copy(receptor_pdbqt, grid_dir / "receptor.pdbqt")
+    with timed('gpf'):
+        subprocess.run([
+            executable(config, 'prepare_gpf4'),
+            '-r', 'receptor.pdbqt',
+            '-o', 'receptor.gpf',
+            '-p', f"ligand_types={','.join(sorted(ligand_types))}",
+            '-p', f"npts={','.join(map(str, config['npts']))}",
+            '-p', f"gridcenter={','.join(map(str, config['center']))}",
+            '-p', f"spacing={config['spacing']}"],
+            check=True, cwd=grid_dir, capture_output=True, text=True
+        )
+    with timed('autogrid'):
+        subprocess.run([
+            executable(config, 'autogrid4'),
+            '-p', 'receptor.gpf',
+            '-l', 'receptor.glg'],
+            check=True, cwd=grid_dir, capture_output=True, text=True
+        )
+    return grid_dir / "receptor.maps.fld"
+
+
+def cached_grid(receptor_pdbqt: str, config: dict, grid_cache_dir: str, ligand_types=DEFAULT_LIGAND_TYPES):
+    """
+    AutoGrid maps of the receptor and box for `ligand_types`, built once and shared by all ligands,
+    workers and runs. Entries are built in a temporary directory and renamed into place.
+
+    :param receptor_pdbqt: Path to the receptor pdbqt file.
+    :param config: Docking config with npts, center and spacing.
+    :param grid_cache_dir: Root directory of the grid cache.
+    :param ligand_types: AD4 ligand atom types the maps are built for.
+    :return: Path of the receptor.maps.fld file to pass to adgpu --ffile.
+    """
+    key = grid_cache_key(receptor_pdbqt, config, ligand_types)
+    entry = Path(grid_cache_dir).absolute() / key
+    if entry.exists():
+        return entry / "receptor.maps.fld"
+
+    Path(grid_cache_dir).mkdir(parents=True, exist_ok=True)
+    tmp_entry = Path(tempfile.mkdtemp(prefix=f".{key}.", dir=grid_cache_dir))
+    try:
+        build_grid(receptor_pdbqt, config, ligand_types, tmp_entry)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another process finished the same entry first
+            if not entry.exists():
+                raise
+    finally:
+        if tmp_entry.exists():
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+    return entry / "receptor.maps.fld"
+
+
+class GridSet:
+    """
+    Grid maps of one worker. Starts with the default ligand types and switches to maps for the
+    union of all types seen so far when a ligand brings a type the current maps lack.
+    """
+
+    def __init__(self, receptor_pdbqt: str, config: dict, grid_cache_dir: str):
+        self.receptor_pdbqt = receptor_pdbqt
+        self.config = config
+        self.grid_cache_dir = grid_cache_dir
+        self.ligand_types = set(DEFAULT_LIGAND_TYPES)
+        self.fld_file = None
+
+    def fld_for(self, ligand_pdbqt_string: str):
+        return self.fld_for_types(ligand_atom_types(ligand_pdbqt_string))
+
+    def fld_for_types(self, types: set):
+        if self.fld_file is None or not types <= self.ligand_types:
+            self.ligand_types |= types
+            self.fld_file = cached_grid(self.receptor_pdbqt, self.config, self.grid_cache_dir, self.ligand_types)
+        return self.fld_file
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/7/4 10:30
+# @Author : yuyeqing
+# @File   : library_prep.py
+# @IDE    : PyCharm
+import json
+import click
+import sqlite3
+import hashlib
+import itertools
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from pathlib import Path
+from multiprocessing import Pool
+from utils.ligand_reader import iter_ligands
+from utils.ligand_cost import CostModel
+from utils.result_sink import read_parquet_results
+
+PROPERTIES = ['heavy_atoms', 'rotatable_bonds', 'mw', 'charge']
+MAP_COLUMNS = ['row', 'name', 'SMILES', 'canonical', *PROPERTIES, 'status', 'task_id', 'representative']
+
+# statuses of the library map, filtered rows get `filtered:<property>`
+KEPT = 'kept'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+
+
+def standardize_smiles(smiles: str, tautomers: bool = False):
+    """
+    Standardise a SMILES with RDKit: cleanup (normalisation, reionisation, metal disconnection), the largest
+    organic fragment by heavy atoms instead of the longest string, neutralisation and optionally the
+    canonical tautomer.
+
+    :return: (canonical SMILES, heavy atoms, rotatable bonds, molecular weight, formal charge),
+             None if RDKit can not parse the SMILES.
+    """
+    from rdkit import Chem
+    from rdkit.Chem import Descriptors, rdMolDescriptors
+    from rdkit.Chem.MolStandardize import rdMolStandardize
+
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return None
+    mol = rdMolStandardize.Cleanup(mol)
+    mol = rdMolStandardize.LargestFragmentChooser(preferOrganic=True).choose(mol)
+    mol = rdMolStandardize.Uncharger().uncharge(mol)
+    if tautomers:
+        mol = rdMolStandardize.TautomerEnumerator().Canonicalize(mol)
+    return (Chem.MolToSmiles(mol), mol.GetNumHeavyAtoms(), rdMolDescriptors.CalcNumRotatableBonds(mol),
+            Descriptors.MolWt(mol), Chem.GetFormalCharge(mol))
+
+
+def _standardize_chunk(args):
+    smiles_list, tautomers = args
+    from rdkit import RDLogger
+
+    # RDKit logs every standardisation step otherwise
+    RDLogger.DisableLog('rdApp.*')
+    rows = []
+    for smiles in smiles_list:
+        try:
+            rows.append(standardize_smiles(smiles, tautomers))
+        except Exception:
+            rows.append(None)
+    return rows
+
+
+def filter_mask(df: pd.DataFrame, filters: dict):
+    """
+    Vectorised property filters.
+
+    :param filters: Property to [min, max], either may be None, e.g. {'mw': [None, 500], 'charge': [-2, 2]}.
+    :return: Series with the first property a row fails, None for rows passing all filters.
+    """
+    failed = pd.Series(None, index=df.index, dtype=object)
+    for prop, (lo, hi) in (filters or dict()).items():
+        if prop not in PROPERTIES:
+            raise ValueError(f"Unknown filter {prop}, choose from {PROPERTIES}")
+        out = pd.Series(False, index=df.index)
+        if lo is not None:
+            out |= df[prop] < lo
+        if hi is not None:
+            out |= df[prop] > hi
+        failed = failed.mask(failed.isna() & out, prop)
+    return failed
+
+
+def canonical_key(canonical: str):
+    # 8 bytes per unique molecule instead of its SMILES, collisions are negligible below billions of molecules
+    return int.from_bytes(hashlib.blake2b(canonical.encode(), digest_size=8).digest(), 'little')
+
+
+def preprocess_library(smiles_file: str, out_dir: str, filters: dict = None, nproc: int = 1,
+                       chunksize: int = 10000, tautomers: bool = False):
+    """
+    Pre-process a ligand library before any 3D work: standardise and canonicalise every SMILES, drop rows
+    failing the property `filters` and dedupe, so every unique molecule is prepared and docked once.
+
+    Writes to `out_dir`:
+        library.csv       the unique molecules to dock, `name` of their first occurrence and canonical `SMILES`
+        library_map.csv   every input row with its properties, status (kept, duplicate, invalid or
+                          filtered:<property>) and `task_id` / `representative` of its row in library.csv,
+                          used to fan the results out to every name
+        library_report.json
+
+    :param smiles_file: Ligand library in any format of `iter_ligands`.
+    :param filters: Property to [min, max] of `filter_mask`.
+    :param nproc: Number of standardisation processes.
+    :param chunksize: Rows per chunk, output is written chunk by chunk.
+    :param tautomers: Also canonicalise tautomers, slower but catches duplicate tautomers.
+    :return: The report dict.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    library_file, map_file = out_dir / "library.csv", out_dir / "library_map.csv"
+    # canonical key -> (task_id, name) of the first occurrence
+    seen = dict()
+    counts = {'input': 0, INVALID: 0, DUPLICATE: 0, KEPT: 0}
+    filtered = dict()
+    model = CostModel()
+    cost = {'valid': 0., 'docked': 0.}
+
+    ligands = iter_ligands(smiles_file, chunksize)
+    chunks = iter(lambda: list(itertools.islice(ligands, chunksize)), [])
+    with Pool(max(nproc, 1)) as p, open(library_file, 'w', newline='') as library_f, \
+            open(map_file, 'w', newline='') as map_f:
+        pd.DataFrame(columns=['name', 'SMILES']).to_csv(library_f, index=False)
+        pd.DataFrame(columns=MAP_COLUMNS).to_csv(map_f, index=False)
+        for chunk in tqdm(chunks, desc="standardise", unit="chunk"):
+            rows, names, smiles = zip(*chunk)
+            # split across the workers, imap keeps the order so the first occurrence is deterministic
+            step = -(-len(smiles) // max(nproc, 1))
+            parts = [list(smiles[i:i + step]) for i in range(0, len(smiles), step)]
+            std = [r for part in p.imap(_standardize_chunk, ((part, tautomers) for part in parts)) for r in part]
+
+            df = pd.DataFrame({'row': rows, 'name': names, 'SMILES': smiles})
+            valid = np.array([r is not None for r in std])
+            props = pd.DataFrame([r if r is not None else (None, np.nan, np.nan, np.nan, np.nan) for r in std],
+                                 columns=['canonical', *PROPERTIES])
+            df = pd.concat([df, props], axis=1)
+            df['status'] = np.where(valid, KEPT, INVALID)
+            failed = filter_mask(df, filters)
+            is_filtered = valid & failed.notna().to_numpy()
+            df.loc[is_filtered, 'status'] = 'filtered:' + failed[is_filtered]
+
+            df['task_id'] = pd.Series(pd.NA, index=df.index, dtype='Int64')
+            df['representative'] = None
+            new_rows = []
+            for i in np.flatnonzero(df.status.to_numpy() == KEPT):
+                key = canonical_key(df.at[i, 'canonical'])
+                if key in seen:
+                    df.at[i, 'status'] = DUPLICATE
+                else:
+                    seen[key] = (len(seen), df.at[i, 'name'])
+                    new_rows.append(i)
+                df.at[i, 'task_id'], df.at[i, 'representative'] = seen[key]
+
+            df.loc[new_rows, ['name', 'canonical']].rename(columns={'canonical': 'SMILES'}) \
+                .to_csv(library_f, index=False, header=False)
+            df.astype({'heavy_atoms': 'Int64', 'rotatable_bonds': 'Int64', 'charge': 'Int64'})[MAP_COLUMNS] \
+                .to_csv(map_f, index=False, header=False, float_format='%.3f')
+
+            counts['input'] += len(df)
+            for status, n in df.status.value_counts().items():
+                if status.startswith('filtered:'):
+                    filtered[status.split(':', 1)[1]] = filtered.get(status.split(':', 1)[1], 0) + int(n)
+                else:
+                    counts[status] += int(n)
+            # prior of the cost model on torsions and heavy atoms, rotatable bonds stand in for torsions
+            t, h = df.rotatable_bonds.to_numpy(), df.heavy_atoms.to_numpy()
+            w = model.weights
+            costs = np.maximum(w[0] + w[1] * t + w[2] * h + w[3] * t * h, 1e-3)
+            cost['valid'] += float(costs[valid].sum())
+            cost['docked'] += float(costs[df.status.to_numpy() == KEPT].sum())
+
+    n_docked = counts[KEPT]
+    report = {
+        'input': counts['input'],
+        'invalid': counts[INVALID],
+        'filtered': filtered,
+        'duplicates': counts[DUPLICATE],
+        'docked': n_docked,
+        'saved_docking_runs': counts['input'] - n_docked,
+        'saved_fraction': round(1 - n_docked / counts['input'], 4) if counts['input'] else 0.,
+        # relative to docking every valid row, weighted by the prior of the cost model
+        'saved_cost_fraction': round(1 - cost['docked'] / cost['valid'], 4) if cost['valid'] else 0.,
+        'filters': filters or dict(),
+        'tautomers': tautomers,
+    }
+    with open(out_dir / "library_report.json", 'w') as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def format_report(report: dict):
+    filtered = ", ".join(f"{k}: {v}" for k, v in report['filtered'].items()) or "none"
+    return (f"library: {report['input']} rows, {report['invalid']} invalid, filtered {filtered}, "
+            f"{report['duplicates']} duplicates -> {report['docked']} molecules to dock, "
+            f"{report['saved_docking_runs']} docking runs saved ({report['saved_fraction']:.1%}, "
+            f"~{report['saved_cost_fraction']:.1%} of the estimated docking time)")
+
+
+def fan_out_results(results_format: str, result_dir: str, library_dir: str):
+    """
+    Results of every row of the input library from the results of its unique molecule, written to
+    `result_dir/results_by_name.csv`. The best opt_energy over all results of a molecule is used,
+    e.g. of all receptors of an ensemble.
+
+    :return: Path of the written file.
+    """
+    result_dir, library_dir = Path(result_dir), Path(library_dir)
+    if results_format == 'sqlite':
+        conn = sqlite3.connect(result_dir / "results.sqlite")
+        results = pd.read_sql_query("SELECT task_id, MIN(opt_energy) AS opt_energy FROM results "
+                                    "WHERE status = 'done' GROUP BY task_id", conn)
+        conn.close()
+    elif results_format == 'parquet':
+        results = read_parquet_results(result_dir, ['task_id', 'status', 'opt_energy'])
+        results = results[results.status == 'done'].groupby('task_id', as_index=False).opt_energy.min()
+    else:
+        raise ValueError(f"Can not fan out results format {results_format}")
+    mapping = pd.read_csv(library_dir / "library_map.csv", dtype={'task_id': 'Int64'})
+    results['task_id'] = results.task_id.astype('Int64')
+    out_file = result_dir / "results_by_name.csv"
+    mapping[['row', 'name', 'SMILES', 'status', 'representative', 'task_id']] \
+        .merge(results, on='task_id', how='left').to_csv(out_file, index=False)
+    return out_file
+
+
+@click.command("prep-library")
+@click.argument("smiles_file", type=click.Path(exists=True))
+@click.argument("out_dir", type=click.Path())
+@click.option("-n", "--nproc", "nproc", default=3, help="number of processes", show_default=True)
+@click.option("--max-heavy-atoms", "max_heavy_atoms", default=None, type=int, help="drop larger molecules")
+@click.option("--min-heavy-atoms", "min_heavy_atoms", default=None, type=int, help="drop smaller molecules")
+@click.option("--max-rotatable-bonds", "max_rotatable_bonds", default=None, type=int,
+              help="drop more flexible molecules")
+@click.option("--max-mw", "max_mw", default=None, type=float, help="drop heavier molecules")
+@click.option("--charge", "charge", default=None, type=(int, int), help="min and max formal charge, e.g. -2 2")
+@click.option("--tautomers", is_flag=True, help="canonicalise tautomers too, slower")
+def prep_library(smiles_file: str, out_dir: str, nproc: int = 3, max_heavy_atoms: int = None,
+                 min_heavy_atoms: int = None, max_rotatable_bonds: int = None, max_mw: float = None,
+                 charge: tuple = None, tautomers: bool = False):
+    """Standardise, filter and dedupe SMILES_FILE into OUT_DIR/library.csv, ready for dock-run."""
+    filters = dict()
+    if min_heavy_atoms is not None or max_heavy_atoms is not None:
+        filters['heavy_atoms'] = [min_heavy_atoms, max_heavy_atoms]
+    if max_rotatable_bonds is not None:
+        filters['rotatable_bonds'] = [None, max_rotatable_bonds]
+    if max_mw is not None:
+        filters['mw'] = [None, max_mw]
+    if charge is not None:
+        filters['charge'] = list(charge)
+    report = preprocess_library(smiles_file, out_dir, filters, nproc=nproc, tautomers=tautomers)
+    click.echo(format_report(report))
+    click.echo(f"dock {Path(out_dir) / 'library.csv'}, fan the results out with {Path(out_dir) / 'library_map.csv'}")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/12 10:05
+# @Author : yuyeqing
+# @File   : ligand_cache.py
+# @IDE    : PyCharm
+import os
+import sqlite3
+from pathlib import Path
+
+try:
+    from rdkit import Chem, RDLogger
+    RDLogger.DisableLog('rdApp.*')
+except ImportError:
+    Chem = None
+
+
+def canonical_smiles(smiles: str):
+    """
+    Canonical SMILES used as cache key, the input is returned as-is when RDKit cannot parse it.
+    """
+    if Chem is not None:
+        mol = Chem.MolFromSmiles(smiles)
+        if mol is not None:
+            return Chem.MolToSmiles(mol)
+    return smiles
+
+
+class LigandCache:
+    """
+    Persistent SQLite cache of prepared ligand pdbqt strings.
+
+    Entries are keyed by canonical SMILES and a `prep_key` describing the preparation backend,
+    its version and settings. The database runs in WAL mode, so many worker processes can read
+    and write it concurrently; every process opens its own connection via `get_ligand_cache`.
+    """
+
+    def __init__(self, cache_file: str, timeout: float = 60.):
+        """
+        :param cache_file: Path to the SQLite database, created if it does not exist.
+        :param timeout: Seconds to wait for a write lock held by another process.
+        """
+        self.cache_file = str(cache_file)
+        Path(self.cache_file).absolute().parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.cache_file, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ligands ("
+            " smiles TEXT NOT NULL,"
+            " prep_key TEXT NOT NULL,"
+            " pdbqt TEXT NOT NULL,"
+            " PRIMARY KEY (smiles, prep_key))"
+        )
+
+    def get(self, smiles: str, prep_key: str):
+        row = self.conn.execute("SELECT pdbqt FROM ligands WHERE smiles = ? AND prep_key = ?",
+                                (canonical_smiles(smiles), prep_key)).fetchone()
+        return row[0] if row else None
+
+    def put(self, smiles: str, prep_key: str, pdbqt: str):
+        # the first writer wins, preparation of the same key gives an equivalent ligand
+        self.conn.execute("INSERT OR IGNORE INTO ligands (smiles, prep_key, pdbqt) VALUES (?, ?, ?)",
+                          (canonical_smiles(smiles), prep_key, pdbqt))
+
+    def __contains__(self, item):
+        smiles, prep_key = item
+        return self.get(smiles, prep_key) is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM ligands").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+# connections must not cross fork, so they are kept per process
+_caches = dict()
+
+
+def get_ligand_cache(cache_file: str):
+    """
+    Return the LigandCache of `cache_file` opened by the current process.
+    """
+    key = (os.getpid(), str(Path(cache_file).absolute()))
+    if key not in _caches:
+        _caches[key] = LigandCache(cache_file)
+    return _caches[key]
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/20 9:30
+# @Author : yuyeqing
+# @File   : ligand_cost.py
+# @IDE    : PyCharm
+import heapq
+import threading
+import multiprocessing
+import numpy as np
+
+NON_HEAVY_TYPES = ('H', 'HD', 'HS')
+
+
+def ligand_features(pdbqt_string: str):
+    """
+    Cost features of a ligand pdbqt: (torsions, heavy atoms), torsions from its TORSDOF record,
+    else its BRANCH records.
+    """
+    torsions, heavy_atoms, n_branches = None, 0, 0
+    for line in pdbqt_string.splitlines():
+        if line.startswith(('ATOM', 'HETATM')):
+            fields = line.split()
+            if fields and fields[-1] not in NON_HEAVY_TYPES:
+                heavy_atoms += 1
+        elif line.startswith('BRANCH'):
+            n_branches += 1
+        elif line.startswith('TORSDOF'):
+            try:
+                torsions = int(line.split()[1])
+            except (IndexError, ValueError):
+                pass
+    return (n_branches if torsions is None else torsions), heavy_atoms
+
+
+class CostModel:
+    """
+    Linear model of the docking time of a ligand on (1, torsions, heavy atoms, torsions * heavy atoms).
+
+    Until `min_observations` runtimes are observed it uses `PRIOR`, which only ranks ligands, then it is
+    refit by least squares on all observations so far.
+    """
+    PRIOR = (1., 1., 0.05, 0.02)
+
+    def __init__(self, min_observations: int = 20, refit_every: int = 10, ridge: float = 1e-6):
+        """
+        :param min_observations: Number of observed runtimes before the first fit.
+        :param refit_every: Refit after this many new observations.
+        :param ridge: Regularization keeping the fit stable while the features barely vary.
+        """
+        self.min_observations = min_observations
+        self.refit_every = refit_every
+        self.ridge = ridge
+        self.weights = np.array(self.PRIOR)
+        self.xtx = np.zeros((len(self.PRIOR), len(self.PRIOR)))
+        self.xty = np.zeros(len(self.PRIOR))
+        self.n_observations = 0
+        # bumped on every refit, predictions of an older version are stale
+        self.version = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def design(features):
+        torsions, heavy_atoms = features
+        return np.array([1., torsions, heavy_atoms, torsions * heavy_atoms])
+
+    def predict(self, features):
+        # never zero or negative, a chunk of failed ligands still costs something
+        return max(float(self.design(features) @ self.weights), 1e-3)
+
+    def observe(self, features, seconds: float):
+        x = self.design(features)
+        with self._lock:
+            self.xtx += np.outer(x, x)
+            self.xty += x * seconds
+            self.n_observations += 1
+            if self.n_observations >= self.min_observations and \
+                    (self.n_observations - self.min_observations) % self.refit_every == 0:
+                self.weights = np.linalg.solve(self.xtx + self.ridge * np.eye(len(x)), self.xty)
+                self.version += 1
+
+
+class CostScheduler:
+    """
+    Longest-first scheduling with cost-sized chunks between the preparation and the docking pool.
+
+    Prepared ligands wait in a window of up to `window` ligands, and at most `max_dispatched` chunks
+    are handed to the docking pool at a time, so the order is decided as late as possible. Every chunk
+    starts with the most expensive waiting ligand and takes the next ones while its predicted cost
+    stays below `chunksize` times the mean cost of the window. Once the library is exhausted, chunks
+    shrink to a share of the remaining cost per worker, so no worker is left with a long chunk at the end.
+    Observed docking times refine the model while running.
+    """
+
+    def __init__(self, model: CostModel, nproc: int, chunksize: int = 1, window: int = 1000,
+                 max_chunk: int = None, max_dispatched: int = None):
+        """
+        :param model: The cost model.
+        :param nproc: Number of docking processes.
+        :param chunksize: Target chunk cost in mean ligand costs.
+        :param window: Max number of prepared ligands waiting to be ordered.
+        :param max_chunk: Max number of ligands per chunk, default 4 * chunksize.
+        :param max_dispatched: Max number of chunks in the docking pool, default 2 * nproc.
+        """
+        self.model = model
+        self.nproc = nproc
+        self.chunksize = chunksize
+        self.window = window
+        self.max_chunk = max_chunk or 4 * chunksize
+        self.dispatched = threading.Semaphore(max_dispatched or 2 * nproc)
+        # features of the ligands in flight by task id, used once their runtime is known
+        self.features = dict()
+
+    def ligand_features(self, param):
+        """
+        :return: Features of the prepared ligand, (0, 0), the default cost, when it has no readable pdbqt.
+        """
+        if param.ligand_pdbqt_string:
+            return ligand_features(param.ligand_pdbqt_string)
+        if param.ligand_pdbqt_file:
+            try:
+                with open(param.ligand_pdbqt_file, 'r') as f:
+                    return ligand_features(f.read())
+            except OSError:
+                # reported by the docking stage
+                pass
+        # failed preparation, reported without docking
+        return 0, 0
+
+    def iter_chunks(self, prepared):
+        """
+        :param prepared: Iterator of prepared TaskParams, a pool `imap` iterator is read without blocking
+                         while it has ligands ready.
+        :return: Iterator of lists of TaskParams, the docking units.
+        """
+        heap, version, n_pushed, exhausted = [], self.model.version, 0, False
+        prepared = iter(prepared)
+
+        def push(param):
+            nonlocal n_pushed
+            features = self.ligand_features(param)
+            self.features[param.task_id] = features
+            heapq.heappush(heap, (-self.model.predict(features), n_pushed, param))
+            n_pushed += 1
+
+        while heap or not exhausted:
+            # wait for a free dispatch slot first, ligands prepared meanwhile join the window
+            self.dispatched.acquire()
+            if not heap and not exhausted:
+                try:
+                    push(next(prepared))
+                except StopIteration:
+                    exhausted = True
+            while not exhausted and len(heap) < self.window:
+                try:
+                    push(prepared.next(timeout=0) if hasattr(prepared, 'next') else next(prepared))
+                except multiprocessing.TimeoutError:
+                    break
+                except StopIteration:
+                    exhausted = True
+            if not heap:
+                self.dispatched.release()
+                continue
+            if self.model.version != version:
+                # the model was refit, rank the window with the new weights
+                version = self.model.version
+                heap = [(-self.model.predict(self.features[p.task_id]), i, p) for _, i, p in heap]
+                heapq.heapify(heap)
+
+            costs = [-c for c, _, _ in heap]
+            target = self.chunksize * sum(costs) / len(costs)
+            if exhausted:
+                target = min(target, sum(costs) / (2 * self.nproc))
+            neg_cost, _, param = heapq.heappop(heap)
+            chunk, chunk_cost = [param], -neg_cost
+            while heap and len(chunk) < self.max_chunk and chunk_cost - heap[0][0] <= target:
+                neg_cost, _, param = heapq.heappop(heap)
+                chunk.append(param)
+                chunk_cost -= neg_cost
+            yield chunk
+
+    def chunk_done(self):
+        self.dispatched.release()
+
+    def observe(self, ret: dict):
+        """
+        Feed the docking time of a result back into the model.
+        """
+        features = self.features.pop(ret.get('task_id'), None)
+        seconds = ret.get('timings', dict()).get('total')
+        if features is not None and seconds is not None and 'opt_energy' in ret:
+            self.model.observe(features, seconds)
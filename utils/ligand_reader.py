@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/16 14:35
+# @Author : yuyeqing
+# @File   : ligand_reader.py
+# @IDE    : PyCharm
+import pandas as pd
+from pathlib import Path
+
+
+def _iter_csv(file_path, chunksize):
+    for chunk in pd.read_csv(file_path, usecols=['name', 'SMILES'], chunksize=chunksize):
+        yield from zip(chunk['name'], chunk['SMILES'])
+
+
+def _iter_smi(file_path, chunksize):
+    # "SMILES name" per line, as written by RDKit / Open Babel
+    with open(file_path, 'r') as f:
+        for i, line in enumerate(f):
+            fields = line.split(maxsplit=1)
+            if not fields or fields[0].startswith('#'):
+                continue
+            name = fields[1].strip() if len(fields) > 1 else f"lig-{i + 1}"
+            yield name, fields[0]
+
+
+def _iter_sdf(file_path, chunksize):
+    from rdkit import Chem
+
+    with open(file_path, 'rb') as f:
+        for i, mol in enumerate(Chem.ForwardSDMolSupplier(f)):
+            if mol is None:
+                continue
+            name = mol.GetProp('_Name') if mol.HasProp('_Name') and mol.GetProp('_Name') else f"lig-{i + 1}"
+            yield name, Chem.MolToSmiles(mol)
+
+
+def _iter_parquet(file_path, chunksize):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunksize, columns=['name', 'SMILES']):
+        yield from zip(batch.column('name').to_pylist(), batch.column('SMILES').to_pylist())
+
+
+ligand_readers = {
+    '.csv': _iter_csv,
+    '.smi': _iter_smi,
+    '.smiles': _iter_smi,
+    '.sdf': _iter_sdf,
+    '.parquet': _iter_parquet,
+}
+
+
+def iter_ligands(file_path: str, chunksize: int = 10000):
+    """
+    Lazily read a ligand library, chunk by chunk, so memory does not grow with the library size.
+
+    Csv and parquet files need the `name` and `SMILES` columns, smi files contain `SMILES name` lines
+    and sdf molecules are converted to SMILES. Rows without name or SMILES are skipped.
+
+    :param file_path: Path to the library, the format is chosen by suffix.
+    :param chunksize: Number of rows read at once from csv / parquet files.
+    :return: Iterator of (index, name, smiles), index is the row number in the library.
+    """
+    suffix = Path(file_path).suffix.lower()
+    if suffix not in ligand_readers:
+        raise ValueError(f"Unsupported ligand library format {suffix}, choose from {list(ligand_readers)}")
+    for i, (name, smiles) in enumerate(ligand_readers[suffix](file_path, chunksize)):
+        if pd.isna(name) or pd.isna(smiles) or not str(name) or not str(smiles):
+            continue
+        yield i, str(name), smiles
+
+
+class LigandCursor:
+    """
+    Reads the rows of ascending index ranges of a ligand library, e.g. the chunks a node leases from a work
+    queue, with one forward pass over the file instead of reading it from the start for every range.
+    The file is only opened again for a range starting before the rows already read.
+    """
+
+    def __init__(self, file_path: str, chunksize: int = 10000):
+        self.file_path = file_path
+        self.chunksize = chunksize
+        self._ligands = None
+        # first row after the last range, read ahead to find its end
+        self._next_row = None
+        # rows with a smaller index were read
+        self._position = 0
+
+    def range(self, start: int, stop: int):
+        """
+        :return: Iterator of (index, name, smiles) of the rows with start <= index < stop, see `iter_ligands`.
+        """
+        if self._ligands is None or start < self._position:
+            self._ligands, self._next_row, self._position = iter_ligands(self.file_path, self.chunksize), None, 0
+        while True:
+            row = self._next_row if self._next_row is not None else next(self._ligands, None)
+            self._next_row = None
+            if row is None:
+                return
+            if row[0] >= stop:
+                self._next_row = row
+                return
+            self._position = row[0] + 1
+            if row[0] >= start:
+                yield row
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/30 10:40
+# @Author : yuyeqing
+# @File   : metrics.py
+# @IDE    : PyCharm
+import os
+import csv
+import time
+import random
+import numpy as np
+from pathlib import Path
+
+CSV_COLUMNS = ['timestamp', 'elapsed', 'done', 'failed', 'ligands_per_hour',
+               'stage', 'count', 'mean', 'p50', 'p90', 'p99']
+
+
+class RunMetrics:
+    """
+    Throughput and per-stage latency percentiles of a run, from the `timings` of the result dicts.
+
+    Written every `interval` seconds either as a Prometheus textfile (`*.prom`, e.g. into the directory of
+    the node_exporter textfile collector) which is replaced on every write, or appended to a CSV file with
+    one row per stage and write. Percentiles are estimated from a uniform sample of `sample_size`
+    latencies per stage, so memory stays bounded for any library size.
+    """
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, metrics_file: str, interval: float = 60., resume: bool = False, sample_size: int = 10000):
+        """
+        :param metrics_file: Output file, Prometheus text format if it ends with .prom, CSV otherwise.
+        :param interval: Min seconds between two writes.
+        :param resume: Append to the CSV file of the previous run instead of replacing it.
+        :param sample_size: Max number of latencies kept per stage.
+        """
+        self.metrics_file = Path(metrics_file)
+        self.prometheus = self.metrics_file.suffix == '.prom'
+        self.interval = interval
+        self.sample_size = sample_size
+        self.start = time.time()
+        self.last_write = self.start
+        self.n_done = 0
+        self.n_failed = 0
+        # stage -> [count, sum of seconds, sample of seconds]
+        self.stages = dict()
+        self.rng = random.Random(0)
+        if not self.prometheus and not (resume and self.metrics_file.exists()):
+            with open(self.metrics_file, 'w', newline='') as f:
+                csv.writer(f).writerow(CSV_COLUMNS)
+
+    def add(self, ret: dict):
+        if 'opt_energy' in ret:
+            self.n_done += 1
+        else:
+            self.n_failed += 1
+        for stage, seconds in ret.get('timings', dict()).items():
+            count, total, sample = self.stages.setdefault(stage, [0, 0., []])
+            count += 1
+            # reservoir sampling, every latency of the stage is kept with the same probability
+            if len(sample) < self.sample_size:
+                sample.append(seconds)
+            else:
+                i = self.rng.randrange(count)
+                if i < self.sample_size:
+                    sample[i] = seconds
+            self.stages[stage] = [count, total + seconds, sample]
+        if time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def summary(self):
+        """
+        :return: (elapsed seconds, ligands/hour, {stage: (count, sum, mean, {quantile: seconds})}).
+        """
+        elapsed = time.time() - self.start
+        rate = (self.n_done + self.n_failed) / elapsed * 3600 if elapsed > 0 else 0.
+        stages = dict()
+        for stage, (count, total, sample) in sorted(self.stages.items()):
+            quantiles = dict(zip(self.QUANTILES, np.quantile(sample, self.QUANTILES).tolist()))
+            stages[stage] = count, total, total / count, quantiles
+        return elapsed, rate, stages
+
+    def write(self):
+        elapsed, rate, stages = self.summary()
+        if self.prometheus:
+            self._write_prometheus(elapsed, rate, stages)
+        else:
+            self._write_csv(elapsed, rate, stages)
+        self.last_write = time.time()
+
+    def _write_prometheus(self, elapsed: float, rate: float, stages: dict):
+        lines = [
+            "# HELP paradock_ligands_total Ligands with a result.",
+            "# TYPE paradock_ligands_total counter",
+            f'paradock_ligands_total{{status="done"}} {self.n_done}',
+            f'paradock_ligands_total{{status="failed"}} {self.n_failed}',
+            "# HELP paradock_elapsed_seconds Seconds since the start of the run.",
+            "# TYPE paradock_elapsed_seconds gauge",
+            f"paradock_elapsed_seconds {elapsed:.3f}",
+            "# HELP paradock_ligands_per_hour Mean throughput since the start of the run.",
+            "# TYPE paradock_ligands_per_hour gauge",
+            f"paradock_ligands_per_hour {rate:.3f}",
+            "# HELP paradock_stage_seconds Seconds per ligand spent in a stage.",
+            "# TYPE paradock_stage_seconds summary",
+        ]
+        for stage, (count, total, _, quantiles) in stages.items():
+            lines += [f'paradock_stage_seconds{{stage="{stage}",quantile="{q}"}} {v:.6f}' for q, v in quantiles.items()]
+            lines += [f'paradock_stage_seconds_sum{{stage="{stage}"}} {total:.6f}',
+                      f'paradock_stage_seconds_count{{stage="{stage}"}} {count}']
+        # the textfile collector may read at any time, so the file is replaced in one step
+        tmp_file = self.metrics_file.with_name(f".{self.metrics_file.name}.{os.getpid()}")
+        with open(tmp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, self.metrics_file)
+
+    def _write_csv(self, elapsed: float, rate: float, stages: dict):
+        head = [f"{time.time():.3f}", f"{elapsed:.3f}", self.n_done, self.n_failed, f"{rate:.3f}"]
+        with open(self.metrics_file, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if not stages:
+                writer.writerow(head + [''] * 6)
+            for stage, (count, _, mean, quantiles) in stages.items():
+                writer.writerow(head + [stage, count, f"{mean:.6f}"] + [f"{v:.6f}" for v in quantiles.values()])
+
+    def close(self):
+        self.write()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
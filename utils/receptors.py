@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/26 16:20
+# @Author : yuyeqing
+# @File   : receptors.py
+# @IDE    : PyCharm
+import yaml
+from pathlib import Path
+
+MANIFEST_SUFFIXES = ('.yaml', '.yml')
+
+
+def is_receptor_manifest(receptor_file: str):
+    return Path(receptor_file).suffix.lower() in MANIFEST_SUFFIXES
+
+
+def load_receptors(manifest_file: str, conf_yaml_file: str, out_dir: Path):
+    """
+    Read a receptor manifest for ensemble docking, e.g.
+
+        receptors:
+          - name: apo
+            pdbqt: apo.pdbqt
+          - name: holo
+            pdbqt: holo.pdbqt
+            center: [1.3, 53.3, -18.0]
+          - name: target_2
+            pdbqt: target_2.pdbqt
+            config: target_2.yaml
+
+    Every receptor uses `conf_yaml_file`, or its own `config` file, updated with the other keys of its entry
+    (e.g. its box). The resulting config of every receptor is written to `out_dir/receptors/<name>.yaml`,
+    relative paths are relative to the manifest.
+
+    :return: List of (name, conf_yaml_file, receptor_pdbqt), absolute paths.
+    """
+    manifest_file = Path(manifest_file).absolute()
+    with open(manifest_file, 'r') as f:
+        manifest = yaml.load(f, Loader=yaml.FullLoader)
+    entries = manifest['receptors'] if isinstance(manifest, dict) else manifest
+    receptor_dir = Path(out_dir).absolute() / "receptors"
+    receptor_dir.mkdir(parents=True, exist_ok=True)
+    receptors, names = [], set()
+    for entry in entries:
+        entry = dict(entry)
+        pdbqt = manifest_file.parent / entry.pop('pdbqt')
+        name = str(entry.pop('name', pdbqt.stem))
+        if name in names:
+            raise ValueError(f"Receptor name {name} is used twice in {manifest_file}")
+        names.add(name)
+        if not pdbqt.exists():
+            raise FileNotFoundError(f"Receptor {name}: {pdbqt} does not exist")
+        base_conf = manifest_file.parent / entry.pop('config') if 'config' in entry else Path(conf_yaml_file)
+        with open(base_conf, 'r') as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+        config.update(entry)
+        receptor_conf = receptor_dir / f"{name}.yaml"
+        with open(receptor_conf, 'w') as f:
+            yaml.dump(config, f)
+        receptors.append((name, str(receptor_conf), str(pdbqt)))
+    if not receptors:
+        raise ValueError(f"No receptors in {manifest_file}")
+    return receptors
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/20 10:48
+# @Author : yuyeqing
+# @File   : result_sink.py
+# @IDE    : PyCharm
+import json
+import math
+import sqlite3
+import warnings
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+RESULT_COLUMNS = ['task_id', 'name', 'status', 'opt_energy', 'energies', 'timings', 'log', 'receptor']
+
+
+def result_row(ret: dict):
+    """
+    Flatten the result dict of `process_one_task` / `process_one_task_gpu` into a results row,
+    `receptor` is only set for the receptors of an ensemble.
+    """
+    return {
+        'task_id': ret.get('task_id'),
+        'name': None if ret.get('ligand_name') is None else str(ret.get('ligand_name')),
+        'status': 'done' if 'opt_energy' in ret else 'failed',
+        'opt_energy': ret.get('opt_energy'),
+        'energies': [list(map(float, e)) for e in ret.get('energies', [])],
+        'timings': ret.get('timings', dict()),
+        'log': ret.get('log', ''),
+        'receptor': ret.get('receptor'),
+    }
+
+
+class ResultSink(ABC):
+    """
+    Collects results in the parent process and appends them in batches, so workers never write result files.
+    """
+
+    def __init__(self, out_dir: str, resume: bool = False, batch_size: int = 1000):
+        """
+        :param out_dir: Output directory of the run.
+        :param resume: Append to the results of the previous run instead of replacing them.
+        :param batch_size: Number of rows buffered before they are written.
+        """
+        self.out_dir = Path(out_dir)
+        self.resume = resume
+        self.batch_size = batch_size
+        self.rows = []
+
+    def write(self, ret: dict):
+        self.rows.append(result_row(ret))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.write_rows(self.rows)
+            self.rows = []
+
+    @abstractmethod
+    def write_rows(self, rows: list):
+        """
+        Append a batch of results rows, see `result_row`.
+        """
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SQLiteResultSink(ResultSink):
+    """
+    Results in `results.sqlite`, table `results`; energies and timings are stored as json text.
+    """
+
+    def __init__(self, out_dir: str, resume: bool = False, batch_size: int = 1000, journal_mode: str = "WAL"):
+        """
+        :param journal_mode: WAL, or DELETE on a filesystem shared by several nodes, as WAL needs shared memory
+                             which network filesystems do not provide.
+        """
+        super().__init__(out_dir, resume, batch_size)
+        self.result_file = self.out_dir / "results.sqlite"
+        self.conn = sqlite3.connect(self.result_file)
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        if not resume:
+            self.conn.execute("DROP TABLE IF EXISTS results")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " task_id INTEGER, name TEXT, status TEXT, opt_energy REAL,"
+            " energies TEXT, timings TEXT, log TEXT, receptor TEXT)"
+        )
+        # results of a run from before ensemble docking
+        if 'receptor' not in [row[1] for row in self.conn.execute("PRAGMA table_info(results)")]:
+            self.conn.execute("ALTER TABLE results ADD COLUMN receptor TEXT")
+        self.conn.commit()
+
+    def write_rows(self, rows: list):
+        self.conn.executemany(
+            f"INSERT INTO results ({', '.join(RESULT_COLUMNS)}) VALUES ({', '.join('?' * len(RESULT_COLUMNS))})",
+            [(r['task_id'], r['name'], r['status'], r['opt_energy'],
+              json.dumps(r['energies']), json.dumps(r['timings']), r['log'], r['receptor']) for r in rows]
+        )
+        self.conn.commit()
+
+    def close(self):
+        super().close()
+        self.conn.close()
+
+
+class ParquetResultSink(ResultSink):
+    """
+    Results in the parquet dataset `results/`, one part file per run and one row group per batch.
+    Read it with `pandas.read_parquet(out_dir / "results")`.
+
+    The part is written to a hidden temporary file, which parquet readers skip, and renamed on close,
+    so a crashed run never leaves a part without footer in the dataset.
+    """
+
+    def __init__(self, out_dir: str, resume: bool = False, batch_size: int = 1000):
+        import pyarrow as pa
+
+        super().__init__(out_dir, resume, batch_size)
+        self.result_dir = self.out_dir / "results"
+        self.result_dir.mkdir(parents=True, exist_ok=True)
+        parts = sorted(self.result_dir.glob("part-*.parquet"))
+        if not resume:
+            for part in parts:
+                part.unlink()
+            parts = []
+        # parts of crashed runs, never completed
+        for part in self.result_dir.glob(".part-*.parquet.tmp"):
+            part.unlink()
+        self.result_file = self.result_dir / f"part-{len(parts):05d}.parquet"
+        self.tmp_file = self.result_dir / f".{self.result_file.name}.tmp"
+        self.schema = pa.schema([
+            ('task_id', pa.int64()),
+            ('name', pa.string()),
+            ('status', pa.string()),
+            ('opt_energy', pa.float64()),
+            ('energies', pa.list_(pa.list_(pa.float64()))),
+            ('timings', pa.string()),
+            ('log', pa.string()),
+            ('receptor', pa.string()),
+        ])
+        self.writer = None
+
+    def write_rows(self, rows: list):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.tmp_file, self.schema)
+        columns = {c: [r[c] for r in rows] for c in RESULT_COLUMNS}
+        columns['timings'] = [json.dumps(t) for t in columns['timings']]
+        self.writer.write_table(pa.table(columns, schema=self.schema))
+
+    def close(self):
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+            self.tmp_file.replace(self.result_file)
+
+
+result_sinks = {
+    'sqlite': SQLiteResultSink,
+    'parquet': ParquetResultSink,
+}
+
+
+def open_result_sink(results_format: str, out_dir: str, resume: bool = False, batch_size: int = 1000,
+                     shared: bool = False):
+    """
+    :param results_format: 'sqlite', 'parquet', or 'json' for the legacy per-ligand json files.
+    :param shared: `out_dir` is on a filesystem shared by several nodes.
+    :return: The result sink, None for 'json' as these files are written by the workers.
+    """
+    if results_format == 'json':
+        return None
+    if results_format not in result_sinks:
+        raise ValueError(f"Unknown results format {results_format}, choose from {['json'] + list(result_sinks)}")
+    kwargs = {'journal_mode': 'DELETE'} if shared and results_format == 'sqlite' else dict()
+    return result_sinks[results_format](out_dir, resume=resume, batch_size=batch_size, **kwargs)
+
+
+def read_parquet_parts(result_dir: str, columns: list = None):
+    """
+    Read the parts of a parquet results directory one by one, skipping those that are not complete
+    parquet files, e.g. written by an older version that crashed, instead of failing on the whole dataset.
+
+    :return: (pyarrow Table, None if no part was read, list of the paths of the skipped parts)
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables, skipped = [], []
+    for part in sorted(Path(result_dir).glob("part-*.parquet")):
+        try:
+            tables.append(pq.read_table(part, columns=columns))
+        except (OSError, pa.ArrowInvalid):
+            skipped.append(part)
+    return (pa.concat_tables(tables) if tables else None), skipped
+
+
+def read_parquet_results(out_dir: Path, columns: list):
+    """
+    :return: pandas DataFrame of `columns` of the readable parts of `out_dir/results`, a warning for every other.
+    """
+    import pandas as pd
+
+    table, skipped = read_parquet_parts(out_dir / "results", columns)
+    for part in skipped:
+        warnings.warn(f"skipped {part}, not a complete parquet file")
+    return table.to_pandas() if table is not None else pd.DataFrame(columns=columns)
+
+
+def select_best(results_format: str, out_dir: str, n: int = None, fraction: float = None):
+    """
+    Task ids of the best docked ligands in the results of `out_dir`, ranked by their lowest opt_energy.
+
+    :param results_format: 'sqlite' or 'parquet', the format the results were written in.
+    :param n: Number of ligands to select.
+    :param fraction: Fraction of the successfully docked ligands to select, used when `n` is None.
+    :return: List of task ids, best first.
+    """
+    out_dir = Path(out_dir)
+    if results_format == 'sqlite':
+        conn = sqlite3.connect(out_dir / "results.sqlite")
+        best = [row[0] for row in conn.execute(
+            "SELECT task_id FROM results WHERE status = 'done' GROUP BY task_id ORDER BY MIN(opt_energy)")]
+        conn.close()
+    elif results_format == 'parquet':
+        df = read_parquet_results(out_dir, ['task_id', 'status', 'opt_energy'])
+        best = df[df.status == 'done'].groupby('task_id').opt_energy.min().sort_values().index.tolist()
+    else:
+        raise ValueError(f"Can not select from results format {results_format}")
+    if n is None:
+        n = math.ceil(len(best) * fraction)
+    return best[:n]
+
+
+def merge_results(results_format: str, src_dirs: list, out_dir: str):
+    """
+    Merge the results of several output directories, e.g. the nodes of a multi-node run, into `out_dir`.
+    Existing results in `out_dir` are replaced.
+
+    A ligand docked twice, e.g. in a chunk taken over from a crashed node, keeps one row per receptor:
+    the last successful one, else the last one. The parquet part a crashed node was writing is still a
+    temporary file and is not merged, parts that can not be read are skipped.
+
+    :return: Paths of the skipped parquet parts.
+    """
+    out_dir = Path(out_dir)
+    skipped = []
+    if results_format == 'sqlite':
+        sink = SQLiteResultSink(out_dir, journal_mode='DELETE')
+        columns = ', '.join(RESULT_COLUMNS)
+        for src_dir in src_dirs:
+            src_file = Path(src_dir) / "results.sqlite"
+            if not src_file.exists():
+                continue
+            sink.conn.execute("ATTACH DATABASE ? AS src", (str(src_file),))
+            sink.conn.execute(f"INSERT INTO results ({columns}) SELECT {columns} FROM src.results")
+            sink.conn.commit()
+            sink.conn.execute("DETACH DATABASE src")
+        sink.conn.execute(
+            "DELETE FROM results WHERE rowid NOT IN (SELECT rowid FROM ("
+            " SELECT rowid, ROW_NUMBER() OVER (PARTITION BY task_id, receptor"
+            " ORDER BY status = 'done' DESC, rowid DESC) AS n FROM results) WHERE n = 1)")
+        sink.conn.commit()
+        sink.close()
+    elif results_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        tables = []
+        for src_dir in src_dirs:
+            table, src_skipped = read_parquet_parts(Path(src_dir) / "results")
+            tables += [table] if table is not None else []
+            skipped += src_skipped
+        result_dir = out_dir / "results"
+        result_dir.mkdir(parents=True, exist_ok=True)
+        for part in result_dir.glob("part-*.parquet"):
+            part.unlink()
+        if tables:
+            table = pa.concat_tables(tables)
+            # per task and receptor, the done row ranks above the failed ones and a later row above an earlier one
+            n = len(table)
+            rank = pc.add(pc.multiply(pc.cast(pc.equal(table['status'], 'done'), pa.int64()), n),
+                          pa.array(range(n), pa.int64()))
+            best = table.append_column('_rank', rank).group_by(['task_id', 'receptor']).aggregate([('_rank', 'max')])
+            rows = sorted(r % n for r in best['_rank_max'].to_pylist())
+            tmp_file = result_dir / ".part-00000.parquet.tmp"
+            pq.write_table(table.take(rows), tmp_file)
+            tmp_file.replace(result_dir / "part-00000.parquet")
+    return skipped
+
+
+def ensemble_matrix(results_format: str, out_dir: str, receptors: list):
+    """
+    Ligand x receptor matrix of the lowest opt_energy of an ensemble run, with the ensemble aggregates
+    `best`, `mean` (over the receptors the ligand docked to) and `best_receptor`, best ligands first.
+
+    :param results_format: 'sqlite' or 'parquet', the format the results were written in.
+    :param receptors: Receptor names, the column order.
+    :return: pandas DataFrame indexed by (task_id, name).
+    """
+    import pandas as pd
+
+    out_dir = Path(out_dir)
+    columns = ['task_id', 'name', 'receptor', 'opt_energy']
+    if results_format == 'sqlite':
+        conn = sqlite3.connect(out_dir / "results.sqlite")
+        df = pd.read_sql_query(f"SELECT {', '.join(columns)} FROM results "
+                               f"WHERE status = 'done' AND receptor IS NOT NULL", conn)
+        conn.close()
+    elif results_format == 'parquet':
+        df = read_parquet_results(out_dir, columns + ['status'])
+        df = df[(df.status == 'done') & df.receptor.notna()]
+    else:
+        raise ValueError(f"Can not build the ensemble matrix from results format {results_format}")
+    matrix = df.pivot_table(index=['task_id', 'name'], columns='receptor', values='opt_energy', aggfunc='min')
+    matrix = matrix.reindex(columns=receptors)
+    matrix.columns.name = None
+    energies = matrix[receptors]
+    matrix['best'] = energies.min(axis=1)
+    matrix['mean'] = energies.mean(axis=1)
+    matrix['best_receptor'] = energies.idxmin(axis=1)
+    return matrix.sort_values('best')
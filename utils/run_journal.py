@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/14 9:20
+# @Author : yuyeqing
+# @File   : run_journal.py
+# @IDE    : PyCharm
+import threading
+from pathlib import Path
+
+
+class RunJournal:
+    """
+    Append-only journal of a dock-run, one `status<TAB>task_id<TAB>ligand_name` line per event.
+
+    Only the parent process writes the journal, workers report back through the pool results,
+    so lines of concurrently finishing ligands can not interleave. A resumed run reads the
+    journal once instead of checking the output files of every ligand.
+    """
+    STARTED = 'started'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, journal_file: str, resume: bool = False, retry_failed: bool = False):
+        """
+        :param journal_file: Path of the journal file.
+        :param resume: Keep and load the existing journal, otherwise start a new one.
+        :param retry_failed: Failed ligands are not finished, a resumed run docks them again.
+        """
+        self.journal_file = Path(journal_file)
+        self.status, self.attempts = self.load(self.journal_file, with_attempts=True) if resume else (dict(), dict())
+        self.finished_statuses = self.finished(retry_failed)
+        self._lock = threading.Lock()
+        if resume:
+            self.truncate_torn_line(self.journal_file)
+        self._fp = open(self.journal_file, 'a' if resume else 'w')
+
+    @staticmethod
+    def truncate_torn_line(journal_file: Path, block_size: int = 4096):
+        """
+        Cut an incomplete last line left by a crash, so the first appended line does not continue it.
+        """
+        if not journal_file.exists():
+            return
+        with open(journal_file, 'rb+') as f:
+            end = f.seek(0, 2)
+            pos = end
+            while pos > 0:
+                start = max(pos - block_size, 0)
+                f.seek(start)
+                i = f.read(pos - start).rfind(b'\n')
+                if i >= 0:
+                    pos = start + i + 1
+                    break
+                pos = start
+            if pos < end:
+                f.truncate(pos)
+
+    @staticmethod
+    def load(journal_file: Path, with_attempts: bool = False):
+        """
+        Read the journal, the last status of every ligand wins.
+
+        :param with_attempts: Also count the attempts of every ligand, its `started` lines.
+        :return: Dict of ligand name to status, and with `with_attempts` dict of ligand name to attempts.
+        """
+        status, attempts = dict(), dict()
+        if journal_file.exists():
+            with open(journal_file, 'r') as f:
+                for line in f:
+                    # a crash may leave the last line incomplete
+                    if not line.endswith('\n'):
+                        break
+                    fields = line.rstrip('\n').split('\t', 2)
+                    if len(fields) == 3:
+                        status[fields[2]] = fields[0]
+                        if fields[0] == RunJournal.STARTED:
+                            attempts[fields[2]] = attempts.get(fields[2], 0) + 1
+        return (status, attempts) if with_attempts else status
+
+    @classmethod
+    def finished(cls, retry_failed: bool = False):
+        """
+        :return: Statuses of the ligands a resumed run skips.
+        """
+        return (cls.DONE,) if retry_failed else (cls.DONE, cls.FAILED)
+
+    def is_finished(self, ligand_name):
+        return self.status.get(str(ligand_name)) in self.finished_statuses
+
+    def record(self, status: str, task_id, ligand_name):
+        # ligands are processed in parallel, but each line goes out in a single write
+        line = f"{status}\t{task_id}\t{ligand_name}\n"
+        with self._lock:
+            if status == self.STARTED:
+                self.attempts[str(ligand_name)] = self.attempts.get(str(ligand_name), 0) + 1
+            self._fp.write(line)
+            self._fp.flush()
+
+    def iter_started(self, task_params):
+        """
+        Mark every task as started when it is handed to the pool.
+        """
+        for param in task_params:
+            self.record(self.STARTED, param.task_id, param.ligand_name)
+            yield param
+
+    def record_result(self, ret: dict):
+        status = self.DONE if 'opt_energy' in ret else self.FAILED
+        self.record(status, ret.get('task_id'), ret.get('ligand_name'))
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/30 9:15
+# @Author : yuyeqing
+# @File   : timing.py
+# @IDE    : PyCharm
+import os
+import time
+import cProfile
+from pathlib import Path
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+
+# seconds of stages not tied to one ligand, e.g. receptor loading and map computation of a worker,
+# charged to the next ligand the process finishes
+_pending = dict()
+
+
+@contextmanager
+def timed(stage: str, timings: dict = None):
+    """
+    Add the seconds spent in the block to `timings[stage]`, or to the pending timings of the process.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _pending if timings is None else timings
+        timings[stage] = timings.get(stage, 0.) + time.perf_counter() - start
+
+
+def take_pending(timings: dict):
+    """
+    Charge the pending stage timings of the process to the ligand of `timings`.
+    """
+    for stage in list(_pending):
+        timings[stage] = timings.get(stage, 0.) + _pending.pop(stage)
+    return timings
+
+
+def profile_file(profile_dir: str, role: str):
+    return Path(profile_dir) / f"{role}_{os.getpid()}.prof"
+
+
+def start_profile(profile_dir: str, role: str):
+    """
+    Profile the rest of this process with cProfile, the stats are written to `<profile_dir>/<role>_<pid>.prof`
+    when the process exits normally. Read them with `python -m pstats`.
+    """
+    Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    profiler = cProfile.Profile()
+    # multiprocessing runs its finalizers when a worker exits, atexit handlers are skipped there
+    Finalize(None, profiler.dump_stats, args=(str(profile_file(profile_dir, role)),), exitpriority=10)
+    profiler.enable()
+    return profiler
+
+
+def init_profiled_worker(profile_dir: str, role: str, initializer=None, *initargs):
+    """
+    Pool initializer starting the profile of the worker before its own `initializer`.
+    """
+    start_profile(profile_dir, role)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+@contextmanager
+def profiled(profile_dir: str, role: str):
+    """
+    Profile the block, e.g. the serial docking loop in the main process.
+    """
+    if profile_dir is None:
+        yield
+        return
+    Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(str(profile_file(profile_dir, role)))
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/9 14:20
+# @Author : yuyeqing
+# @File   : tool_version.py
+# @IDE    : PyCharm
+import os
+import shutil
+import hashlib
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def _file_sha256(path, mtime_ns, size):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def executable_sha256(name: str):
+    """
+    sha256 of an executable on PATH, or of the given path, after resolving symlinks. It stands in for the
+    version of tools without one in cache keys, computed once per process and again when the file changes.
+
+    :return: The hex digest, None if the executable is not found.
+    """
+    path = shutil.which(name)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return _file_sha256(path, stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/26 11:02
+# @Author : yuyeqing
+# @File   : top_hits.py
+# @IDE    : PyCharm
+import os
+import csv
+import time
+import heapq
+from pathlib import Path
+
+
+class TopHits:
+    """
+    Bounded heap of the k best (lowest) opt_energy results seen so far, plus a periodically
+    rewritten ranked summary csv. Memory depends on k only, not on the library size.
+    """
+
+    def __init__(self, k: int, summary_file: str, interval: float = 60., resume: bool = False):
+        """
+        :param k: Number of hits to keep.
+        :param summary_file: Path of the ranked summary csv.
+        :param interval: Min seconds between two summary writes.
+        :param resume: Start from the hits of the existing summary file.
+        """
+        self.k = k
+        self.summary_file = Path(summary_file)
+        self.interval = interval
+        # max-heap on energy via negated values, the worst kept hit is on top
+        self.heap = []
+        self.names = set()
+        self.n_seen = 0
+        self.last_write = time.time()
+        if resume and self.summary_file.exists():
+            self.load(self.summary_file)
+
+    def load(self, summary_file: str):
+        """
+        Add the hits of a ranked summary csv, e.g. of a previous run or of another node.
+        """
+        with open(summary_file, 'r') as f:
+            for row in csv.DictReader(f):
+                self.push(float(row['opt_energy']), row['name'], row['task_id'])
+
+    def push(self, opt_energy: float, name: str, task_id):
+        item = (-opt_energy, self.n_seen, name, task_id)
+        self.n_seen += 1
+        if name in self.names:
+            # docked again, e.g. after resume, keep the better result only
+            old = next(x for x in self.heap if x[2] == name)
+            if item[0] > old[0]:
+                self.heap.remove(old)
+                self.heap.append(item)
+                heapq.heapify(self.heap)
+        elif len(self.heap) < self.k:
+            heapq.heappush(self.heap, item)
+            self.names.add(name)
+        elif item[0] > self.heap[0][0]:
+            self.names.discard(heapq.heapreplace(self.heap, item)[2])
+            self.names.add(name)
+
+    def add(self, ret: dict):
+        if ret.get('opt_energy') is not None:
+            self.push(float(ret['opt_energy']), ret['ligand_name'], ret.get('task_id'))
+        if time.time() - self.last_write >= self.interval:
+            self.write_summary()
+
+    def ranked(self):
+        """
+        :return: List of (rank, name, task_id, opt_energy), best first.
+        """
+        items = sorted(self.heap, key=lambda x: (-x[0], x[1]))
+        return [(rank, name, task_id, -neg_e) for rank, (neg_e, _, name, task_id) in enumerate(items, 1)]
+
+    def write_summary(self):
+        # write then rename, readers never see a half written summary
+        tmp_file = self.summary_file.with_name(self.summary_file.name + ".tmp")
+        with open(tmp_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['rank', 'name', 'task_id', 'opt_energy'])
+            writer.writerows(self.ranked())
+        os.replace(tmp_file, self.summary_file)
+        self.last_write = time.time()
+
+    def close(self):
+        self.write_summary()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/5/6 9:40
+# @Author : yuyeqing
+# @File   : vina_maps.py
+# @IDE    : PyCharm
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+import vina
+from vina import Vina
+from utils.timing import timed
+
+
+def map_cache_key(receptor_pdbqt: str, center, box_size, spacing, sf_name: str = 'vina'):
+    """
+    Hash of everything the affinity maps depend on, including the Vina version that computes them.
+
+    :param receptor_pdbqt: Path to the receptor pdbqt file, its content is hashed.
+    :param sf_name: Scoring function, 'vina' or 'vinardo'.
+    :return: Hex digest used as the name of the cache entry.
+    """
+    h = hashlib.sha256()
+    with open(receptor_pdbqt, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    grid = {
+        'vina_version': vina.__version__,
+        'sf_name': sf_name,
+        'center': [float(x) for x in center],
+        'box_size': [float(x) for x in box_size],
+        'spacing': float(spacing),
+    }
+    h.update(json.dumps(grid, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def create_vina(config: dict):
+    return Vina(sf_name=config.get("sf_name", "vina"), cpu=config.get("cpu", 1), seed=config.get("seed", 42),
+                verbosity=1)
+
+
+def compute_maps(v: Vina, config: dict, receptor_pdbqt: str, force_even_voxels: bool = False):
+    v.set_receptor(receptor_pdbqt)
+    # maps are computed before any ligand is set, so all atom types are covered
+    v.compute_vina_maps(center=config['center'],
+                        box_size=config['box_size'],
+                        spacing=config['spacing'],
+                        force_even_voxels=force_even_voxels)
+
+
+def cached_map_prefix(config: dict, receptor_pdbqt: str, map_cache_dir: str):
+    """
+    Return the map prefix of the cache entry, computing and writing the maps if the entry does not exist.
+
+    The maps are written to a temporary directory and renamed into place, so concurrent
+    workers or runs either see a complete entry or none at all.
+
+    :param config: Docking config loaded from the yaml file.
+    :param receptor_pdbqt: Path to the receptor pdbqt file.
+    :param map_cache_dir: Root directory of the map cache.
+    :return: Map prefix that can be passed to `Vina.load_maps`.
+    """
+    key = map_cache_key(receptor_pdbqt, config['center'], config['box_size'], config['spacing'],
+                        sf_name=config.get('sf_name', 'vina'))
+    entry = Path(map_cache_dir) / key
+    prefix = entry / "receptor"
+    if entry.exists():
+        return str(prefix)
+
+    Path(map_cache_dir).mkdir(parents=True, exist_ok=True)
+    tmp_entry = Path(tempfile.mkdtemp(prefix=f".{key}.", dir=map_cache_dir))
+    try:
+        with timed('maps'):
+            v = create_vina(config)
+            # writing maps requires an even number of voxels
+            compute_maps(v, config, receptor_pdbqt, force_even_voxels=True)
+            v.write_maps(map_prefix_filename=str(tmp_entry / "receptor"), overwrite=True)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another process finished the same entry first
+            if not entry.exists():
+                raise
+    finally:
+        if tmp_entry.exists():
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+    return str(prefix)
+
+
+def load_vina(config: dict, receptor_pdbqt: str, map_cache_dir: str = None):
+    """
+    Create a Vina object with the receptor affinity maps ready for docking.
+
+    :param config: Docking config loaded from the yaml file.
+    :param receptor_pdbqt: Path to the receptor pdbqt file.
+    :param map_cache_dir: Optional map cache directory, maps are loaded from it instead of recomputed.
+    :return: Vina object, only the ligand has to be set before docking.
+    """
+    v = create_vina(config)
+    if map_cache_dir:
+        map_prefix = cached_map_prefix(config, receptor_pdbqt, map_cache_dir)
+        with timed('receptor_load'):
+            v.load_maps(map_prefix)
+    else:
+        with timed('maps'):
+            compute_maps(v, config, receptor_pdbqt)
+    return v
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time   : 2025/6/24 10:12
+# @Author : yuyeqing
+# @File   : work_queue.py
+# @IDE    : PyCharm
+import time
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+
+
+class WorkQueue:
+    """
+    Work queue of a multi-node dock-run in a SQLite file on the shared filesystem, no broker needed.
+
+    The library is split into chunks of consecutive task ids. A node leases a chunk for `lease_seconds`
+    and keeps renewing the lease while it works on it; the chunk of a crashed node expires and is
+    leased again by another node. Leases use wall clock time, so the clocks of the nodes must be in sync.
+
+    The database uses a rollback journal instead of WAL, as WAL needs shared memory which network
+    filesystems do not provide; every lease is one short write transaction.
+    """
+    PENDING = 'pending'
+    LEASED = 'leased'
+    # all results written, the node has not closed them yet; leased again if the node stops renewing
+    FINISHED = 'finished'
+    DONE = 'done'
+
+    def __init__(self, queue_file: str, lease_seconds: float = 600., timeout: float = 60.):
+        """
+        :param queue_file: Path of the queue database, created if it does not exist.
+        :param lease_seconds: Seconds a lease is valid without renewal.
+        :param timeout: Seconds to wait for the lock of another node.
+        """
+        self.queue_file = Path(queue_file)
+        self.lease_seconds = lease_seconds
+        self.conn = sqlite3.connect(self.queue_file, timeout=timeout, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self._lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " chunk_id INTEGER PRIMARY KEY, start INTEGER, stop INTEGER, status TEXT,"
+            " owner TEXT, lease_until REAL, attempts INTEGER DEFAULT 0)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _write(self, sql: str, args=()):
+        """
+        Run one statement in its own write transaction.
+
+        :return: (returned rows, number of changed rows).
+        """
+        # BEGIN IMMEDIATE takes the write lock up front, so two nodes can not lease the same chunk
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self.conn.execute(sql, args)
+                rows = cur.fetchall()
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return rows, cur.rowcount
+
+    def create(self, n_tasks: int, chunk_size: int):
+        """
+        Split task ids 0..n_tasks - 1 into chunks, only the first node to arrive does.
+
+        :return: True if this call created the chunks.
+        """
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0] > 0:
+                    self.conn.execute("COMMIT")
+                    return False
+                self.conn.executemany(
+                    "INSERT INTO chunks (chunk_id, start, stop, status) VALUES (?, ?, ?, ?)",
+                    [(i, start, min(start + chunk_size, n_tasks), self.PENDING)
+                     for i, start in enumerate(range(0, n_tasks, chunk_size))]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return True
+
+    def lease(self, owner: str):
+        """
+        Lease the next pending or expired chunk.
+
+        :return: (chunk_id, start, stop), None if no chunk is left to lease.
+        """
+        now = time.time()
+        rows, _ = self._write(
+            "UPDATE chunks SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1"
+            " WHERE chunk_id = (SELECT chunk_id FROM chunks WHERE status = ? OR (status IN (?, ?) AND lease_until < ?)"
+            " ORDER BY chunk_id LIMIT 1) RETURNING chunk_id, start, stop",
+            (self.LEASED, owner, now + self.lease_seconds, self.PENDING, self.LEASED, self.FINISHED, now)
+        )
+        return rows[0] if rows else None
+
+    def renew(self, owner: str, chunk_ids):
+        """
+        Extend the leases of `owner` on `chunk_ids`, chunks taken over by another node are not touched.
+        """
+        chunk_ids = list(chunk_ids)
+        if chunk_ids:
+            self._write(f"UPDATE chunks SET lease_until = ? WHERE owner = ? AND status IN (?, ?) "
+                        f"AND chunk_id IN ({', '.join('?' * len(chunk_ids))})",
+                        (time.time() + self.lease_seconds, owner, self.LEASED, self.FINISHED, *chunk_ids))
+
+    def finish(self, chunk_id: int, owner: str):
+        self._write("UPDATE chunks SET status = ? WHERE chunk_id = ? AND owner = ?", (self.FINISHED, chunk_id, owner))
+
+    def complete(self, chunk_id: int, owner: str):
+        self._write("UPDATE chunks SET status = ?, owner = ?, lease_until = NULL WHERE chunk_id = ?",
+                    (self.DONE, owner, chunk_id))
+
+    def counts(self):
+        """
+        :return: Dict of status to number of chunks, expired leases count as pending.
+        """
+        counts = {self.PENDING: 0, self.LEASED: 0, self.FINISHED: 0, self.DONE: 0}
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT CASE WHEN status IN (?, ?) AND lease_until < ? THEN ? ELSE status END AS s, COUNT(*) "
+                "FROM chunks GROUP BY s", (self.LEASED, self.FINISHED, time.time(), self.PENDING)).fetchall()
+        counts.update(dict(rows))
+        return counts
+
+    def n_leased_by_others(self, owner: str):
+        """
+        Number of chunks other nodes are docking or closing, they may still expire and be leased again.
+        """
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks WHERE status IN (?, ?) AND owner != ?",
+                                     (self.LEASED, self.FINISHED, owner)).fetchone()[0]
+
+    def done_owners(self):
+        """
+        Nodes that completed at least one chunk, their results are needed for the merge.
+        """
+        with self._lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT owner FROM chunks WHERE status = ?", (self.DONE,))]
+
+    def heartbeat(self, owner: str):
+        self._write("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"heartbeat:{owner}", str(time.time())))
+
+    def last_heartbeat(self, owner: str):
+        """
+        :return: Time of the last heartbeat of `owner`, 0 if it never sent one.
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (f"heartbeat:{owner}",)).fetchone()
+        return float(row[0]) if row else 0.
+
+    def all_done(self):
+        counts = self.counts()
+        return sum(counts.values()) > 0 and counts[self.DONE] == sum(counts.values())
+
+    def claim(self, key: str, owner: str):
+        """
+        Claim a one-off job such as merging the results, only the first node succeeds.
+        """
+        _, n_changed = self._write("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (key, owner))
+        return n_changed == 1
+
+    def close(self):
+        self.conn.close()
+
+
+def claim_node_id(nodes_dir: str):
+    """
+    Default node id `<hostname>-<slot>`, with the lowest slot no running process on this host holds, so a
+    restarted node gets the id of the one it replaces and continues its results. The slot is held by a
+    lock on `nodes_dir/<node id>/node.lock` until the returned file is closed or the process exits.
+
+    :return: (node id, open lock file).
+    """
+    import fcntl
+
+    host = socket.gethostname()
+    slot = 0
+    while True:
+        node_id = f"{host}-{slot}"
+        node_dir = Path(nodes_dir) / node_id
+        node_dir.mkdir(parents=True, exist_ok=True)
+        lock_file = open(node_dir / "node.lock", 'a')
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return node_id, lock_file
+        except OSError:
+            lock_file.close()
+            slot += 1
+
+
+class LeasedTasks:
+    """
+    Task ids of the chunks a node holds. Chunks are leased lazily while the pipeline pulls ligands,
+    renewed by a heartbeat thread, and completed once every ligand of the chunk has a result on disk.
+
+    The last finished chunk stays FINISHED until `complete_finished` is called once the node has closed its
+    results, so the queue is never all done while a node is still writing.
+    """
+
+    def __init__(self, queue: WorkQueue, owner: str):
+        self.queue = queue
+        self.owner = owner
+        # chunk id -> task ids handed out but without result yet
+        self.pending = dict()
+        self.chunk_of = dict()
+        # chunks still being handed out, not complete even if nothing is pending
+        self.open_chunks = set()
+        # chunks with all results, completed with the next flush of the results
+        self.finished_chunks = set()
+        # finished chunks kept FINISHED until the node has closed its results
+        self.held_chunks = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.queue.heartbeat(owner)
+        self._heartbeat = threading.Thread(target=self._renew_loop, daemon=True)
+        self._heartbeat.start()
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            with self._lock:
+                chunk_ids = list(self.pending) + list(self.finished_chunks) + list(self.held_chunks)
+            self.queue.renew(self.owner, chunk_ids)
+            self.queue.heartbeat(self.owner)
+
+    def iter_chunks(self):
+        """
+        :return: Iterator of (chunk_id, range of task ids), leasing the next chunk when asked for one.
+                 Ends when no chunk can be leased, see `wait_for_chunk`.
+        """
+        while True:
+            chunk = self.queue.lease(self.owner)
+            if chunk is None:
+                return
+            chunk_id, start, stop = chunk
+            with self._lock:
+                self.pending[chunk_id] = set()
+                self.open_chunks.add(chunk_id)
+            yield chunk_id, range(start, stop)
+            with self._lock:
+                self.open_chunks.discard(chunk_id)
+                self._check_finished(chunk_id)
+
+    def add(self, chunk_id: int, task_id: int):
+        with self._lock:
+            self.pending[chunk_id].add(task_id)
+            self.chunk_of[task_id] = chunk_id
+
+    def _check_finished(self, chunk_id: int):
+        if chunk_id in self.pending and not self.pending[chunk_id] and chunk_id not in self.open_chunks:
+            del self.pending[chunk_id]
+            self.finished_chunks.add(chunk_id)
+
+    def done(self, task_id: int, flush=None):
+        """
+        Record the result of `task_id` and complete the finished chunks.
+
+        :param flush: Writes the buffered results to disk, called before a chunk is completed, so a node
+                      crashing later never leaves a completed chunk without its results.
+        """
+        with self._lock:
+            chunk_id = self.chunk_of.pop(task_id, None)
+            if chunk_id is not None:
+                self.pending[chunk_id].discard(task_id)
+                self._check_finished(chunk_id)
+            if not self.finished_chunks:
+                return
+        if flush is not None:
+            flush()
+        self.complete_finished(hold=1)
+
+    def complete_finished(self, hold: int = 0):
+        """
+        Complete the chunks that have all their results, call only once these results are on disk.
+
+        :param hold: Number of finished chunks kept FINISHED instead.
+        """
+        with self._lock:
+            chunk_ids = sorted(self.finished_chunks | self.held_chunks)
+            keep = len(chunk_ids) - hold
+            chunk_ids, held = chunk_ids[:keep], set(chunk_ids[keep:])
+            newly_held = held - self.held_chunks
+            self.finished_chunks, self.held_chunks = set(), held
+        for chunk_id in newly_held:
+            self.queue.finish(chunk_id, self.owner)
+        for chunk_id in chunk_ids:
+            self.queue.complete(chunk_id, self.owner)
+
+    def wait_for_chunk(self):
+        """
+        Wait while other nodes hold chunks, call after the results of the node are closed.
+
+        :return: True when a chunk can be leased again, e.g. the lease of a crashed node expired,
+                 False when every chunk is done.
+        """
+        while True:
+            if self.queue.counts()[WorkQueue.PENDING]:
+                return True
+            if self.queue.n_leased_by_others(self.owner) == 0:
+                return False
+            time.sleep(min(self.queue.lease_seconds / 3, 30.))
+
+    def close(self):
+        self._stop.set()